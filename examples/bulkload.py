@@ -29,10 +29,9 @@ def testaction(kw, retval):
     starttime = datetime.now()
     try:
         if _LOAD:
-            f = open(_LOAD, 'r')
-            data = json.load(f)
-            datastore.add(data) # update is very slow for this use case
-            print "data loaded from", _LOAD
+            report = datastore.bulkload(_LOAD)
+            print "data loaded from", _LOAD, 
+            print "(%(statements)d statements, %(rate)d per second)" % report
         else:
             print "opening", _DUMP
             f = open(_DUMP, 'w')
@@ -309,8 +309,12 @@ class RequestProcessor(TransactionProcessor):
         initConstants( ['secure_file_access', 'use_etags'], True)
         self.default_expires_in = appVars.get('default_expires_in', 0)
         initConstants( ['action_cache_size'], 0)
+        initConstants( ['stream_query_results'], False)
         self.validate_external_request = appVars.get('validate_external_request',
                                         lambda *args: True)
+        initConstants( ['server_threads'], 0)
+        self.is_read_only_request = appVars.get('is_read_only_request',
+                                        lambda kw: False)
         self.get_principal_func = appVars.get('get_principal_func', lambda kw: '')        
         
         if appVars.get('configHook'):
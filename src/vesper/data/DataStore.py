@@ -8,12 +8,13 @@
 """
 import StringIO, os, os.path
 import logging
-import time
+import time, copy
+import threading
 
 from vesper.data import base, transactions
 from vesper.data.base import graph as graphmod # avoid aliasing some local vars
 from vesper.data.store.basic import MemStore, FileStore, IncrementalNTriplesFileStoreBase
-from vesper.utils import debugp, flatten, defaultattrdict
+from vesper.utils import debugp, flatten, defaultattrdict, attrdict, ThreadPool
 from vesper.data.base.utils import OrderedModel
 from vesper.data.base.schema import defaultSchemaClass
 
@@ -34,6 +35,43 @@ def _toStatements(contents, **kw):
     stmts, emptyobjs = pjson.Parser(**kw).to_rdf(contents)
     return stmts, contents, emptyobjs
 
+def _batches(items, batchSize):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batchSize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _iterPjson(stream, format):
+    '''
+    Yields the top-level objects in the stream. If format is 'pjsonlines'
+    each line of the stream is parsed as a separate json document, otherwise
+    the stream is parsed as one document (so must fit in memory).
+    '''
+    if format == 'pjsonlines':
+        for line in stream:
+            if line.strip():
+                obj = pjson.json.loads(line)
+                if isinstance(obj, list):
+                    for item in obj:
+                        yield item
+                else:
+                    yield obj
+    else:
+        obj = pjson.json.load(stream)
+        if isinstance(obj, dict) and 'pjson' in obj:
+            #yield the header then the objects it applies to
+            data = obj.pop('data', [])
+            yield obj
+            obj = data
+        if not isinstance(obj, list):
+            obj = [obj]
+        for item in obj:
+            yield item
+
 class DataStore(transactions.TransactionParticipant): # XXX this base class can go away
     '''
     Abstract interface for DataStores
@@ -111,13 +149,47 @@ class BasicStore(DataStore):
                  replication_hosts=None,
                  replication_channel=None,
                  send_stomp_ack=True,
+                 query_cache_size=200,
+                 snapshot_reads=True,
+                 query_result_cache_size=0,
+                 query_result_cache_max_rows=1000,
+                 query_parallelism=0,
+                 sort_buffer_rows=0,
                  **kw):
         '''
         model_factory is a base.Model class or factory function that takes
         two parameters:
           a location (usually a local file path) and iterator of Statements
           to initialize the model if it needs to be created
+
+        query_cache_size is the maximum number of parsed queries to keep 
+        (0 disables the cache)
+
+        If snapshot_reads is True and the model supports snapshots 
+        (see `base.Model.getSnapshot`) queries in transactions that haven't 
+        modified anything read a snapshot of the last committed version of 
+        the store instead of the model, so they don't see the changes of a
+        transaction that is in progress in another thread. 
+
+        query_result_cache_size is the maximum number of query results to 
+        keep in a `vesper.query.QueryResultCache` shared by all transactions
+        (0 disables the cache). Only the results of queries that read a 
+        snapshot are cached, and only if they have at most 
+        query_result_cache_max_rows rows.
+
+        If query_parallelism is greater than 1, up to that many threads 
+        (the thread running the query and a pool of query_parallelism - 1 
+        threads shared by all queries) evaluate the independent branches of 
+        a query's joins concurrently, if the model supports concurrent reads
+        (see `base.Model.concurrentReads`).
+
+        If sort_buffer_rows is set, a query's ``order by`` sorts at most that
+        many rows in memory, spilling sorted runs of rows to temporary files
+        and merging them if there are more (0 always sorts in memory).
+        It also limits the number of groups kept in memory by a ``group by``
+        that only outputs aggregate functions.
         '''
+        import vesper.query
         self.requestProcessor = requestProcessor
         self.model_factory = model_factory
         self.version_model_factory = version_model_factory
@@ -144,6 +216,23 @@ class BasicStore(DataStore):
                 
         self._txnparticipants = []
         self.model_options = model_options or {}
+        self.astCache = vesper.query.ASTCache(query_cache_size)
+        self.snapshot_reads = snapshot_reads
+        if query_result_cache_size:
+            self.resultCache = vesper.query.QueryResultCache(
+                        query_result_cache_size, query_result_cache_max_rows)
+        else:
+            self.resultCache = None
+        if query_parallelism > 1:
+            self.queryPool = ThreadPool(query_parallelism - 1, 'query-worker')
+        else:
+            self.queryPool = None
+        self.sort_buffer_rows = sort_buffer_rows
+        self.snapshotReads = False #set by load()
+        #the snapshot read while a transaction is modifying the model
+        self._snapshot = None
+        self._writers = 0
+        self._snapshotLock = threading.Lock()
 
     def load(self):
         requestProcessor = self.requestProcessor
@@ -237,6 +326,9 @@ class BasicStore(DataStore):
             model.bnodePrefix = '_:'
             self.model.bnodePrefix = '_:'
 
+        self.snapshotReads = bool(self.snapshot_reads and 
+                                                self.model.snapshotReads)
+
     def setupHistory(self, source):
         requestProcessor = self.requestProcessor
 
@@ -303,6 +395,94 @@ class BasicStore(DataStore):
             return
         self.model.rollback()
 
+    def finishTransaction(self, txnService, committed):
+        state = txnService.state
+        snapshot = getattr(state, 'snapshots', {}).pop(self, None)
+        if snapshot is not None:
+            snapshot.close()
+        if self not in getattr(state, 'writingStores', ()):
+            return
+        if self.model.snapshotIsolation:
+            if committed:
+                self._invalidateResults(state)
+            return
+        self._snapshotLock.acquire()
+        try:
+            #invalidate before readers can take a snapshot with the changes
+            if committed:
+                self._invalidateResults(state)
+            self._writers -= 1
+            if not self._writers:
+                #readers can take a new snapshot now
+                self._snapshot = None
+        finally:
+            self._snapshotLock.release()
+
+    def _invalidateResults(self, state):
+        if self.resultCache is None:
+            return
+        changes = getattr(state, 'dbstates', {}).get(self)
+        if changes is not None:
+            self.resultCache.invalidate(changes.additions + changes.removals)
+        else:
+            #the changes weren't recorded 
+            self.resultCache.clear()
+
+    def _joinAsWriter(self, txnService):
+        state = txnService.state
+        if not hasattr(state, 'writingStores'):
+            state.writingStores = set()
+        elif self in state.writingStores:
+            return
+        state.writingStores.add(self)
+        if self.model.snapshotIsolation:
+            return #the model's snapshots don't see uncommitted changes
+        #the transaction is about to modify the model: take the snapshot 
+        #that readers will use until it completes
+        self._snapshotLock.acquire()
+        try:
+            if not self._writers:
+                self._snapshot = self.model.getSnapshot()
+            self._writers += 1
+        finally:
+            self._snapshotLock.release()
+
+    def getQueryModel(self, txnService):
+        '''
+        Returns the model queries in the current transaction should read.
+        If snapshot reads are enabled and the transaction hasn't modified 
+        anything this is a snapshot of the last committed version of the 
+        store (the same one for the rest of the transaction), otherwise it's
+        the store's model.
+        '''
+        state = txnService.state
+        if not self.snapshotReads or not state.readOnly:
+            return self.model
+        if not hasattr(state, 'snapshots'):
+            state.snapshots = {}
+            state.snapshotVersions = {}
+        snapshot = state.snapshots.get(self)
+        if snapshot is None:
+            resultCache = self.resultCache
+            if self.model.snapshotIsolation:
+                version = resultCache and resultCache.version
+                snapshot = self.model.getSnapshot()
+            else:
+                self._snapshotLock.acquire()
+                try:
+                    version = resultCache and resultCache.version
+                    if self._writers:
+                        #the model has uncommitted changes
+                        snapshot = self._snapshot
+                    else:
+                        snapshot = self.model.getSnapshot()
+                finally:
+                    self._snapshotLock.release()
+            state.snapshots[self] = snapshot
+            #the version of the result cache that matches the snapshot
+            state.snapshotVersions[self] = version
+        return snapshot
+
     def getTransactionContext(self):
         if self.graphManager:
             return self.graphManager.getTxnContext() #return a contextUri
@@ -313,6 +493,8 @@ class BasicStore(DataStore):
             return False
         
         super(BasicStore,self).join(txnService, readOnly)
+        if not readOnly and self.snapshotReads:
+            self._joinAsWriter(txnService)
         
         if not hasattr(txnService.state, 'queryCache'):
             #create a cache that will be used by the query engine
@@ -423,6 +605,98 @@ class BasicStore(DataStore):
         '''
         return self._add(adds, True)
 
+    def bulkload(self, source, format=None, batchSize=10000):
+        '''
+        Adds a large amount of data to the store, reading and adding it in 
+        batches of `batchSize` statements (or objects, for pjson).
+
+        `source`: A file path, a file-like object or an iterator of 
+        statements or pjson objects.
+        `format`: 'ntriples', 'pjson' or 'pjsonlines' (a pjson document on 
+        each line). If None, it is guessed from the file extension, 
+        defaulting to 'pjson'.
+        
+        If the store doesn't keep history, triggers or a transaction log 
+        and no transaction is active, the batches are committed directly to
+        the underlying store as they are read (so a failure leaves the 
+        batches already loaded in the store) and the store can defer 
+        maintaining its indexes until the end. Otherwise all the batches are 
+        added in one transaction.
+
+        Returns a dictionary with the number of statements read, the number
+        of seconds elapsed, and the statements per second.
+        '''
+        start = time.time()
+        close = False
+        if isinstance(source, (str, unicode)):
+            if format is None:
+                ext = os.path.splitext(source)[1]
+                format = { '.nt' : 'ntriples', 
+                           '.jsonl' : 'pjsonlines' }.get(ext, 'pjson')
+            source = open(source, 'rb')
+            close = True
+
+        try:
+            if format == 'ntriples':
+                makebNode = lambda bNode: base.BNODE_BASE + bNode
+                def getStatements():
+                    for stmt in base.parseTriples(source, makebNode):
+                        if stmt[0] is base.Removed:
+                            raise DataStoreError(
+                                    "bulkload doesn't support removing statements")
+                        yield base.Statement(stmt[0], stmt[1], stmt[2], 
+                                                        stmt[3], stmt[4] or '')
+                batches = _batches(getStatements(), batchSize)
+            else:
+                if hasattr(source, 'read'):
+                    source = _iterPjson(source, format)
+                parseOptions=self.model_options.get('parseOptions', 
+                                    self.storage_template_options).copy()
+                parseOptions['setBNodeOnObj'] = True
+                #use one parser so generated bnode ids don't collide
+                parser = pjson.Parser(**parseOptions)
+                def getBatches():
+                    header = []
+                    for batch in _batches(source, batchSize):
+                        if isinstance(batch[0], (tuple, base.BaseStatement)):
+                            yield batch
+                            continue
+                        yield parser.to_rdf(header + batch)[0]
+                        headers = [o for o in batch 
+                                    if isinstance(o, dict) and 'pjson' in o]
+                        if headers:
+                            header = headers[-1:]
+                batches = getBatches()
+            
+            txnSvc = self.requestProcessor.txnSvc
+            if (self.graphManager or self.addTrigger or self.newResourceTrigger
+                    or self.transaction_log or self.model is self.schema
+                    or txnSvc.isActive()):
+                def addBatches():
+                    count = 0
+                    for batch in batches:
+                        self._add(batch, False)
+                        count += len(batch)
+                    return count
+                count = self.requestProcessor.executeTransaction(addBatches)
+            else:
+                model = self.model
+                if isinstance(model, ModelWrapper):
+                    #skip the undo log
+                    model = model.model
+                count = model.bulkload(batches)
+                if self.resultCache is not None:
+                    self.resultCache.clear()
+        finally:
+            if close:
+                source.close()
+
+        elapsed = time.time() - start
+        rate = elapsed and count / elapsed or 0.0
+        self.log.info("bulkload added %d statements in %.2f seconds (%d/sec)" 
+                                                    % (count, elapsed, rate))
+        return dict(statements=count, seconds=elapsed, rate=rate)
+
     def _removePropLists(self, stmts):
         removed = []
         if not self.model.canHandleStatementWithOrder:
@@ -716,20 +990,86 @@ class BasicStore(DataStore):
         
         if not contextShapes:
             contextShapes = {dict:defaultattrdict}
-        if useSerializer and isinstance(useSerializer, (bool, int, float)):            
-            pjsonOptions=self.model_options.get('serializeOptions',{}).get('pjson')
-            if pjsonOptions is not None:
-                useSerializer = pjsonOptions
+        useSerializer = self._getSerializerOptions(useSerializer)
                 
-        cache = self.requestProcessor.txnSvc.state.queryCache
-        results = vesper.query.getResults(query, self.model, bindvars, explain,
-          debug, forUpdate, captureErrors, contextShapes, useSerializer, printast, cache)
+        txnSvc = self.requestProcessor.txnSvc
+        model = self.getQueryModel(txnSvc)
+        resultCache = self.resultCache
+        key = None
+        if (resultCache is not None and model is not self.model
+                and not explain and not debug and not printast):
+            key = resultCache.getKey(query, bindvars, forUpdate, 
+                                            contextShapes, useSerializer)
+        if key is not None:
+            version = txnSvc.state.snapshotVersions[self]
+            cached = resultCache.get(key, version)
+            if cached is not None:
+                self.log.debug('cached results for query %s', query)
+                if not captureErrors:
+                    return cached
+                return attrdict(results=cached, errors=[], elapsed=0.0)
+            model = vesper.query.ReadRecordingModel(model)
+
+        results = vesper.query.getResults(query, model, bindvars, explain,
+          debug, forUpdate, captureErrors, contextShapes, useSerializer, printast, 
+          txnSvc.state.queryCache, self.astCache, self.queryPool, 
+          self.sort_buffer_rows)
+        if key is not None and not results.errors:
+            resultCache.put(key, results.results, model.patterns, version, 
+                                                            results.elapsed)
         self.log.debug('%s elapsed for query %s', results.elapsed, query)
         if not captureErrors and not explain and not debug:
             return results.results
         else:
             return results
 
+    def iterQuery(self, query, bindvars=None, forUpdate=False,
+                                    contextShapes=None, useSerializer=True):
+        '''
+        Like `query` but returns an iterator that evaluates the query as the
+        result rows are consumed instead of a list of all the results.
+        Must be called and consumed inside a transaction
+        (e.g. using `requestProcessor.inTransaction()`).
+        Raises `QueryException` if the query fails to parse.
+        '''
+        import vesper.query
+        if not self.join(self.requestProcessor.txnSvc, readOnly=True):
+            raise RuntimeError('iterQuery() called outside of a transaction')
+
+        if not contextShapes:
+            contextShapes = {dict:defaultattrdict}
+        useSerializer = self._getSerializerOptions(useSerializer)
+        (ast, errors) = self.astCache.getAST(query)
+        if ast is None:
+            raise vesper.query.QueryException('could not parse query: '
+                                                        + '\n'.join(errors))
+        txnSvc = self.requestProcessor.txnSvc
+        return vesper.query.evalAST(ast, self.getQueryModel(txnSvc), bindvars,
+            forUpdate=forUpdate, contextShapes=contextShapes,
+            useSerializer=useSerializer, queryCache=txnSvc.state.queryCache,
+            executor=self.queryPool, sortBufferRows=self.sort_buffer_rows)
+
+    def _getSerializerOptions(self, useSerializer):
+        if useSerializer and isinstance(useSerializer, (bool, int, float)):            
+            pjsonOptions=self.model_options.get('serializeOptions',{}).get('pjson')
+            if pjsonOptions is not None:
+                return pjsonOptions
+        return useSerializer
+
+    def prepare(self, query, contextShapes=None, useSerializer=True):
+        '''
+        Parse the given query and return a `PreparedQuery` that can be 
+        executed repeatedly with different bindvars.
+        Raises `QueryException` if the query fails to parse.
+        '''
+        import vesper.query
+        if not contextShapes:
+            contextShapes = {dict:defaultattrdict}
+        #copy since the serializer options dict is updated with the namemap
+        useSerializer = copy.copy(self._getSerializerOptions(useSerializer))
+        compiled = vesper.query.CompiledQuery(query, useSerializer, self.astCache)
+        return PreparedQuery(self, compiled, contextShapes)
+
     def merge(self,changeset): 
         if not self.join(self.requestProcessor.txnSvc, setCurrentTxn=False):
             #not in a transaction, so call this inside one
@@ -747,6 +1087,46 @@ class BasicStore(DataStore):
             graphTxnManager.dirty = True
             raise
 
+class PreparedQuery(object):
+    '''
+    A query that is parsed once and executed with `execute`. 
+    Returned by `BasicStore.prepare()`.
+    '''
+
+    def __init__(self, datastore, compiled, contextShapes):
+        self.datastore = datastore
+        self.compiled = compiled
+        self.contextShapes = contextShapes
+
+    query = property(lambda self: self.compiled.query)
+    bindVarNames = property(lambda self: self.compiled.bindVarNames)
+
+    def execute(self, bindvars=None, limit=None, offset=None, explain=None, 
+                        debug=False, forUpdate=False, captureErrors=False):
+        '''
+        Execute the query with the given bindvars. `limit` and `offset` 
+        are applied to the query's result rows. 
+        Returns the same results as `BasicStore.query()`.
+        '''
+        store = self.datastore
+        if not store.join(store.requestProcessor.txnSvc, readOnly=True):
+            #not in a transaction, so call this inside one
+            func = lambda: self.execute(bindvars, limit, offset, explain, 
+                                        debug, forUpdate, captureErrors)
+            return store.requestProcessor.executeTransaction(func)
+
+        txnSvc = store.requestProcessor.txnSvc
+        results = self.compiled.getResults(store.getQueryModel(txnSvc), 
+            bindvars, limit, offset, explain, debug, forUpdate, captureErrors,
+            self.contextShapes, txnSvc.state.queryCache, store.queryPool,
+            store.sort_buffer_rows)
+        store.log.debug('%s elapsed for prepared query %s', results.elapsed,
+                                                            self.query)
+        if not captureErrors and not explain and not debug:
+            return results.results
+        else:
+            return results
+
 class TwoPhaseTxnModelAdapter(transactions.TransactionParticipant):
     '''
     Adapts models which doesn't support transactions or only support simple (one-phase) transactions.
@@ -766,7 +1146,15 @@ class TwoPhaseTxnModelAdapter(transactions.TransactionParticipant):
     def voteForCommit(self, txnService):
         #the only way we can tell if commit will succeed is to do it now 
         #if not self.model.autocommit:
-        self.model.commit(**txnService.getInfo())
+        if getattr(self.model, 'groupCommit', False):
+            #wait for the commit to be flushed after the transaction's lock is
+            #released so that other transactions' commits can be flushed with it
+            ticket = self.model.commit(flush=False, **txnService.getInfo())
+            if ticket is not None:
+                model = self.model
+                txnService.callAfterRelease(lambda: model.waitForCommit(ticket))
+        else:
+            self.model.commit(**txnService.getInfo())
         #else: already committed
         self.committed = True
                                         
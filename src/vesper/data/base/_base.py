@@ -11,7 +11,7 @@ from vesper.backports import *
 from vesper import utils
 from vesper.data.base.utils import *
 
-import os.path, sys, time
+import os.path, sys, time, itertools
 
 import logging 
 log = logging.getLogger("RxPath")
@@ -44,6 +44,8 @@ class Tupleset(object):
     Interface for representing a set of tuples
     '''
     columns = None
+    #: the position of the column the tuples are sorted by (None if unknown)
+    orderedBy = None
 
     def findColumnPos(self, label, rowinfo=False, shallow=False, pos=(), count=1):
         if not self.columns:
@@ -111,8 +113,46 @@ class Tupleset(object):
     def append(self, row, *moreRows):
         raise TypeError('Tupleset is read only')
     
+class PredicateStatistics(object):
+    '''
+    Statistics about the statements with a given predicate (or about all the 
+    statements in the model): the number of statements and the number of 
+    distinct subjects and distinct object values.
+    '''
+    __slots__ = ('count', 'subjects', 'objects')
+
+    def __init__(self, count=0, subjects=0, objects=0):
+        self.count = count
+        self.subjects = subjects
+        self.objects = objects
+
+    def __add__(self, other):
+        return PredicateStatistics(self.count + other.count, 
+            self.subjects + other.subjects, self.objects + other.objects)
+
+    def __eq__(self, other):
+        if not isinstance(other, PredicateStatistics):
+            return False
+        return (self.count, self.subjects, self.objects) == (
+                                other.count, other.subjects, other.objects)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'PredicateStatistics(%r, %r, %r)' % (self.count, 
+                                                self.subjects, self.objects)
+
 class Model(Tupleset):
     canHandleStatementWithOrder = False
+    #set if getStatements() understands the 'where' and 'semijoins' hints
+    canHandlePushdownHints = False
+    #set if getStatements() and iterStatements() understand the 'orderby' 
+    #hint (models that set canHandlePushdownHints must understand it too)
+    canHandleOrderbyHint = False
+    #set if getStatements() and iterStatements() can be called from several
+    #threads at once (used by the query engine to evaluate joins concurrently)
+    concurrentReads = False
     updateAdvisory = False    
     bnodePrefix = BNODE_BASE
     
@@ -125,6 +165,23 @@ class Model(Tupleset):
     def rollback(self):
         return
 
+    ### Snapshots ###
+    #set if getSnapshot() is supported
+    snapshotReads = False
+    #set if a snapshot only sees committed transactions (e.g. a database
+    #that provides its own isolation), otherwise a snapshot sees every change
+    #made to the model before it was taken
+    snapshotIsolation = False
+
+    def getSnapshot(self):
+        '''
+        Returns a read-only model with the current contents of this model
+        that isn't affected by subsequent changes to it, or None if the model
+        doesn't support snapshots. Call the snapshot's `close()` method when
+        done reading from it.
+        '''
+        return None
+
     ### Tupleset interface ###
     columns = tuple(ColumnInfo(l, i == 4 and object or unicode) for i, l in
           enumerate(('subject', 'predicate','object', 'objecttype','context', 'listpos')))
@@ -139,7 +196,7 @@ class Model(Tupleset):
                     value = value.uri
                 kw[labels[key] ] = value
         kw['hints'] = hints
-        for stmt in self.getStatements(**kw):
+        for stmt in self.iterStatements(**kw):
             objectType = stmt[3]
             if objectType == OBJECT_TYPE_RESOURCE:
                 value = ResourceUri(stmt[2])
@@ -170,9 +227,43 @@ class Model(Tupleset):
         If objectype is specified, it should be one of:
         OBJECT_TYPE_RESOURCE, OBJECT_TYPE_LITERAL, an ISO language code or an URL representing the datatype.
         If asQuad is True, will return duplicate statements if their context differs.
+
+        Models that set canHandlePushdownHints can be passed these hints, 
+        which let them skip statements the query engine would discard anyway
+        (the engine still evaluates these conditions itself, so it's fine to
+        return more statements than they match):
+        
+        'where': a list of (op, values, objectTypes) tuples, where op is one
+        of '<', '<=', '>', '>=' or 'in'. Statements whose objecttype is in 
+        objectTypes should only be returned if their object satisfies the
+        comparison (compared as a number if the values are numbers). 
+        Statements with other object types are not constrained by it.
+
+        'semijoins': a list of (columns, where) pairs. Only return statements 
+        whose subject is the subject of a statement whose columns 
+        (a dictionary using this method's argument names as keys) match and 
+        that satisfies the 'where' list.
+
+        'orderby': a list of column names (e.g. ['subject']) that the 
+        statements must be sorted by. Unlike the other hints this one can't be
+        ignored: the engine asks for it when it can stop reading statements
+        early (e.g. for a query with a limit) and relies on the order.
         '''
         assert object is not None or objecttype
         raise NotImplementedError 
+
+    def iterStatements(self, subject = None, predicate = None, object=None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        ''' 
+        Like `getStatements` but returns an iterator. Stores that can retrieve
+        statements lazily override this so that callers that stop early or 
+        only need to iterate once don't hold all the statements in memory.
+        Unless the model sets `orderedBy` the statements aren't necessarily 
+        sorted, and if asQuad is False which context is returned for a
+        statement that appears in several is unspecified.
+        '''
+        return iter(self.getStatements(subject, predicate, object, objecttype,
+                                                    context, asQuad, hints))
         
     def addStatement(self, statement):
         '''add the specified statement to the model'''
@@ -200,6 +291,28 @@ class Model(Tupleset):
               rowsRemoved += 1
         return rowsRemoved
 
+    def bulkload(self, batches):
+        '''
+        Add and commit each list of statements yielded by `batches`.
+        Stores can override this to defer work (e.g. building indexes) until
+        all the batches have been added. Returns the number of statements seen.
+        '''
+        count = 0
+        for batch in batches:
+            self.addStatements(batch)
+            self.commit()
+            count += len(batch)
+        return count
+
+    def getPredicateStatistics(self, predicate):
+        '''
+        Returns a `PredicateStatistics` for the statements with the given 
+        predicate or, if `predicate` is None, for all statements in the model.
+        Returns None if the model doesn't maintain statistics. 
+        Used by the query engine's cost model.
+        '''
+        return None
+
     reifiedIDs = None
     def findStatementIDs(self, stmt):        
         if self.reifiedIDs is None:
@@ -233,24 +346,59 @@ def getReifiedStatements(stmts):
     return reifiedDict
 
 def removeDupStatementsFromSortedList(aList, asQuad=True, pred=None, 
-                                                limit=None, offset=None):
-    def removeDups(x, y):
-        if pred and not pred(y):
-            return x
-        if not x:
-            x.append(y)
-        if asQuad and x[-1] != y:
-            x.append(y)
-        elif not asQuad and x[-1][:4] != y[:4]: 
-            #exclude scope from comparison
-            x.append(y)
-        return x
-    aList = reduce(removeDups, aList, [])
-    if 'offset' is not None:
-        aList = aList[offset:]
-    if 'limit' is not None:
-        aList = aList[:limit]
-    return aList
+                                    limit=None, offset=None, **otherHints):
+    stmts = []
+    lastKey = None
+    for stmt in aList:
+        if pred and not pred(stmt):
+            continue
+        if asQuad:
+            key = stmt
+        else:
+            key = stmt[:4] #exclude scope from comparison
+        if not stmts or key != lastKey:
+            stmts.append(stmt)
+            lastKey = key
+    if offset is not None:
+        stmts = stmts[offset:]
+    if limit is not None:
+        stmts = stmts[:limit]
+    return stmts
+
+def iterUniqueStatements(stmts, asQuad=True, limit=None, offset=None, 
+                                            presorted=False, **otherHints):
+    '''
+    Like `removeDupStatementsFromSortedList` but lazily filters an iterator 
+    of statements that doesn't need to be sorted. It assumes the iterator
+    doesn't yield duplicate quads. If `presorted` is True the statements
+    are sorted so duplicates can be skipped without remembering every 
+    statement.
+    '''
+    if not asQuad and presorted:
+        def removeDups(stmts):
+            lastKey = None
+            for stmt in stmts:
+                key = stmt[:4] #exclude scope from comparison
+                if key != lastKey:
+                    lastKey = key
+                    yield stmt
+        stmts = removeDups(stmts)
+    elif not asQuad:
+        def removeDups(stmts):
+            seen = set()
+            for stmt in stmts:
+                key = stmt[:4] #exclude scope from comparison
+                if key not in seen:
+                    seen.add(key)
+                    yield stmt
+        stmts = removeDups(stmts)
+    if offset or limit is not None:
+        offset = offset or 0
+        if limit is not None:
+            stmts = itertools.islice(stmts, offset, offset + limit)
+        else:
+            stmts = itertools.islice(stmts, offset, None)
+    return stmts
 
 class MultiModel(Model):
     '''
@@ -324,6 +472,19 @@ class MultiModel(Model):
         '''removes the statement'''
         return self.models[0].removeStatement( statement)
 
+    def getPredicateStatistics(self, predicate):
+        #the distinct counts are an upper bound since models may overlap
+        total = None
+        for model in self.models:
+            stats = model.getPredicateStatistics(predicate)
+            if stats is None:
+                return None
+            if total is None:
+                total = stats
+            else:
+                total = total + stats
+        return total
+
 class MirrorModel(Model):
     '''
     This mirrors updates to multiple models
@@ -354,6 +515,9 @@ class MirrorModel(Model):
                       objecttype=None,context=None, asQuad=True, hints=None):
         return self.models[0].getStatements(subject, predicate, object,
                                             objecttype,context, asQuad)
+
+    def getPredicateStatistics(self, predicate):
+        return self.models[0].getPredicateStatistics(predicate)
                      
     def addStatement(self, statement ):
         retval = False
@@ -395,6 +559,88 @@ class ViewModel(MirrorModel):
     def rollback(self):
         raise RuntimeError("invalid operation for ViewModel")
                 
+class PendingStatements(object):
+    '''
+    The statements added and removed by an uncommitted transaction. Only the 
+    net change is kept (adding a statement cancels an earlier removal of it 
+    and vice versa) and the added statements are indexed by subject, 
+    predicate, object and context so finding the ones that match a lookup 
+    doesn't require scanning all of them.
+    '''
+    INDEXED = (0, 1, 2, 4)
+
+    def __init__(self):
+        self.added = set()
+        self.removed = set()
+        #triples (which match statements in any context) => removed triple
+        self.removedTriples = {}
+        self.indexes = dict((pos, {}) for pos in self.INDEXED)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.removedTriples)
+
+    def _index(self, stmt):
+        self.added.add(stmt)
+        for pos in self.INDEXED:
+            self.indexes[pos].setdefault(stmt[pos], set()).add(stmt)
+
+    def _unindex(self, stmt):
+        self.added.discard(stmt)
+        for pos in self.INDEXED:
+            index = self.indexes[pos]
+            stmts = index[stmt[pos]]
+            stmts.discard(stmt)
+            if not stmts:
+                del index[stmt[pos]]
+
+    def add(self, stmt):
+        if not isinstance(stmt, Statement) or isinstance(stmt, Triple):
+            stmt = Statement(*stmt)
+        self.removed.discard(stmt)
+        if stmt not in self.added:
+            self._index(stmt)
+
+    def remove(self, stmt):
+        if isinstance(stmt, (Triple, MutableTriple)):
+            triple = tuple(stmt[:4])
+            for match in [s for s in self.indexes[0].get(stmt[0], ()) 
+                                                    if s[:4] == triple]:
+                self._unindex(match)
+            self.removedTriples[triple] = stmt
+        else:
+            if not isinstance(stmt, Statement):
+                stmt = Statement(*stmt)
+            if stmt in self.added:
+                self._unindex(stmt)
+            self.removed.add(stmt)
+
+    def isRemoved(self, stmt):
+        return stmt in self.removed or (self.removedTriples and 
+                                    tuple(stmt[:4]) in self.removedTriples)
+
+    def getRemoved(self):
+        return sorted(self.removed) + sorted(self.removedTriples.values())
+
+    def getAdded(self):
+        return sorted(self.added)
+
+    def findAdded(self, subject=None, predicate=None, object=None, context=None):
+        '''
+        Returns the added statements in the smallest index that matches one
+        of the given values (the caller still needs to check each statement).
+        '''
+        candidates = self.added
+        for pos, value in ((0, subject), (1, predicate), (2, object), 
+                                                            (4, context)):
+            if value is None or (pos < 2 and not value):
+                continue
+            if isinstance(value, ResourceUri):
+                value = value.uri
+            stmts = self.indexes[pos].get(value, ())
+            if len(stmts) < len(candidates):
+                candidates = stmts
+        return candidates
+
 class TransactionModel(object):
     '''
     Provides transaction functionality for models that don't already have that.
@@ -407,8 +653,9 @@ class TransactionModel(object):
         
     TransactionalMyModel(TransactionModel, MyModel): pass
     '''
-    queue = None 
+    queue = None #a PendingStatements
     updateAdvisory = False
+    _flushing = False #True while commit() applies the queue
     
     def __init__(self, *args, **kw):
         #don't create a transaction for the initial statements
@@ -423,22 +670,25 @@ class TransactionModel(object):
         if not self.queue:
             self.txnState = TxnState.BEGIN
             return
-        for stmt in self.queue:
-            if stmt[0] is Removed:
-                super(TransactionModel, self).removeStatement( stmt[1] )
-            else:
-                assert len(stmt) == 1
-                super(TransactionModel, self).addStatement( stmt[0] )
+        #removals go first, the queue has already cancelled out any removal 
+        #that was followed by adding the same statement
+        queue = self.queue
+        self._flushing = True
+        try:
+            super(TransactionModel, self).removeStatements(queue.getRemoved())
+            super(TransactionModel, self).addStatements(queue.getAdded())
+        finally:
+            self._flushing = False
         super(TransactionModel, self).commit(**kw)
 
-        self.queue = []
+        self.queue = None
         
     def rollback(self):        
         if self.autocommit:
             super(TransactionModel, self).rollback()
         else:
             self.txnState = TxnState.BEGIN
-        self.queue = []
+        self.queue = None
 
     def _match(self, stmt, subject = None, predicate = None, object = None,
                                                objectType=None,context=None):
@@ -468,57 +718,57 @@ class TransactionModel(object):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
-        statements = super(TransactionModel, self).getStatements(subject,
+        queue = self.queue
+        if not queue:
+            return super(TransactionModel, self).getStatements(subject,
                                 predicate, object,objecttype,context, asQuad,hints)
-        if not self.queue: 
-            return statements
 
         #avoid phantom reads, etc.
-        changed = False
-        for stmt in self.queue:
-            if stmt[0] is Removed:
-                stmt = stmt[1] 
-                if self._match(stmt, subject, predicate, object,
-                                               objecttype,context):
-                    try:                        
-                        while 1:
-                            i = statements.index(stmt)
-                            del statements[i]
-                            changed = True
-                    except ValueError:
-                        pass
-            else:
-                if self._match(stmt[0], subject, predicate, object,
-                                               objecttype,context):
-                    changed = True
-                    statements.append( stmt[0] )
-
-        if changed:        
-            statements.sort()
-            return removeDupStatementsFromSortedList(statements, asQuad, **(hints or {}))
-        else:
-            return statements
+        #limit and offset (and removing duplicates) can only be applied after
+        #the pending changes are merged in
+        hints = hints or {}
+        baseHints = dict((k, v) for k, v in hints.items() 
+                                            if k not in ('limit', 'offset'))
+        statements = super(TransactionModel, self).getStatements(subject,
+                            predicate, object, objecttype, context, True, 
+                            baseHints)
+        if queue.removed or queue.removedTriples:
+            statements = [s for s in statements if not queue.isRemoved(s)]
+        statements.extend(s for s in queue.findAdded(subject, predicate, 
+                                                            object, context)
+            if self._match(s, subject, predicate, object, objecttype, context))
+        statements.sort()
+        return removeDupStatementsFromSortedList(statements, asQuad, **hints)
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        if not self.queue:
+            return super(TransactionModel, self).iterStatements(subject,
+                            predicate, object, objecttype, context, asQuad, hints)
+        #merge in the pending changes
+        return iter(self.getStatements(subject, predicate, object, objecttype,
+                                                        context, asQuad, hints))
 
     def addStatement(self, statement ):
         '''add the specified statement to the model'''
-        if self.autocommit:
+        if self.autocommit or self._flushing:
             return super(TransactionModel, self).addStatement(statement)
         else:
             self.txnState = TxnState.DIRTY
         
         if self.queue is None: 
-            self.queue = []
-        self.queue.append( (statement,) )
+            self.queue = PendingStatements()
+        self.queue.add(statement)
         
     def removeStatement(self, statement ):
         '''removes the statement'''        
-        if self.autocommit:
+        if self.autocommit or self._flushing:
             return super(TransactionModel, self).removeStatement(statement)
         else:
             self.txnState = TxnState.DIRTY
         
         if self.queue is None: 
-            self.queue = []
-        self.queue.append( (Removed, statement) )
+            self.queue = PendingStatements()
+        self.queue.remove(statement)
 
 
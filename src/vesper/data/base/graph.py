@@ -162,6 +162,14 @@ class NamedGraphManager(base.Model):
         else:
             self.currentVersion = self._increment('')
         
+    canHandlePushdownHints = property(lambda self: 
+                                self.managedModel.canHandlePushdownHints)
+
+    def getPredicateStatistics(self, predicate):
+        #when the revision statements are stored in the primary model 
+        #these will be included in the statistics 
+        return self.managedModel.getPredicateStatistics(predicate)
+
     def getStatements(self, subject=None, predicate=None, object=None,
         objecttype=None, context=None, asQuad=True, hints=None):
         '''
@@ -199,7 +207,7 @@ class NamedGraphManager(base.Model):
                     context = None
 
             return model.getStatements(subject, predicate, object,
-                objecttype, context, asQuad, **hints)
+                objecttype, context, asQuad, hints)
 
     def getCurrentContextUri(self):
         return getTxnContextUri(self.modelUri, self.currentVersion)
@@ -3,7 +3,7 @@
 '''
     Various utility functions and classes for vesper
 '''
-import re, random, urllib2
+import re, random, urllib2, os, sys, struct, array, mmap, itertools
 try:
     import cStringIO
     StringIO = cStringIO
@@ -62,7 +62,15 @@ class BaseStatement(object):
     LIST_POS = 5
 
 class Statement(tuple, BaseStatement):
-    #__slots__ = ('listpos', )
+    '''
+    A statement is an immutable 5-tuple. Since it doesn't have an instance
+    dictionary it is no larger than the equivalent tuple. 
+
+    Creating one normalizes any `ResourceUri` arguments; stores creating
+    statements from plain values can skip that by calling 
+    ``tuple.__new__(Statement, (subject, predicate, object, objectType, scope))``.
+    '''
+    __slots__ = ()
 
     def __new__(cls, subject, predicate, object,
              objectType=OBJECT_TYPE_LITERAL, scope=''):
@@ -86,6 +94,7 @@ class Statement(tuple, BaseStatement):
     listpos =  None
 
 class _BaseTriple(object):
+    __slots__ = ()
 
     def __hash__( self):
         #for now don't include scope
@@ -113,7 +122,7 @@ class _BaseTriple(object):
             return False
 
 class Triple(_BaseTriple, Statement):
-    pass
+    __slots__ = ()
 
 class MutableStatement(list, BaseStatement):
     __slots__ = ()
@@ -144,9 +153,11 @@ class MutableStatement(list, BaseStatement):
     def pop(self): raise TypeError("pop() not allowed")    
 
 class MutableTriple(_BaseTriple, MutableStatement):
-    pass
+    __slots__ = ()
 
 class StatementWithOrder(Statement):
+    #note: no __slots__ here, listpos is stored in the instance dictionary
+    #(tuple subclasses can't have non-empty __slots__)
     
     def __new__(cls, subject, predicate, object,
              objectType=OBJECT_TYPE_LITERAL, scope='', listpos=()):        
@@ -189,6 +200,66 @@ class ResourceUri(object):
     def __repr__(self):
         return 'ResourceUri('+repr(self.uri)+')'
 
+class TermTable(object):
+    '''
+    Maps each distinct term (uri or literal) to a single shared instance so
+    that the statements and index keys that repeat a term all reference
+    the same string instead of each holding their own copy. Besides the
+    memory saved, comparing interned terms is cheap because equal terms are
+    the same object (and strings cache their hash).
+
+    The table counts the statements using each term so that it can be shared
+    by several stores: a term is dropped once every statement interned with
+    `internStatement()` that uses it has been passed to `releaseStatement()`.
+    '''
+
+    def __init__(self):
+        self.terms = {}
+        self.refs = {} #term => number of interned statements using it
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def intern(self, term):
+        return self.terms.setdefault(term, term)
+
+    def discard(self, term):
+        self.terms.pop(term, None)
+
+    def internStatement(self, stmt):
+        '''
+        Returns a statement equal to the given one but whose terms are the
+        instances in this table.
+        '''
+        terms = self.terms
+        interned = tuple.__new__(type(stmt),
+                            [terms.setdefault(term, term) for term in stmt])
+        if stmt.listpos is not None:
+            interned.listpos = stmt.listpos
+        refs = self.refs
+        for term in interned:
+            refs[term] = refs.get(term, 0) + 1
+        return interned
+
+    def releaseStatement(self, stmt):
+        '''
+        Called when a statement returned by `internStatement()` is no longer 
+        used: drops the terms no other interned statement uses.
+        '''
+        refs = self.refs
+        for term in stmt:
+            count = refs.get(term)
+            if count is None:
+                continue
+            if count > 1:
+                refs[term] = count - 1
+            else:
+                del refs[term]
+                self.terms.pop(term, None)
+
 class ParseException(utils.NestedException):
     def __init__(self, msg = '', useNested = False):
         utils.NestedException.__init__(self, msg,useNested)
@@ -403,6 +474,10 @@ def _parseRDFFromString(contents, baseuri, type='unknown', scope=None,
                 type='pjson' #assume pjson
                 break
             
+            if contents.startswith(SNAPSHOT_MAGIC):
+                type = 'vsnap'
+                break
+
             startcontents = contents[:256].lstrip()
             if not startcontents: #empty
                 return [], 'statements'
@@ -437,7 +512,9 @@ def _parseRDFFromString(contents, baseuri, type='unknown', scope=None,
                 except:
                     raise ParseException("unrecognized or invalid file contents")
                             
-        if type in ['ntriples', 'ntjson']:
+        if type == 'vsnap':
+            return readSnapshot(contents, scope), type
+        elif type in ['ntriples', 'ntjson']:
             #use our parser
             return NTriples2Statements(StringIO.StringIO(contents), scope,
                                        baseuri, **options), type
@@ -505,7 +582,9 @@ def parseRDFFromURI(uri, type='unknown', modelbaseuri=None, scope=None,
     stream = urllib2.urlopen(uri)
     contents = stream.read()
     stream.close()
-    return parseRDFFromString(contents.decode('utf8'), modelbaseuri, type, scope, options, getType)
+    if not contents.startswith(SNAPSHOT_MAGIC): #binary format
+        contents = contents.decode('utf8')
+    return parseRDFFromString(contents, modelbaseuri, type, scope, options, getType)
 
 def _serializeRDFXMLWithRdflib(stream, statements, uri2prefixMap, format='xml'):
     #note: using format "xml" instead of "pretty-xml" because that latter is buggier
@@ -560,7 +639,7 @@ def serializeRDF(statements, type, uri2prefixMap=None, options=None):
 def serializeRDF_Stream(statements,stream,type,uri2prefixMap=None,options=None):
     '''    
     type can be one of the following:
-        "rdfxml", "ntriples", "ntjson", "yaml", "mjson", or "pjson"
+        "rdfxml", "ntriples", "ntjson", "yaml", "mjson", "pjson" or "vsnap"
     '''
     from vesper.data import base
     if type.startswith('http://rx4rdf.sf.net/ns/wiki#rdfformat-'):
@@ -581,6 +660,8 @@ def serializeRDF_Stream(statements,stream,type,uri2prefixMap=None,options=None):
         writeTriples(statements, stream)
     elif type == 'ntjson':
         writeTriples(statements, stream, writejson=True)
+    elif type == 'vsnap':
+        writeSnapshot(statements, stream)
     elif type == 'pjson' or type == 'mjson':
         isMjson = type == 'mjson'
         from vesper import pjson, multipartjson        
@@ -612,7 +693,7 @@ def serializeRDF_Stream(statements,stream,type,uri2prefixMap=None,options=None):
                                      **pjsonOptions), stream, **defaultoptions)
 
 def canWriteFormat(format):
-    if format in ('ntriples', 'ntjson', 'json', 'pjson', 'mjson'):
+    if format in ('ntriples', 'ntjson', 'json', 'pjson', 'mjson', 'vsnap'):
         return True
     elif format == 'yaml':
         try:
@@ -849,6 +930,108 @@ def writeTriples(stmts, stream, enc='utf8', writejson=False):
                 stream.write(' "' + escaped + '"^^' + stmt[objectType].encode(enc))
                 stream.write(" .\n")
 
+#the binary snapshot format: a header with the number of distinct terms and 
+#the number of statements, followed by the offsets of each term in the
+#concatenation of the utf8 encoded terms, then the terms, then each statement 
+#as 5 indexes into the term table. All integers are little-endian 32-bit.
+SNAPSHOT_MAGIC = 'VSNAP\x00\x01\x00'
+_snapshotHeader = struct.Struct('<8sII')
+_uint32 = [t for t in 'IL' if array.array(t).itemsize == 4][0]
+
+def writeSnapshot(stmts, stream):
+    '''
+    Write the statements to the stream (opened in binary mode) in the 
+    binary snapshot format (see `readSnapshot`).
+    '''
+    termIds = {}
+    terms = []
+    quads = array.array(_uint32)
+    for stmt in stmts:
+        for term in stmt[:5]:
+            termId = termIds.get(term)
+            if termId is None:
+                termId = termIds[term] = len(terms)
+                if isinstance(term, unicode):
+                    term = term.encode('utf8')
+                terms.append(term)
+            quads.append(termId)
+
+    offsets = array.array(_uint32, [0])
+    for term in terms:
+        offsets.append(offsets[-1] + len(term))
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+        quads.byteswap()
+    stream.write(_snapshotHeader.pack(SNAPSHOT_MAGIC, len(terms), 
+                                                        len(quads) // 5))
+    stream.write(offsets.tostring())
+    stream.write(''.join(terms))
+    stream.write(quads.tostring())
+
+def readSnapshot(data, scope=''):
+    '''
+    Returns the list of statements in the given snapshot, which can be a 
+    string or a buffer (e.g. a mmap). Statements without a context are given 
+    `scope`.
+    
+    Unlike the text formats there is no per-statement parsing: each distinct 
+    term is decoded once and shared by all the statements that use it.
+    '''
+    if len(data) < _snapshotHeader.size:
+        raise ParseException('invalid snapshot: missing header')
+    magic, termCount, stmtCount = _snapshotHeader.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ParseException('invalid snapshot: unrecognized header')
+    pos = _snapshotHeader.size
+    offsets = array.array(_uint32)
+    offsets.fromstring(data[pos:pos + (termCount+1) * offsets.itemsize])
+    pos += len(offsets) * offsets.itemsize
+    quads = array.array(_uint32)
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    if len(offsets) != termCount+1 or (len(data) != pos + offsets[-1] + 
+                                    stmtCount * 5 * quads.itemsize):
+        raise ParseException('invalid snapshot: unexpected length')
+
+    termdata = data[pos:pos + offsets[-1]]
+    text = termdata.decode('utf8')
+    if len(text) == len(termdata): 
+        #all ascii so the byte offsets are also the character offsets
+        termdata, decode = text, unicode
+    else:
+        decode = lambda term: term.decode('utf8')
+    terms = [decode(termdata[offsets[i]:offsets[i+1]]) 
+                                                for i in xrange(termCount)]
+    pos += offsets[-1]
+    quads.fromstring(data[pos:])
+    if sys.byteorder == 'big':
+        quads.byteswap()
+    args = [iter(map(terms.__getitem__, quads))] * 5
+    #bypass Statement.__new__'s checks, the terms are already strings
+    new = tuple.__new__
+    if scope:
+        return [new(Statement, (s, p, o, t, c or scope)) 
+                            for (s, p, o, t, c) in itertools.izip(*args)]
+    else:
+        return [new(Statement, quad) for quad in itertools.izip(*args)]
+
+def loadSnapshot(path, scope=''):
+    '''
+    Returns the list of statements in the snapshot file at the given path 
+    (which is memory-mapped rather than read).
+    '''
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            return [] #can't mmap an empty file
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return readSnapshot(data, scope)
+        finally:
+            data.close()
+    finally:
+        f.close()
+
 def peekpair(seq):
     '''
     yield next, peek
@@ -8,7 +8,7 @@ import os, os.path
 import sqlalchemy
 from sqlalchemy import engine, sql, create_engine
 from sqlalchemy.sql import select
-from sqlalchemy.sql.expression import func, or_, and_
+from sqlalchemy.sql.expression import func, or_, and_, not_, cast
 from sqlalchemy.types import *
 from sqlalchemy.schema import Table, Column, MetaData, UniqueConstraint, Index
 
@@ -69,6 +69,48 @@ class AlchemySqlStore(Model):
                 self.trans = self.conn.begin()
         self.conn.execution_options(autocommit=self.autocommit)
 
+    canHandlePushdownHints = True
+
+    def _compileConditions(self, table, conditions):
+        '''
+        Returns a list of SQL expressions for the given 'where' hint.
+        '''
+        clauses = []
+        for op, values, objectTypes in conditions:
+            if isinstance(values[0], (int, long, float)):
+                #XXX 'inf' and 'nan' will be cast as 0
+                column = cast(table.c.object, Numeric)
+            else:
+                column = table.c.object
+            if op == 'in':
+                test = column.in_(values)
+            elif op == '<':
+                test = column < values[0]
+            elif op == '<=':
+                test = column <= values[0]
+            elif op == '>':
+                test = column > values[0]
+            elif op == '>=':
+                test = column >= values[0]
+            else:
+                raise ValueError('unsupported operator: %s' % op)
+            clauses.append( or_(not_(table.c.objecttype.in_(objectTypes)), test) )
+        return clauses
+
+    def _compileHints(self, hints):
+        '''
+        Returns a list of SQL expressions for the 'where' and 'semijoins' hints.
+        '''
+        clauses = self._compileConditions(self.vesper_stmts, hints.get('where', ()))
+        for columns, conditions in hints.get('semijoins', ()):
+            inner = self.vesper_stmts.alias()
+            subclauses = [inner.c[name] == value 
+                                    for name, value in columns.items()]
+            subclauses.extend( self._compileConditions(inner, conditions) )
+            subquery = select([inner.c.subject]).where(and_(*subclauses))
+            clauses.append( self.vesper_stmts.c.subject.in_(subquery) )
+        return clauses
+
     def getStatements(self, subject=None, predicate=None, object=None,
                       objecttype=None, context=None, asQuad=True, hints=None):
         ''' 
@@ -76,6 +118,17 @@ class AlchemySqlStore(Model):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
+        stmts = list(self.iterStatements(subject, predicate, object, 
+                                        objecttype, context, asQuad, hints))
+        log.debug("stmts returned: ", len(stmts), stmts)
+        return stmts
+
+    def iterStatements(self, subject=None, predicate=None, object=None,
+                      objecttype=None, context=None, asQuad=True, hints=None):
+        '''
+        Like `getStatements` but the statements are fetched from the result
+        as the iterator is consumed.
+        '''
         fs = subject is not None
         fp = predicate is not None
         fo = object is not None
@@ -113,24 +166,31 @@ class AlchemySqlStore(Model):
             query = query.where(self.vesper_stmts.c.objecttype == objecttype)
         if fc:
             query = query.where(self.vesper_stmts.c.context == context)
+        for clause in self._compileHints(hints):
+            query = query.where(clause)
         if not asQuad and not fc:
             query = query.group_by(self.vesper_stmts.c.subject,
                                    self.vesper_stmts.c.predicate,
                                    self.vesper_stmts.c.object,
                                    self.vesper_stmts.c.objecttype)
+        for name in hints.get('orderby', ()):
+            query = query.order_by(getattr(self.vesper_stmts.c, name))
         if limit is not None:
             query = query.limit(limit)
         if offset is not None:
             query = query.offset(offset)
 
-        stmts = []
         self._checkConnection()
         result = self.conn.execute(query)
-        for r in result:
-            stmts.append( Statement(r['subject'], r['predicate'], r['object'], r['objecttype'], r['context']) )
-           
-        log.debug("stmts returned: ", len(stmts), stmts)
-        return stmts
+        return self._iterRows(result)
+
+    def _iterRows(self, result):
+        try:
+            #rows are (subject, predicate, object, objecttype, context)
+            for r in result:
+                yield tuple.__new__(Statement, r)
+        finally:
+            result.close()
 
     def addStatement(self, stmt):
         '''add the specified statement to the model'''
@@ -1,40 +1,87 @@
 #:copyright: Copyright 2009-2010 by the Vesper team, see AUTHORS.
 #:license: Dual licenced under the GPL or Apache2 licences, see LICENSE.
 from vesper.data.base import * # XXX
+from vesper.backports import json
+import itertools, weakref, threading
 
 class MemStore(Model):
     '''
     simple in-memory module
+
+    Statements are indexed by subject, predicate, object, context and subject,
+    (subject, predicate) and (predicate, object) in dictionaries of sets.
+
+    If `internTerms` is True (or a `TermTable` to share between stores) the 
+    terms of each statement added are interned in a term table so each 
+    distinct uri or literal is only held in memory once.
+
+    `getSnapshot()` returns a read-only `MemStoreSnapshot`. Until the 
+    snapshot is first read, changes to the store are just recorded in it so 
+    taking a snapshot that is never read is cheap. Once it is read it shares
+    the indexes with the store (undoing the recorded changes on its own copy)
+    and the store's indexes are copied on write (the top-level dictionaries 
+    when first changed and each set when it is first changed) for as long 
+    as the snapshot is still referenced.
     '''
     updateAdvisory = True
+    snapshotReads = True
+    concurrentReads = True
+    #statements are always sorted so the 'orderby' hint is honored
+    canHandleOrderbyHint = True
+    internTerms = False
+    termTable = None
     
-    def __init__(self,defaultStatements=None, **kw):
+    def __init__(self,defaultStatements=None, internTerms=False, **kw):
+        self.internTerms = internTerms
+        if isinstance(internTerms, TermTable):
+            self.termTable = internTerms
+        elif internTerms:
+            self.termTable = TermTable()
+        else:
+            self.termTable = None
         self.by_s = {}
         self.by_p = {}
         self.by_o = {}
         self.by_c = {}
+        self.by_sp = {}
+        self.by_po = {}
+        self.predicateStats = {} #predicate => PredicateStatistics
+        self._snapshot = None #snapshot of the current contents
+        self._snapshotRefs = [] #weak references to the snapshots being read
+        #weak references to the snapshots that haven't been read yet
+        self._pendingRefs = []
+        #ids of the containers created since the last snapshot was taken 
+        #(None if no snapshot is sharing the indexes)
+        self._owned = None
+        self._ownIndexes = True
+        self._lock = threading.Lock() #guards snapshots against writers
         if defaultStatements:
             for stmt in defaultStatements:
                 MemStore.addStatement(self, stmt)
 
     def size(self):
         return len(self.by_s)
+
+    def getPredicateStatistics(self, predicate):
+        if predicate is None:
+            count = sum(stats.count for stats in self.predicateStats.itervalues())
+            return PredicateStatistics(count, len(self.by_s), len(self.by_o))
+        stats = self.predicateStats.get(predicate)
+        if stats is None:
+            return PredicateStatistics()
+        return PredicateStatistics(stats.count, stats.subjects, stats.objects)
             
-    def getStatements(self, subject = None, predicate = None, object = None,
-                      objecttype=None,context=None, asQuad=True, hints=None):
-        ''' 
-        Return all the statements in the model that match the given arguments.
-        Any combination of subject and predicate can be None, and any None slot is
-        treated as a wildcard that matches any value in the model.
-        '''        
+    def _findStatements(self, subject, predicate, object, objecttype, context):
+        '''
+        Yields the matching statements in sorted order by walking the most 
+        selective index (sorting a subject at a time when the whole store or
+        context is walked).
+        '''
         fs = subject is not None
         fp = predicate is not None
         fo = object is not None
         fot = objecttype is not None
         fc = context is not None
-        hints = hints or {}
-        limit=hints.get('limit')
-        offset=hints.get('offset')
         checkLiteral = False
         if fo:
             if isinstance(object, ResourceUri):
@@ -45,95 +92,364 @@ class MemStore(Model):
                 checkLiteral = True
 
         if not fc:
-            if fs:                
-                stmts = self.by_s.get(subject,[])            
+            if fs and fp:
+                stmts = self.by_sp.get((subject, predicate), ())
+            elif fp and fo:
+                stmts = self.by_po.get((predicate, object), ())
+            elif fs:                
+                stmts = self.by_s.get(subject, ())
             elif fo:
-                stmts = self.by_o.get(object, [])
+                stmts = self.by_o.get(object, ())
             elif fp:
-                stmts = self.by_p.get(predicate, [])
+                stmts = self.by_p.get(predicate, ())
             else:
                 #get all
-                stmts = utils.flattenSeq(self.by_s.itervalues(), 1)
-                if fot:
-                    stmts = [s for s in stmts if s.objectType == objecttype]
-                else:
-                    stmts = list(stmts)
-                stmts.sort()
-                return removeDupStatementsFromSortedList(stmts,asQuad,
-                                                    limit=limit,offset=offset)
+                stmts = self._walkSubjects(self.by_s)
         else:            
             by_cAnds = self.by_c.get(context)
             if not by_cAnds:
-                return []
+                return
             if fs:                
-                stmts = by_cAnds.get(subject,[])
+                stmts = by_cAnds.get(subject, ())
             else:
-                stmts = utils.flattenSeq(by_cAnds.itervalues(), 1)
-                
-        stmts = [s for s in stmts 
-                    if (not fs or s.subject == subject)
+                stmts = self._walkSubjects(by_cAnds)
+        if isinstance(stmts, set):
+            stmts = sorted(stmts)
+
+        for s in stmts:
+            if ((not fs or s.subject == subject)
                     and (not fp or s.predicate == predicate)
                     and (not fo or s.object == object)
                     and (not fot or s.objectType == objecttype)
                     and (not checkLiteral or s.objectType != OBJECT_TYPE_RESOURCE)
-                    and (not fc or s.scope == context)]
-        stmts.sort()
-        stmts = removeDupStatementsFromSortedList(stmts, asQuad, 
-                                            limit=limit, offset=offset)
-        return stmts
+                    and (not fc or s.scope == context)):
+                yield s
+
+    def _walkSubjects(self, index):
+        '''
+        Yields the statements in an index keyed by subject in sorted order 
+        (statements are sorted by subject first).
+        '''
+        return itertools.chain.from_iterable(sorted(index.get(subject, ())) 
+                                                for subject in sorted(index))
+
+    def getStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        ''' 
+        Return all the statements in the model that match the given arguments.
+        Any combination of subject and predicate can be None, and any None slot is
+        treated as a wildcard that matches any value in the model.
+        '''        
+        hints = hints or {}
+        stmts = list(self._findStatements(subject, predicate, object, 
+                                                    objecttype, context))
+        return removeDupStatementsFromSortedList(stmts, asQuad, 
+                        limit=hints.get('limit'), offset=hints.get('offset'))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        '''
+        Like `getStatements` but duplicates are removed and the limit and
+        offset applied as the statements are consumed. The statements are 
+        in the same (sorted) order as `getStatements` (which query results 
+        can depend on) but when the whole store or context is read the 
+        index is only sorted a subject at a time as it is walked.
+        '''
+        hints = hints or {}
+        stmts = self._findStatements(subject, predicate, object, 
+                                                    objecttype, context)
+        return iterUniqueStatements(stmts, asQuad, presorted=True,
+                        limit=hints.get('limit'), offset=hints.get('offset'))
                      
     def addStatement(self, stmt ):
         '''add the specified statement to the model'''            
-        if not isinstance(stmt, BaseStatement):
+        self._lock.acquire()
+        try:
+            return self._addStatement(stmt)
+        finally:
+            self._lock.release()
+
+    def _addStatement(self, stmt):
+        if not isinstance(stmt, Statement) or isinstance(stmt, Triple):
+            #needs to be hashable and hashed like a tuple
             stmt = Statement(*stmt)
         assert isinstance(stmt.object, (str, unicode)), 'bad object %r, objectType %s' % (stmt.object, stmt.objectType)
-        if stmt in self.by_c.get(stmt[4], {}).get(stmt[0], []):
+        if stmt in self.by_s.get(stmt[0], ()):
             return False#statement already in
-        self.by_s.setdefault(stmt[0], []).append(stmt)
-        self.by_p.setdefault(stmt[1], []).append(stmt)
-        self.by_o.setdefault(stmt[2], []).append(stmt)
-        self.by_c.setdefault(stmt[4], {}).setdefault(stmt[0], []).append(stmt)
+        self._copyOnWrite(stmt, True)
+        if self.termTable is not None:
+            stmt = self.termTable.internStatement(stmt)
+        stats = self.predicateStats.get(stmt[1])
+        if stats is None:
+            stats = self.predicateStats[stmt[1]] = PredicateStatistics()
+        stats.count += 1
+        sp = (stmt[0], stmt[1])
+        if sp not in self.by_sp:
+            stats.subjects += 1
+        po = (stmt[1], stmt[2])
+        if po not in self.by_po:
+            stats.objects += 1
+        self.by_s.setdefault(stmt[0], set()).add(stmt)
+        self.by_p.setdefault(stmt[1], set()).add(stmt)
+        self.by_o.setdefault(stmt[2], set()).add(stmt)
+        self.by_sp.setdefault(sp, set()).add(stmt)
+        self.by_po.setdefault(po, set()).add(stmt)
+        self.by_c.setdefault(stmt[4], {}).setdefault(stmt[0], set()).add(stmt)
         return True
+
+    def _removeFromIndex(self, index, key, stmt):
+        '''
+        Remove the statement from the index and return True if it was the 
+        last statement with that key.
+        '''
+        stmts = index[key]
+        stmts.discard(stmt)
+        if not stmts:
+            del index[key]
+            return True
+        return False
         
     def removeStatement(self, stmt ):
         '''removes the statement'''
-        stmts = self.by_s.get(stmt[0])
-        if not stmts:
-            return False
-        try:
-            stmts.remove(stmt)
-        except ValueError:
-            return False  
-        self.by_p[stmt[1]].remove(stmt)
-        self.by_o[stmt[2]].remove(stmt)
+        self._lock.acquire()
         try:
-            self.by_c[stmt[4]][stmt[0]].remove(stmt)
-        except (ValueError,KeyError):
-            #this can happen since scope isn't part of the stmt's key
-            for subjectDict in self.by_c.values():
-                stmts = subjectDict.get(stmt[0],[])
-                try:
-                    stmts.remove(stmt)
-                except ValueError:
-                    pass
-                else:
-                    return True
+            return self._removeStatement(stmt)
+        finally:
+            self._lock.release()
+
+    def _removeStatement(self, stmt):
+        if isinstance(stmt, (Triple, MutableTriple)):
+            #triples match a statement in any context
+            matches = [s for s in self.by_s.get(stmt[0], ()) if s[:4] == stmt[:4]]
+            if not matches:
+                return False
+            stmt = matches[0]
+        else:
+            if not isinstance(stmt, tuple):
+                stmt = Statement(*stmt)
+            if stmt not in self.by_s.get(stmt[0], ()):
+                return False
+        self._copyOnWrite(stmt, False)
+        self._removeFromIndex(self.by_s, stmt[0], stmt)
+        self._removeFromIndex(self.by_p, stmt[1], stmt)
+        self._removeFromIndex(self.by_o, stmt[2], stmt)
+        stats = self.predicateStats[stmt[1]]
+        stats.count -= 1
+        if self._removeFromIndex(self.by_sp, (stmt[0], stmt[1]), stmt):
+            stats.subjects -= 1
+        if self._removeFromIndex(self.by_po, (stmt[1], stmt[2]), stmt):
+            stats.objects -= 1
+        if not stats.count:
+            del self.predicateStats[stmt[1]]
+        subjectDict = self.by_c[stmt[4]]
+        self._removeFromIndex(subjectDict, stmt[0], stmt)
+        if not subjectDict:
+            del self.by_c[stmt[4]]
+        if self.termTable is not None:
+            self.termTable.releaseStatement(stmt)
         return True
 
+    def getSnapshot(self):
+        '''
+        Returns a `MemStoreSnapshot` of the current contents of the store.
+        The same snapshot is returned until the store is changed.
+        '''
+        self._lock.acquire()
+        try:
+            snapshot = self._snapshot
+            if snapshot is None:
+                snapshot = self._snapshot = MemStoreSnapshot(self)
+                self._pendingRefs.append(weakref.ref(snapshot))
+            return snapshot
+        finally:
+            self._lock.release()
+
+    def _shareIndexes(self, snapshot, copiedIndexes):
+        '''
+        Called when a pending snapshot is first read: from now on the index
+        containers are shared with it (and the top-level dictionaries too
+        unless `copiedIndexes`).
+        '''
+        self._pendingRefs = [ref for ref in self._pendingRefs 
+                                if ref() is not None and ref() is not snapshot]
+        self._snapshotRefs = [ref for ref in self._snapshotRefs 
+                                                    if ref() is not None]
+        self._snapshotRefs.append(weakref.ref(snapshot))
+        self._owned = set()
+        if not copiedIndexes:
+            self._ownIndexes = False
+
+    def _copyIndexes(self):
+        for name in ('by_s', 'by_p', 'by_o', 'by_c', 'by_sp', 'by_po', 
+                                                    'predicateStats'):
+            setattr(self, name, getattr(self, name).copy())
+        self._ownIndexes = True
+
+    def _copyOnWrite(self, stmt, added):
+        '''
+        Called before the statement is added or removed: records the change
+        in the snapshots that haven't been read yet and copies the index 
+        containers that the change will modify if they might be shared with 
+        a snapshot.
+        '''
+        self._snapshot = None
+        if self._pendingRefs:
+            pendingRefs = []
+            for ref in self._pendingRefs:
+                snapshot = ref()
+                if snapshot is not None:
+                    snapshot._changes.append((added, stmt))
+                    pendingRefs.append(ref)
+            self._pendingRefs = pendingRefs
+
+        owned = self._owned
+        if owned is None:
+            return
+        self._snapshotRefs = [ref for ref in self._snapshotRefs 
+                                                    if ref() is not None]
+        if not self._snapshotRefs:
+            #all the snapshots are gone so nothing is shared anymore
+            self._owned = None
+            return
+
+        if not self._ownIndexes:
+            self._copyIndexes()
+
+        for index, key in ((self.by_s, stmt[0]), (self.by_p, stmt[1]), 
+                (self.by_o, stmt[2]), (self.by_sp, (stmt[0], stmt[1])),
+                (self.by_po, (stmt[1], stmt[2])), (self.by_c, stmt[4])):
+            container = index.get(key)
+            if container is not None and id(container) not in owned:
+                container = index[key] = container.copy()
+                owned.add(id(container))
+        #by_c is a dictionary of sets
+        subjectDict = self.by_c.get(stmt[4])
+        if subjectDict is not None:
+            container = subjectDict.get(stmt[0])
+            if container is not None and id(container) not in owned:
+                container = subjectDict[stmt[0]] = container.copy()
+                owned.add(id(container))
+        stats = self.predicateStats.get(stmt[1])
+        if stats is not None and id(stats) not in owned:
+            stats = self.predicateStats[stmt[1]] = PredicateStatistics(
+                                stats.count, stats.subjects, stats.objects)
+            owned.add(id(stats))
+
+class MemStoreSnapshot(MemStore):
+    '''
+    A read-only view of a `MemStore` as it was when 
+    `MemStore.getSnapshot()` was called.
+    '''
+    snapshotReads = False
+    _pendingRefs = ()
+    _snapshotRefs = ()
+
+    def __init__(self, store):
+        self.store = store
+        #changes made to the store before the snapshot was first read
+        #(None once it has been read)
+        self._changes = []
+        self.internTerms = store.internTerms
+        #terms are interned by the store so the snapshot doesn't need to
+        self.termTable = None
+        self.bnodePrefix = store.bnodePrefix
+        self._shareStore()
+
+    def _shareStore(self):
+        store = self.store
+        self.by_s = store.by_s
+        self.by_p = store.by_p
+        self.by_o = store.by_o
+        self.by_c = store.by_c
+        self.by_sp = store.by_sp
+        self.by_po = store.by_po
+        self.predicateStats = store.predicateStats
+
+    def _read(self):
+        '''
+        Called before the snapshot is read: shares the store's indexes and
+        undoes the changes made to the store since the snapshot was taken.
+        '''
+        store = self.store
+        store._lock.acquire()
+        try:
+            changes = self._changes
+            if changes is None:
+                return #another thread got here first
+            self._shareStore()
+            store._shareIndexes(self, bool(changes))
+            if changes:
+                #the snapshot's own copies of the index containers
+                self._copyIndexes()
+                #the rest are shared with the store
+                self._owned = set()
+                self._snapshotRefs = [weakref.ref(store)]
+                for added, stmt in reversed(changes):
+                    if added:
+                        MemStore._removeStatement(self, stmt)
+                    else:
+                        MemStore._addStatement(self, stmt)
+                self._owned = None
+                self._snapshotRefs = ()
+            self._changes = None
+        finally:
+            store._lock.release()
+
+    def size(self):
+        if self._changes is not None:
+            self._read()
+        return MemStore.size(self)
+
+    def getPredicateStatistics(self, predicate):
+        if self._changes is not None:
+            self._read()
+        return MemStore.getPredicateStatistics(self, predicate)
+
+    def _findStatements(self, *args):
+        if self._changes is not None:
+            self._read()
+        return MemStore._findStatements(self, *args)
+
+    def addStatement(self, stmt):
+        raise RuntimeError('can not modify a snapshot')
+
+    def removeStatement(self, stmt):
+        raise RuntimeError('can not modify a snapshot')
+
+    def getSnapshot(self):
+        return self
+
+    def close(self):
+        pass
+
 class TransactionMemStore(TransactionModel, MemStore): pass
     
 class FileStore(MemStore):
     '''
     Reads the file into memory and write out 
+
+    If `journal` is True, instead of rewriting the whole file on every 
+    commit the changes made by each transaction are appended to a journal 
+    file (the path with ".journal" appended) as a line of JSON. The journal
+    is replayed when the file is loaded and once it grows larger than 
+    `compactRatio` times the size of the file, the file is rewritten 
+    (see `compact()`) and the journal removed.
     '''    
     autocommit = False
+    journal = False
+    compactRatio = 1.0
+    concurrentReads = False #reads may reload the file
     
+
     def __init__(self, source, defaultStatements=(), context='',
            incrementHook=None, serializeOptions=None, parseOptions=None, 
-           checkForExternalChanges=True, **kw):
+           checkForExternalChanges=True, journal=False, compactRatio=1.0,
+           **kw):
         self.initialContext = context
         self.defaultStatements = defaultStatements
         self.checkForExternalChanges = checkForExternalChanges
+        self.journal = journal
+        self.compactRatio = compactRatio
         serializeOptions = serializeOptions or {}
         if 'pjson' not in serializeOptions:
             pjsonOptions = {}
@@ -178,11 +494,61 @@ class FileStore(MemStore):
             self.fileSize = 0
         
         self.txnState = TxnState.BEGIN
-        MemStore.__init__(self, stmts)    
+        MemStore.__init__(self, stmts, **kw)
+        self._loadJournal()
 
     def canWriteFormat(self, format):
         return canWriteFormat(format)
 
+    journalPath = property(lambda self: self.path + '.journal')
+
+    def _loadJournal(self):
+        '''
+        Apply the changes saved in the journal (if there is one).
+        '''
+        self.journalChanges = []
+        self.journalSize = 0
+        if not self.path or not os.path.exists(self.journalPath):
+            return
+        journalfile = open(self.journalPath, 'rb+')
+        try:
+            for line in journalfile:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError('missing end of line')
+                    changes = json.loads(line)
+                except ValueError:
+                    #a partially written transaction, discard it so the next
+                    #transaction isn't appended to it
+                    log.warning('discarding incomplete transaction in %s' 
+                                                        % self.journalPath)
+                    journalfile.truncate(self.journalSize)
+                    break
+                for op, s, p, o, t, c in changes:
+                    if op == '-':
+                        MemStore.removeStatement(self, Statement(s, p, o, t, c))
+                    else:
+                        MemStore.addStatement(self, Statement(s, p, o, t, c))
+                self.journalSize += len(line)
+        finally:
+            journalfile.close()
+
+    def _appendJournal(self):
+        '''
+        Append the changes made in the current transaction to the journal.
+        '''
+        if not self.journalChanges:
+            return
+        line = json.dumps(self.journalChanges) + '\n'
+        journalfile = open(self.journalPath, 'ab')
+        try:
+            journalfile.write(line)
+            journalfile.flush()
+            os.fsync(journalfile.fileno())
+        finally:
+            journalfile.close()
+        self.journalSize = os.path.getsize(self.journalPath)
+
     def _checkTxnState(self):
         if self.txnState == TxnState.BEGIN:
             if self.checkForExternalChanges and self.wasModifiedSinceLastWrite():
@@ -195,6 +561,18 @@ class FileStore(MemStore):
         return super(FileStore, self).getStatements(subject, predicate, object, 
                                         objecttype,context, asQuad, hints)
 
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        self._checkTxnState()
+        return super(FileStore, self).iterStatements(subject, predicate, object, 
+                                        objecttype,context, asQuad, hints)
+
+    def getSnapshot(self):
+        if (self.txnState == TxnState.BEGIN and self.checkForExternalChanges
+                and self.wasModifiedSinceLastWrite()):
+            self.reload()
+        return super(FileStore, self).getSnapshot()
+
     def _maybeCommit(self, retVal):
         if self.autocommit:
             assert super(FileStore, self).updateAdvisory
@@ -206,12 +584,22 @@ class FileStore(MemStore):
         self._checkTxnState()
         self.txnState = TxnState.DIRTY
         retVal = super(FileStore, self).addStatement(stmt)
+        if retVal and self.journal:
+            self.journalChanges.append(['+'] + list(stmt[:5]))
         return self._maybeCommit(retVal)
 
     def removeStatement(self, stmt):
         self._checkTxnState()
         self.txnState = TxnState.DIRTY
+        if self.journal and isinstance(stmt, (Triple, MutableTriple)):
+            #journal the statement that actually gets removed
+            matches = [s for s in self.by_s.get(stmt[0], ()) 
+                                                if s[:4] == stmt[:4]]
+            if matches:
+                stmt = matches[0]
         retVal = super(FileStore, self).removeStatement(stmt)
+        if retVal and self.journal:
+            self.journalChanges.append(['-'] + list(stmt[:5]))
         return self._maybeCommit(retVal)
 
     def addStatements(self, stmts):
@@ -231,21 +619,41 @@ class FileStore(MemStore):
             stat = os.stat(self.path)
         except (OSError, IOError):
             return False
-        return self.mtime < stat.st_mtime or self.fileSize != stat.st_size
+        if self.mtime < stat.st_mtime or self.fileSize != stat.st_size:
+            return True
+        try:
+            journalSize = os.path.getsize(self.journalPath)
+        except (OSError, IOError):
+            journalSize = 0
+        return self.journalSize != journalSize
 
     def commit(self, **kw):
         if self.txnState != TxnState.DIRTY or not self.path: 
             self.txnState = TxnState.BEGIN
+            self.journalChanges = []
             return
 
         if self.checkForExternalChanges and self.wasModifiedSinceLastWrite():
             raise RuntimeError('error saving to "%s", file was '
                         'modified by another process' % self.path)
+        if self.journal and os.path.exists(self.path):
+            self._appendJournal()
+            self.journalChanges = []
+            self.txnState = TxnState.BEGIN
+            if self.journalSize > self.compactRatio * self.fileSize:
+                self.compact()
+        else:
+            self.compact()
+
+    def compact(self):
+        '''
+        Write all the statements to the file and remove the journal.
+        '''
         from vesper.data.transactions import TxnFileFactory
         try:
             #use TxnFileFactory so serializations errors don't corrupt file
             tff = TxnFileFactory(self.path)
-            outputfile = tff.create('t')
+            outputfile = tff.create(self.format == 'vsnap' and 'b' or 't')
             stmts = self.getStatements()
             serializeRDF_Stream(stmts, outputfile, self.format, 
                                             options=self.serializeOptions)
@@ -257,6 +665,11 @@ class FileStore(MemStore):
         else:                        
             tff.commitTransaction(None)
             tff.finishTransaction(None, True)
+            #the file now includes the changes in the journal
+            if os.path.exists(self.journalPath):
+                os.remove(self.journalPath)
+            self.journalSize = 0
+            self.journalChanges = []
             self.txnState = TxnState.BEGIN
             stat = os.stat(self.path)
             self.mtime = stat.st_mtime
@@ -276,7 +689,13 @@ class FileStore(MemStore):
                 stmts = self.defaultStatements
         else:
             stmts = self.defaultStatements
-        MemStore.__init__(self, stmts)
+        if isinstance(self.internTerms, TermTable):
+            #the term table is shared so release the statements being replaced
+            for subjectStmts in self.by_s.itervalues():
+                for stmt in subjectStmts:
+                    self.termTable.releaseStatement(stmt)
+        MemStore.__init__(self, stmts, internTerms=self.internTerms)
+        self._loadJournal()
         
 class TransactionFileStore(TransactionModel, FileStore): pass
         
@@ -362,6 +781,7 @@ def guessFileType(path):
     '.json' : 'pjson',
     '.mjson' : 'mjson',
     '.yaml' : 'yaml',
+    '.vsnap' : 'vsnap',
   }
   #try to guess from extension
   base, ext = os.path.splitext(path)
@@ -384,7 +804,10 @@ def loadFileStore(path, context='', incrementHook=None, parseOptions=None):
         if incrementHook:
             options['incrementHook']=incrementHook
         
-        stmts, format = parseRDFFromURI(uri, type=format, scope=context,
+        if format == 'vsnap':
+            stmts = loadSnapshot(path, context)
+        else:
+            stmts, format = parseRDFFromURI(uri, type=format, scope=context,
                                 options=options, getType=True)
     else:
         mtime = 0
@@ -22,7 +22,7 @@ http://download.oracle.com/docs/cd/E17076_02/html/gsg_txn/C/logfileremoval.html
 __all__ = ['BdbStore']
 
 import os, os.path
-import logging
+import logging, threading
 
 try:
     import bsddb, bsddb.db
@@ -48,6 +48,15 @@ except AttributeError:
     else:
         bsddb.db.DB_GET_BOTH_RANGE = 10
 
+try:
+    bsddb.db.DB_CURSOR_BULK
+except AttributeError:
+    #not defined by bsddb, added in Berkeley DB 4.8
+    if bsddb.db.version() < (4,8):
+        bsddb.db.DB_CURSOR_BULK = 0
+    else:
+        bsddb.db.DB_CURSOR_BULK = 1
+
 log = logging.getLogger("bdb")
 
 def _to_safe_str(s):
@@ -87,6 +96,54 @@ def _btopen(env, file, txn=None, mode=0666,
     d.open(file, dbtype=bsddb.db.DB_BTREE, flags=flags, mode=mode, txn=txn)
     return bsddb._DBWithCursor(d)
 
+class _GroupCommit(object):
+    '''
+    Transactions are committed without flushing the log and `wait()` blocks
+    until the log has been flushed past the commit. Only one thread flushes
+    the log at a time, each flush covering every commit written before it 
+    started, so commits that arrive while a flush is in progress share the
+    next one.
+    '''
+
+    def __init__(self, env):
+        self.env = env
+        self._cond = threading.Condition(threading.Lock())
+        self._flushing = False
+        self.written = 0 #number of commits written to the log
+        self.flushed = 0 #number of those known to be flushed to disk
+        self.flushes = 0
+
+    def commit(self, txn):
+        "Commit the transaction and return the ticket to pass to `wait()`"
+        txn.commit(bsddb.db.DB_TXN_NOSYNC)
+        self._cond.acquire()
+        try:
+            self.written += 1
+            return self.written
+        finally:
+            self._cond.release()
+
+    def wait(self, ticket):
+        self._cond.acquire()
+        try:
+            while self.flushed < ticket:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                self._flushing = True
+                upto = self.written
+                self._cond.release()
+                try:
+                    self.env.log_flush()
+                finally:
+                    self._cond.acquire()
+                    self._flushing = False
+                    self._cond.notifyAll()
+                self.flushed = max(self.flushed, upto)
+                self.flushes += 1
+        finally:
+            self._cond.release()
+
 class BdbStore(Model):
     '''
     datastore using Berkeley DB using Python's bsddb module
@@ -97,6 +154,33 @@ class BdbStore(Model):
     
     s => p o t c 
 
+    and a b-tree database with statistics used by the query engine:
+
+    p => count subjects objects
+
+    The `indexes` keyword argument (e.g. set in `model_options`) chooses which
+    of the optional b-trees in `INDEXES` are also maintained, so statements
+    can be found by object or by context without scanning every statement:
+
+    o t => s p c  ('osp')
+
+    c => s p o t  ('context')
+
+    An index is built when an existing database is opened with it and 
+    removed when the database is opened without it.
+
+    `durability` chooses what a commit waits for: 'sync' (the default) 
+    flushes the log to disk, 'write-nosync' writes it to the operating 
+    system's buffers (a commit can be lost if the machine crashes), 'nosync' 
+    leaves it in Berkeley DB's log buffer (a commit can also be lost if the
+    process crashes) and 'in-memory' never writes the log (the database isn't
+    recoverable if the process crashes). 
+
+    If `groupCommit` is set (and `durability` is 'sync') commits made 
+    concurrently by different threads share a log flush (see `commit()`).
+    How much that changes commit throughput hasn't been measured yet 
+    (BdbModelTest's testCommitThroughput compares it with 'sync').
+
     where
         
     s subject
@@ -111,8 +195,25 @@ class BdbStore(Model):
     
     debug=0
     updateAdvisory = True
+    orderedBy = 0 #getStatements() returns statements sorted by subject
+
+    INDEXES = {
+        'osp' : 'obj_db',
+        'context' : 'ctx_db',
+    }
+    DURABILITY = ('sync', 'write-nosync', 'nosync', 'in-memory')
+    inMemoryLogSize = 10 * 1024 * 1024 #bytes, used if durability is 'in-memory'
+    groupCommit = False
+    _txn = None #set here too in case __init__ raises
      
-    def __init__(self, source, defaultStatements=None, autocommit = False, **kw):
+    def __init__(self, source, defaultStatements=None, autocommit = False, 
+                indexes=None, durability='sync', groupCommit=False, **kw):
+        indexes = indexes or ()
+        for name in indexes:
+            if name not in self.INDEXES:
+                raise RuntimeError('unknown BdbStore index: %s' % name)
+        if durability not in self.DURABILITY:
+            raise RuntimeError('unknown BdbStore durability: %s' % durability)
         if source is not None:
             source = os.path.abspath(source) # bdb likes absolute paths for everything
             log.debug("opening db at:" + source)
@@ -123,12 +224,15 @@ class BdbStore(Model):
             
             pPath = os.path.join(source, 'pred_db')
             sPath = os.path.join(source, 'subj_db')
+            statsPath = os.path.join(source, 'stats_db')
             newdb = not os.path.exists(pPath)
+            newStats = not os.path.exists(statsPath)
         else:
-            newdb = True
-            pPath = sPath = None
+            newdb = newStats = True
+            pPath = sPath = statsPath = None
 
         self.autocommit = autocommit
+        self._liveIterators = [] #see `_liveStatements`
 
         log.debug("pPath:" + pPath)
         log.debug("sPath:" + sPath)
@@ -137,10 +241,23 @@ class BdbStore(Model):
         db = bsddb.db
         self.env = db.DBEnv()
         self.env.set_lk_detect(db.DB_LOCK_DEFAULT)
+        self.durability = durability
+        if durability == 'write-nosync':
+            self.env.set_flags(db.DB_TXN_WRITE_NOSYNC, True)
+        elif durability == 'nosync':
+            self.env.set_flags(db.DB_TXN_NOSYNC, True)
+        elif durability == 'in-memory':
+            self.env.log_set_config(db.DB_LOG_IN_MEMORY, True)
+            self.env.set_lg_bsize(self.inMemoryLogSize)
         #for flags see http://docs.oracle.com/cd/E17076_02/html/gsg_txn/C/enabletxn.html
-        self.env.open(source, db.DB_CREATE | db.DB_INIT_LOG | db.DB_INIT_MPOOL | db.DB_INIT_TXN | db.DB_INIT_LOCK)
-        #for performance set: DB_TXN_WRITE_NOSYNC or DB_TXN_NOSYNC 
-        #or even env.log_set_config(db.DB_LOG_IN_MEMORY, True) 
+        envflags = db.DB_CREATE | db.DB_INIT_LOG | db.DB_INIT_MPOOL | db.DB_INIT_TXN | db.DB_INIT_LOCK
+        self.groupCommit = groupCommit and durability == 'sync'
+        if self.groupCommit:
+            #the log is flushed by whichever thread is waiting for it
+            envflags |= db.DB_THREAD
+        self.env.open(source, envflags)
+        if self.groupCommit:
+            self._groupCommit = _GroupCommit(self.env)
 
         self._txn = None
         self._checkAutoCommit()
@@ -150,6 +267,13 @@ class BdbStore(Model):
         self.pDb.db.set_get_returns_none(2)
         self.sDb = _btopen(self.env, sPath, self._txn, btflags=bsddb.db.DB_DUPSORT)         
         self.sDb.db.set_get_returns_none(2)
+        self.statsDb = _btopen(self.env, statsPath, self._txn)
+        self.statsDb.db.set_get_returns_none(2)
+        if newStats and not newdb:
+            #database created before statistics were added
+            self._rebuildStatistics()
+        self.oDb = self._openIndex(source, 'osp', indexes, newdb)
+        self.cDb = self._openIndex(source, 'context', indexes, newdb)
         if newdb and defaultStatements:            
             self.addStatements(defaultStatements) 
         self.commit()
@@ -161,13 +285,61 @@ class BdbStore(Model):
 
     def close(self):
         log.debug("closing db")
+        self._closeCursors()
         if self._txn:
             log.debug("aborting txn in close")
             self._txn.abort()
         self._txn = None        
         self.pDb.close()
         self.sDb.close()
+        self.statsDb.close()
+        if self.oDb is not None:
+            self.oDb.close()
+        if self.cDb is not None:
+            self.cDb.close()
         self.env.close()
+
+    def _openIndex(self, source, name, indexes, newdb):
+        '''
+        Open (building it if necessary) the given optional index if its in 
+        `indexes`, otherwise remove it and return None.
+        '''
+        path = source and os.path.join(source, self.INDEXES[name])
+        exists = path is not None and os.path.exists(path)
+        if name not in indexes:
+            if exists:
+                log.info("removing index " + path)
+                self.env.dbremove(path, txn=self._txn, 
+                    flags=not self._txn and bsddb.db.DB_AUTO_COMMIT or 0)
+            return None
+
+        idxDb = _btopen(self.env, path, self._txn, btflags=bsddb.db.DB_DUPSORT)
+        idxDb.db.set_get_returns_none(2)
+        if not exists and not newdb:
+            #index the statements already in the database
+            log.info("building index " + name)
+            scursor = self.sDb.db.cursor(self._txn)
+            rec = scursor.first()
+            while rec:
+                s, value = rec
+                p, o, t, c = value.split('\0')
+                key, value = self._indexEntry(name, (s, p, o, t, c))
+                idxDb.db.put(key, value, txn=self._txn, 
+                                            flags=bsddb.db.DB_NODUPDATA)
+                rec = scursor.next()
+            scursor.close()
+        return idxDb
+
+    def _indexEntry(self, name, stmt):
+        "Returns the key and value for the statement in the given index"
+        if name == 'osp':
+            #o t => s p c
+            return (_encodeValues(stmt[2], stmt[3]), 
+                    _encodeValues(stmt[0], stmt[1], stmt[4]))
+        else:
+            #c => s p o t
+            return (_to_safe_str(stmt[4]), 
+                    _encodeValues(stmt[0], stmt[1], stmt[2], stmt[3]))
         
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
@@ -176,10 +348,72 @@ class BdbStore(Model):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
+        return list(self.iterStatements(subject, predicate, object, 
+                                    objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        '''
+        Like `getStatements` but the statements are read as the iterator is
+        consumed (and reading stops once `limit` statements are returned).
+        Walking the indexes yields the statements in sorted order, except for
+        the predicate index (see `_isSorted`), so only those are sorted first.
+        If the store is modified, committed or rolled back before the iterator
+        is exhausted its cursor is closed and reading it raises RuntimeError.
+        '''
+        hints = hints or {}
+        stmts = self._findStatements(subject, predicate, object, objecttype, 
+                                                                    context)
+        if self._isSorted(subject, predicate, object, objecttype):
+            stmts = self._liveStatements(stmts)
+        else:
+            stmts = iter(sorted(stmts))
+        return iterUniqueStatements(stmts, asQuad, presorted=True,
+                        limit=hints.get('limit'), offset=hints.get('offset'))
+
+    def _liveStatements(self, stmts):
+        '''
+        Yields the statements from the given `_findStatements` generator, 
+        which `_closeCursors()` closes (closing its cursor) if it's called 
+        first.
+        '''
+        self._liveIterators.append(stmts)
+        try:
+            for stmt in stmts:
+                yield stmt
+                if stmts not in self._liveIterators:
+                    raise RuntimeError('BdbStore was modified while '
+                                        'iterating over its statements')
+        finally:
+            if stmts in self._liveIterators:
+                self._liveIterators.remove(stmts)
+                stmts.close()
+
+    def _closeCursors(self):
+        "Close the cursors of any `iterStatements` iterators still being read"
+        while self._liveIterators:
+            self._liveIterators.pop().close()
+
+    def _isSorted(self, subject, predicate, object, objecttype):
+        '''
+        Returns True if `_findStatements` yields the statements in sorted 
+        order. 
+        '''
+        if subject is not None:
+            return True
+        elif predicate is not None:
+            return False
+        elif object is not None and self.oDb is not None:
+            #only one key of the object index is read if the type is known
+            return objecttype is not None or isinstance(object, ResourceUri)
+        return True
+
+    def _findStatements(self, subject, predicate, object, objecttype, context):
         #if subject is specified, use subject index, 
         #  with/get_both if predicate is specified 
         #if predicate, use property index
-        #if only object or scope is specified, get all and search manually
+        #if only object or scope is specified, use the object or context 
+        #  index if its maintained, otherwise get all and search manually
         #else: get all: use subject index, regenerate json_seq stmts
         #do a manual scan if subject list bnode
         fs = subject is not None
@@ -187,15 +421,14 @@ class BdbStore(Model):
         fo = object is not None
         fot = objecttype is not None
         fc = context is not None
-        hints = hints or {}
-        limit=hints.get('limit')
-        offset=hints.get('offset')
         
         #to prevent locking when reading we only use a txn if its already been created
         #and use DB_TXN_SNAPSHOT (db needs to be DB_MULTIVERSION)
-        cursorflags = bsddb.db.DB_TXN_SNAPSHOT
+        #DB_CURSOR_BULK keeps the cursor on the current page when it can
+        #instead of searching the b-tree for every record
+        #XXX bsddb can't read DB_MULTIPLE_KEY buffers so we read one record at a time
+        cursorflags = bsddb.db.DB_TXN_SNAPSHOT | bsddb.db.DB_CURSOR_BULK
         txn = self._txn
-        #XXX we want to use bsddb.db.DB_CURSOR_BULK but not in bsdbd.db defines
         
         if fo:
             if isinstance(object, ResourceUri):
@@ -205,91 +438,193 @@ class BdbStore(Model):
             elif not fot:
                 objecttype = OBJECT_TYPE_LITERAL
 
-        stmts = []
-        if fs: 
-            subject = _to_safe_str(subject)
-            #if subject is specified, use subject index            
-            scursor = self.sDb.db.cursor(txn, flags=cursorflags)
-            if fp:
-                val = _to_safe_str(predicate)
-                if fo:
-                    val += '\0'+ _to_safe_str(object)
-                    if fot: 
-                        val += '\0'+ _to_safe_str(objecttype)
-                        if fc:
-                            val += '\0'+_to_safe_str(context)
-                #duplicates are sorted so we can position the cursor at the
-                #first value we're interested
-                rec = scursor.get(subject, val, bsddb.db.DB_GET_BOTH_RANGE)
-            else:
-                rec = scursor.set(subject)
-            while rec:
-                #s => p o t c 
-                s, value = rec
-                assert s == subject
-                p, o, t, c = value.split('\0')                
+        cursor = None
+        try:
+            if fs: 
+                subject = _to_safe_str(subject)
+                #if subject is specified, use subject index            
+                scursor = cursor = self.sDb.db.cursor(txn, flags=cursorflags)
                 if fp:
-                    #since dups are sorted we can break
-                    if p != predicate:
-                        break
+                    val = _to_safe_str(predicate)
                     if fo:
-                        if o != object:
+                        val += '\0'+ _to_safe_str(object)
+                        if fot: 
+                            val += '\0'+ _to_safe_str(objecttype)
+                            if fc:
+                                val += '\0'+_to_safe_str(context)
+                    #duplicates are sorted so we can position the cursor at the
+                    #first value we're interested
+                    rec = scursor.get(subject, val, bsddb.db.DB_GET_BOTH_RANGE)
+                else:
+                    rec = scursor.set(subject)
+                while rec:
+                    #s => p o t c 
+                    s, value = rec
+                    assert s == subject
+                    p, o, t, c = value.split('\0')                
+                    if fp:
+                        #since dups are sorted we can break
+                        if p != predicate:
                             break
-                        if fot:
-                            if t != objecttype:
+                        if fo:
+                            if o != object:
                                 break
-                            if fc:
-                                if c != context:
-                                    break      
+                            if fot:
+                                if t != objecttype:
+                                    break
+                                if fc:
+                                    if c != context:
+                                        break      
                 
-                if ((not fo or o == object)
-                    and (not fot or t == objecttype)
-                    and (not fc or c == context)):            
-                    stmts.append( Statement(s, p, o, t, c) )            
-                rec = scursor.next_dup()
+                    if ((not fo or o == object)
+                        and (not fot or t == objecttype)
+                        and (not fc or c == context)):            
+                        yield tuple.__new__(Statement, (s, p, o, t, c))            
+                    rec = scursor.next_dup()
                 
-        elif fp:
-            pcursor = self.pDb.db.cursor(txn, flags=cursorflags)            
-            key = _to_safe_str(predicate)
-            val = None
-            if fo:
-                key += '\0'+_to_safe_str(object)
-                if fot: 
-                    key += '\0'+_to_safe_str(objecttype)
-                    if fc:
-                        val = _to_safe_str(context)
-                        rec = pcursor.get(key, val, bsddb.db.DB_GET_BOTH_RANGE)
-            if val is None:
-                rec = pcursor.set_range(key)                
+            elif fp:
+                pcursor = cursor = self.pDb.db.cursor(txn, flags=cursorflags)            
+                key = _to_safe_str(predicate)
+                val = None
+                if fo:
+                    key += '\0'+_to_safe_str(object)
+                    if fot: 
+                        key += '\0'+_to_safe_str(objecttype)
+                        if fc:
+                            val = _to_safe_str(context)
+                            rec = pcursor.get(key, val, bsddb.db.DB_GET_BOTH_RANGE)
+                if val is None:
+                    rec = pcursor.set_range(key)                
                         
-            while rec:                
-                key, value = rec
-                p, o, t = key.split('\0')                
-                if p != predicate or (fo and o != object) or (fot and t != objecttype):
-                    break  #we're finished with the range of the key we're interested in               
-                c, s = value.split('\0')                            
-                if not fc or c == context:                     
-                    stmts.append( Statement(s, p, o, t, c) )                
-                rec = pcursor.next()
+                while rec:                
+                    key, value = rec
+                    p, o, t = key.split('\0')                
+                    if p != predicate or (fo and o != object) or (fot and t != objecttype):
+                        break  #we're finished with the range of the key we're interested in               
+                    c, s = value.split('\0')                            
+                    if not fc or c == context:                     
+                        yield tuple.__new__(Statement, (s, p, o, t, c))                
+                    rec = pcursor.next()
+
+            elif fo and self.oDb is not None:
+                ocursor = cursor = self.oDb.db.cursor(txn, flags=cursorflags)
+                prefix = _to_safe_str(object) + '\0'
+                if fot:
+                    rec = ocursor.set(prefix + _to_safe_str(objecttype))
+                else:
+                    rec = ocursor.set_range(prefix)
+                while rec:
+                    #o t => s p c
+                    key, value = rec
+                    if not key.startswith(prefix):
+                        break
+                    o, t = key.split('\0')
+                    if fot and t != objecttype:
+                        break
+                    s, p, c = value.split('\0')
+                    if not fc or c == context:
+                        yield tuple.__new__(Statement, (s, p, o, t, c))
+                    rec = ocursor.next()
+
+            elif fc and self.cDb is not None:
+                ccursor = cursor = self.cDb.db.cursor(txn, flags=cursorflags)
+                rec = ccursor.set(_to_safe_str(context))
+                while rec:
+                    #c => s p o t
+                    c, value = rec
+                    s, p, o, t = value.split('\0')
+                    if ((not fo or o == object)
+                        and (not fot or t == objecttype)):
+                        yield tuple.__new__(Statement, (s, p, o, t, c))
+                    rec = ccursor.next_dup()
                             
-        else:            
-            #get all            
-            scursor = self.sDb.db.cursor(txn, flags=cursorflags)
-            rec = scursor.first()
+            else:            
+                #get all            
+                scursor = cursor = self.sDb.db.cursor(txn, flags=cursorflags)
+                rec = scursor.first()
+                while rec:
+                    s, value = rec
+                    p, o, t, c = value.split('\0')
+                    if ((not fo or o == object)
+                        and (not fot or t == objecttype)
+                        and (not fc or c == context)):
+                        yield tuple.__new__(Statement, (s, p, o, t, c))
+                    rec = scursor.next()
+        finally:
+            #close the cursor even if the caller stops iterating early
+            if cursor is not None:
+                cursor.close()
+
+    def getPredicateStatistics(self, predicate):
+        if predicate is None:
+            #distinct counts are summed so they are an upper bound
+            total = PredicateStatistics()
+            cursor = self.statsDb.db.cursor(self._txn, 
+                                        flags=bsddb.db.DB_TXN_SNAPSHOT)
+            rec = cursor.first()
             while rec:
-                s, value = rec
-                p, o, t, c = value.split('\0')
-                if ((not fo or o == object)
-                    and (not fot or t == objecttype)
-                    and (not fc or c == context)):
-                    stmts.append( Statement(s, p, o, t, c) )
-                rec = scursor.next()
+                total = total + PredicateStatistics(*map(int, rec[1].split('\0')))
+                rec = cursor.next()
+            cursor.close()
+            return total
+        value = self.statsDb.db.get(_to_safe_str(predicate), txn=self._txn)
+        if value is None:
+            return PredicateStatistics()
+        return PredicateStatistics(*map(int, value.split('\0')))
+
+    def _updateStatistics(self, predicate, count, subjects, objects):
+        key = _to_safe_str(predicate)
+        value = self.statsDb.db.get(key, txn=self._txn)
+        if value is not None:
+            oldCount, oldSubjects, oldObjects = map(int, value.split('\0'))
+            count += oldCount
+            subjects += oldSubjects
+            objects += oldObjects
+        if count > 0:
+            self.statsDb.db.put(key, _encodeValues(count, subjects, objects),
+                                                            txn=self._txn)
+        elif value is not None:
+            self.statsDb.db.delete(key, txn=self._txn)
+
+    def _hasSubjectPredicate(self, subject, predicate):
+        prefix = _to_safe_str(predicate) + '\0'
+        scursor = self.sDb.db.cursor(self._txn)
+        try:
+            rec = scursor.get(_to_safe_str(subject), prefix, 
+                                                bsddb.db.DB_GET_BOTH_RANGE)
+            return bool(rec) and rec[1].startswith(prefix)
+        finally:
+            scursor.close()
+
+    def _hasPredicateObject(self, predicate, object):
+        prefix = _encodeValues(predicate, object) + '\0'
+        pcursor = self.pDb.db.cursor(self._txn)
+        try:
+            rec = pcursor.set_range(prefix)
+            return bool(rec) and rec[0].startswith(prefix)
+        finally:
+            pcursor.close()
+
+    def _rebuildStatistics(self):
+        self.statsDb.db.truncate(txn=self._txn)
+        stats = {}
+        lastKey = None
+        pcursor = self.pDb.db.cursor(self._txn)
+        rec = pcursor.first()
+        while rec:
+            #p o t => c s
+            key, value = rec
+            p, o, t = key.split('\0')
+            pstats = stats.setdefault(p, [0, set(), set()])
+            pstats[0] += 1
+            pstats[1].add(value.split('\0')[1])
+            pstats[2].add(o)
+            rec = pcursor.next()
+        pcursor.close()
+        for p, (count, subjects, objects) in stats.iteritems():
+            self.statsDb.db.put(p, _encodeValues(count, len(subjects), 
+                                            len(objects)), txn=self._txn)
 
-        stmts.sort()        
-        stmts = removeDupStatementsFromSortedList(stmts, asQuad, 
-                                            limit=limit, offset=offset)
-        return stmts
-    
     def _checkAutoCommit(self):
         if self.autocommit:
             if self._txn:
@@ -303,8 +638,11 @@ class BdbStore(Model):
         
     def addStatement(self, stmt):
         '''add the specified statement to the model'''
+        self._closeCursors()
         self._checkAutoCommit()
         
+        newSubject = not self._hasSubjectPredicate(stmt[0], stmt[1])
+        newObject = not self._hasPredicateObject(stmt[1], stmt[2])
         try:
             #p o t => c s        
             self.pDb.db.put(_encodeValues(stmt[1], stmt[2], stmt[3]), 
@@ -315,33 +653,74 @@ class BdbStore(Model):
             self.sDb.db.put(_to_safe_str(stmt[0]), 
                 _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]), 
                 txn=self._txn, flags=bsddb.db.DB_NODUPDATA)
-            
-            return True
         except bsddb.db.DBKeyExistError:
             return False
+
+        for name, idxDb in (('osp', self.oDb), ('context', self.cDb)):
+            if idxDb is not None:
+                key, value = self._indexEntry(name, stmt)
+                idxDb.db.put(key, value, txn=self._txn, 
+                                            flags=bsddb.db.DB_NODUPDATA)
+
+        self._updateStatistics(stmt[1], 1, int(newSubject), int(newObject))
+        return True
         
     def removeStatement(self, stmt):
         '''removes the statement'''
+        self._closeCursors()
         self._checkAutoCommit()
         
         #p o t => c s
         pcursor = self.pDb.db.cursor(self._txn)
         if pcursor.set_both(_encodeValues(stmt[1], stmt[2], stmt[3]), _encodeValues(stmt[4], stmt[0])):
             pcursor.delete()
+        pcursor.close()
+
+        for name, idxDb in (('osp', self.oDb), ('context', self.cDb)):
+            if idxDb is not None:
+                icursor = idxDb.db.cursor(self._txn)
+                if icursor.set_both(*self._indexEntry(name, stmt)):
+                    icursor.delete()
+                icursor.close()
 
         #s => p o t c
         scursor = self.sDb.db.cursor(self._txn)
-        if scursor.set_both(_to_safe_str(stmt[0]), _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]) ):
+        try:
+            if not scursor.set_both(_to_safe_str(stmt[0]), _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]) ):
+                return False
             scursor.delete()
-            return True
-        return False
+        finally:
+            scursor.close()
+        self._updateStatistics(stmt[1], -1, 
+            -int(not self._hasSubjectPredicate(stmt[0], stmt[1])),
+            -int(not self._hasPredicateObject(stmt[1], stmt[2])))
+        return True
     
-    def commit(self, **kw):
+    def commit(self, flush=True, **kw):
+        '''
+        Commit the current transaction. With `groupCommit`, if `flush` is 
+        False the log isn't flushed: a ticket is returned instead and the 
+        commit isn't durable until it has been passed to `waitForCommit()`.
+        '''
+        ticket = None
+        self._closeCursors()
         if self._txn:
-            self._txn.commit()
+            if self.groupCommit:
+                ticket = self._groupCommit.commit(self._txn)
+            else:
+                self._txn.commit()
         self._txn = None
+        if ticket is not None and flush:
+            self._groupCommit.wait(ticket)
+            return None
+        return ticket
+
+    def waitForCommit(self, ticket):
+        "Wait until the commit that returned the ticket is flushed to disk"
+        self._groupCommit.wait(ticket)
     
     def rollback(self):
+        self._closeCursors()
         if self._txn:
             self._txn.abort()
         self._txn = None
@@ -1,9 +1,10 @@
 #:copyright: Copyright 2009-2011 by the Vesper team, see AUTHORS.
 #:license: Dual licenced under the GPL or Apache2 licences, see LICENSE.
-__all__ = ['SqliteStore']
+__all__ = ['SqliteStore', 'SqliteSnapshot']
 
 import os, os.path
 import sqlite3
+import threading
 from vesper.backports import *
 from vesper.data.base import * # XXX
 import logging 
@@ -21,21 +22,145 @@ class SqliteStore(Model):
       context
     )
 
+    getStatements() supports the 'where', 'semijoins' and 'orderby' hints, 
+    compiling them into the select statement so that rows the query engine would discard
+    aren't returned.
+
+    Per-predicate statistics (used by the query engine's cost model) are kept
+    in the vesper_stats table, which is maintained by triggers so that it is 
+    updated in the same transaction as the statements.
+
+    The unique constraint provides a subject-first index; the `indexes` 
+    keyword argument (e.g. set in `model_options`) chooses which of the 
+    covering indexes in `INDEXES` are also maintained. Indexes are created or
+    dropped when an existing database is opened with a different setting. 
+    If `analyze` is set, SQLite's ANALYZE command is run when the database is
+    opened so the query planner has statistics for choosing between indexes
+    (see also `analyze()`).
+
+    If `wal` is set the database (which must be on disk) is put in SQLite's 
+    write-ahead logging mode and `getSnapshot()` returns a `SqliteSnapshot` 
+    that reads the last committed version of the database on a separate 
+    connection, so readers don't wait for a writer and vice versa.
     '''
     
-    def __init__(self, source = None, defaultStatements = None, autocommit = False, **kw):
-        if source is None:
+    INDEXES = {
+        'pos' : ('predicate', 'object', 'objecttype', 'subject', 'context'),
+        'osp' : ('object', 'objecttype', 'subject', 'predicate', 'context'),
+        'context' : ('context', 'subject', 'predicate', 'object', 'objecttype'),
+    }
+    defaultIndexes = ('pos', 'osp')
+
+    def __init__(self, source = None, defaultStatements = None, autocommit = False, 
+                        indexes=None, analyze=False, wal=False, **kw):
+        if not source:
             source = ':memory:'
             log.debug("in-memory database being opened")
+            if wal:
+                log.warning("wal is ignored for in-memory databases")
+                wal = False
         else:
             source = os.path.abspath(source)
             log.debug("on-disk database being opened at ", source)
+        self.source = source
 
-        self.conn = sqlite3.connect(source, isolation_level=not autocommit and 'DEFERRED' or None)
+        #the connection is shared by the threads using the store: writes are
+        #serialized by the transaction lock and, without wal, reads by the
+        #caller (see `concurrentReads`), e.g. ThreadPoolWSGIServer's requests
+        self.conn = sqlite3.connect(source, check_same_thread=False,
+                        isolation_level=not autocommit and 'DEFERRED' or None)
+        self.snapshotReads = self.snapshotIsolation = wal
+        self.concurrentReads = wal
+        self._readers = [] #idle connections used by snapshots
+        self._readersLock = threading.Lock()
         curs = self.conn.cursor()
+        if wal:
+            curs.execute("pragma journal_mode=wal")
         curs.execute("create table if not exists vesper_stmts (\
 subject, predicate, object, objecttype, context not null, \
 unique (subject, predicate, object, objecttype, context) )" )
+        self._createStatistics(curs)
+        if indexes is None:
+            indexes = self.defaultIndexes
+        created = self._createIndexes(curs, indexes)
+        if analyze or created:
+            self.analyze()
+        self.conn.commit()
+
+    def _createStatistics(self, curs):
+        curs.execute("select count(*) from sqlite_master where type = 'table' \
+and name = 'vesper_stats'")
+        exists = curs.fetchone()[0]
+        curs.execute("create table if not exists vesper_stats (\
+predicate primary key, count, subjects, objects)")
+        curs.execute("create trigger if not exists vesper_stats_insert \
+after insert on vesper_stmts begin \
+insert or ignore into vesper_stats values (new.predicate, 0, 0, 0); \
+update vesper_stats set count = count + 1, \
+subjects = subjects + not exists (select 1 from vesper_stmts where \
+subject = new.subject and predicate = new.predicate and rowid != new.rowid), \
+objects = objects + not exists (select 1 from vesper_stmts where \
+predicate = new.predicate and object = new.object and rowid != new.rowid) \
+where predicate = new.predicate; end")
+        curs.execute("create trigger if not exists vesper_stats_delete \
+after delete on vesper_stmts begin \
+update vesper_stats set count = count - 1, \
+subjects = subjects - not exists (select 1 from vesper_stmts where \
+subject = old.subject and predicate = old.predicate), \
+objects = objects - not exists (select 1 from vesper_stmts where \
+predicate = old.predicate and object = old.object) \
+where predicate = old.predicate; \
+delete from vesper_stats where predicate = old.predicate and count < 1; end")
+        if not exists:
+            #database created before statistics were added 
+            self._rebuildStatistics(curs)
+
+    def _rebuildStatistics(self, curs):
+        curs.execute("delete from vesper_stats")
+        curs.execute("insert into vesper_stats select predicate, count(*), \
+count(distinct subject), count(distinct object) from vesper_stmts \
+group by predicate")
+
+    def _createIndexes(self, curs, indexes):
+        '''
+        Create the given indexes and drop the ones that are no longer wanted.
+        Returns True if an index was created on a table that already has rows.
+        '''
+        wanted = {}
+        for name in indexes:
+            if name not in self.INDEXES:
+                raise RuntimeError('unknown SqliteStore index: %s' % name)
+            wanted['vesper_stmts_%s_idx' % name] = self.INDEXES[name]
+        #the statistics triggers need to efficiently find distinct objects
+        #(the unique constraint already provides an index on subject, predicate)
+        if 'pos' not in indexes:
+            wanted['vesper_stmts_po_idx'] = ('predicate', 'object')
+
+        curs.execute("select name from sqlite_master where type = 'index' \
+and tbl_name = 'vesper_stmts' and name like 'vesper_stmts_%_idx'")
+        existing = set(row[0] for row in curs.fetchall())
+        for name in existing.difference(wanted):
+            log.info("dropping index " + name)
+            curs.execute("drop index %s" % name)
+
+        created = False
+        for name, columns in wanted.items():
+            if name not in existing:
+                curs.execute("create index %s on vesper_stmts (%s)" % (name, 
+                                                        ', '.join(columns)))
+                created = True
+        if created:
+            curs.execute("select exists (select 1 from vesper_stmts)")
+            created = bool(curs.fetchone()[0])
+        return created
+
+    def analyze(self):
+        '''
+        Gather statistics about the tables and indexes for SQLite's query 
+        planner. This should be called after the contents of the store change
+        substantially, e.g. after a bulk load.
+        '''
+        self.conn.execute("analyze")
 
     def _set_autocommit(self, set):
         if set:
@@ -45,6 +170,51 @@ unique (subject, predicate, object, objecttype, context) )" )
 
     autocommit = property(lambda self: not self.conn.isolation_level, _set_autocommit)
 
+    canHandlePushdownHints = True
+
+    def _compileConditions(self, conditions):
+        '''
+        Returns a list of SQL expressions and their parameters for the given
+        'where' hint.
+        '''
+        clauses = []
+        sqlparams = []
+        for op, values, objectTypes in conditions:
+            assert op in ('<', '<=', '>', '>=', 'in'), op
+            if isinstance(values[0], (int, long, float)):
+                #XXX 'inf' and 'nan' will be cast as 0
+                column = 'cast(object as numeric)'
+            else:
+                column = 'object'
+            if op == 'in':
+                test = '%s in (%s)' % (column, ', '.join('?' * len(values)))
+            else:
+                test = '%s %s ?' % (column, op)
+            clauses.append('(objecttype not in (%s) OR %s)' % (
+                                    ', '.join('?' * len(objectTypes)), test))
+            sqlparams.extend(objectTypes)
+            sqlparams.extend(values)
+        return clauses, sqlparams
+
+    def _compileHints(self, hints):
+        '''
+        Returns a list of SQL expressions and their parameters for the 
+        'where' and 'semijoins' hints.
+        '''
+        clauses, sqlparams = self._compileConditions(hints.get('where', ()))
+        for columns, conditions in hints.get('semijoins', ()):
+            subclauses = []
+            for name in ('subject', 'predicate', 'object', 'objecttype', 'context'):
+                if name in columns:
+                    subclauses.append('%s = ?' % name)
+                    sqlparams.append(columns[name])
+            moreclauses, moreparams = self._compileConditions(conditions)
+            sqlparams.extend(moreparams)
+            subclauses.extend(moreclauses)
+            clauses.append('subject in (select subject from vesper_stmts where %s)'
+                                                    % ' AND '.join(subclauses))
+        return clauses, sqlparams
+
     def getStatements(self, subject=None, predicate=None, object=None,
                       objecttype=None, context=None, asQuad=True, hints=None):
         ''' 
@@ -52,6 +222,19 @@ unique (subject, predicate, object, objecttype, context) )" )
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
+        stmts = list(self.iterStatements(subject, predicate, object, 
+                                        objecttype, context, asQuad, hints))
+        # sqlite returns -1 on successful select()... 
+        log.debug("stmts returned: ", stmts)
+        return stmts
+
+    def iterStatements(self, subject=None, predicate=None, object=None,
+                      objecttype=None, context=None, asQuad=True, hints=None):
+        '''
+        Like `getStatements` but the statements are read from the cursor as 
+        the iterator is consumed. The iterator can't be used after the 
+        connection is committed or rolled back.
+        '''
         fs = subject is not None
         fp = predicate is not None
         fo = object is not None
@@ -77,7 +260,8 @@ unique (subject, predicate, object, objecttype, context) )" )
         if not asQuad and not fc:
             sqlstmt = 'select subject, predicate, object, objecttype, min(context) as c from vesper_stmts'
 
-        if fs | fp | fo | fot | fc:
+        pushdown, pushdownparams = self._compileHints(hints)
+        if fs | fp | fo | fot | fc or pushdown:
             sqlstmt += ' where'                   # at least one column constraint
         if fs: 
             if arity: 
@@ -108,8 +292,20 @@ unique (subject, predicate, object, objecttype, context) )" )
                 sqlstmt += ' AND'
             sqlstmt += ' context = ?'  
             sqlparams.append(context)
+            arity = True
+        for clause in pushdown:
+            if arity: 
+                sqlstmt += ' AND'
+            sqlstmt += ' ' + clause
+            arity = True
+        sqlparams.extend(pushdownparams)
         if not asQuad and not fc:
             sqlstmt += ' group by subject, predicate, object, objecttype'
+        orderby = hints.get('orderby')
+        if orderby:
+            assert set(orderby) <= set(('subject', 'predicate', 'object', 
+                                    'objecttype', 'context')), orderby
+            sqlstmt += ' order by ' + ', '.join(orderby)
         if limit is not None:
             sqlstmt += ' limit ?'
             sqlparams.append(str(limit))
@@ -121,17 +317,32 @@ unique (subject, predicate, object, objecttype, context) )" )
         #print "sqlstmt: ", sqlstmt
         #print "sqlparams: ", sqlparams
 
-        self.conn.row_factory = sqlite3.Row
         self.conn.text_factory = sqlite3.OptimizedUnicode
         curs = self.conn.cursor()
         curs.execute(sqlstmt, sqlparams)
-        stmts = []
-        for r in curs:
-            stmts.append( Statement(r['subject'], r['predicate'], r['object'], r['objecttype'], r['c']) )
-            
-        # sqlite returns -1 on successful select()... 
-        log.debug("stmts returned: ", stmts)
-        return stmts
+        return self._iterRows(curs)
+
+    def _iterRows(self, curs):
+        try:
+            #rows are (subject, predicate, object, objecttype, context) tuples
+            for r in curs:
+                yield tuple.__new__(Statement, r)
+        finally:
+            curs.close()
+
+    def getPredicateStatistics(self, predicate):
+        curs = self.conn.cursor()
+        if predicate is None:
+            #distinct counts are summed so they are an upper bound
+            curs.execute("select total(count), total(subjects), total(objects) \
+from vesper_stats")
+        else:
+            curs.execute("select count, subjects, objects from vesper_stats \
+where predicate = ?", (predicate,))
+        row = curs.fetchone()
+        if row is None:
+            return PredicateStatistics()
+        return PredicateStatistics(*[int(v) for v in row])
 
     def addStatement(self, stmt):
         '''add the specified statement to the model'''
@@ -147,6 +358,36 @@ unique (subject, predicate, object, objecttype, context) )" )
         curs.executemany("insert or ignore into vesper_stmts values (?, ?, ?, ?, ?)",  stmts)
         return curs.rowcount > 0
 
+    def bulkload(self, batches):
+        '''
+        Add and commit each list of statements yielded by `batches`. 
+        The secondary indexes and the statistics triggers are dropped while 
+        loading and rebuilt once all the batches are added.
+        '''
+        curs = self.conn.cursor()
+        curs.execute("select type, name, sql from sqlite_master where \
+tbl_name = 'vesper_stmts' and type in ('index', 'trigger') and sql is not null")
+        deferred = curs.fetchall()
+        for type, name, sql in deferred:
+            curs.execute("drop %s %s" % (type, name))
+        self.conn.commit()
+        count = 0
+        try:
+            for batch in batches:
+                curs.executemany(
+                    "insert or ignore into vesper_stmts values (?, ?, ?, ?, ?)", 
+                                                                        batch)
+                self.conn.commit()
+                count += len(batch)
+        finally:
+            self.conn.rollback()
+            for type, name, sql in deferred:
+                curs.execute(sql)
+            self._rebuildStatistics(curs)
+            self.analyze()
+            self.conn.commit()
+        return count
+
     def removeStatement(self, stmt):
         '''removes the statement from the model'''
         log.debug("removeStatement called with: ", stmt)
@@ -169,6 +410,83 @@ subject = ? AND predicate = ? AND object = ? AND objecttype = ? AND context = ?
     def rollback(self):
         self.conn.rollback()
 
+    def getSnapshot(self):
+        '''
+        If the store was opened with `wal` set, returns a `SqliteSnapshot` 
+        of the last committed version of the database, otherwise None.
+        '''
+        if not self.snapshotReads:
+            return None
+        self._readersLock.acquire()
+        try:
+            conn = self._readers and self._readers.pop() or None
+        finally:
+            self._readersLock.release()
+        if conn is None:
+            #the snapshot's connection manages its own read transaction
+            conn = sqlite3.connect(self.source, isolation_level=None,
+                                                    check_same_thread=False)
+        conn.execute("begin")
+        #a read transaction starts with the first read, do one now so
+        #the snapshot sees the database as of this call
+        conn.execute("select count(*) from sqlite_master").fetchone()
+        return SqliteSnapshot(self, conn)
+
+    def _releaseReader(self, conn):
+        conn.execute("commit")
+        self._readersLock.acquire()
+        try:
+            self._readers.append(conn)
+        finally:
+            self._readersLock.release()
+
     def close(self):
         log.debug("closing!")
         self.conn.close()
+        for conn in self._readers:
+            conn.close()
+        self._readers = []
+
+class SqliteSnapshot(SqliteStore):
+    '''
+    A read-only view of a `SqliteStore` returned by 
+    `SqliteStore.getSnapshot()`. Its reads happen in one read transaction on
+    a separate connection that is returned to the store by `close()`.
+    '''
+    snapshotReads = snapshotIsolation = False
+    concurrentReads = True
+
+    def __init__(self, store, conn):
+        self.store = store
+        self.conn = conn
+
+    autocommit = True
+
+    def addStatement(self, stmt):
+        raise RuntimeError('can not modify a snapshot')
+
+    def addStatements(self, stmts):
+        raise RuntimeError('can not modify a snapshot')
+
+    def removeStatement(self, stmt):
+        raise RuntimeError('can not modify a snapshot')
+
+    def removeStatements(self, stmts):
+        raise RuntimeError('can not modify a snapshot')
+
+    def bulkload(self, batches):
+        raise RuntimeError('can not modify a snapshot')
+
+    def commit(self, **kw):
+        pass
+
+    def rollback(self):
+        pass
+
+    def getSnapshot(self):
+        return None
+
+    def close(self):
+        if self.conn is not None:
+            self.store._releaseReader(self.conn)
+            self.conn = None
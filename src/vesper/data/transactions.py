@@ -78,6 +78,7 @@ class TransactionState(object):
        self.participants = []
        self.info = {}
        self.readOnly = True
+       self.afterRelease = []
 
     def addInfo(self, info):
         self.info.update(info)
@@ -181,7 +182,10 @@ class TransactionService(object):
         finally:
             self.state.inCommit = False 
         
+        afterRelease = self.state.afterRelease
         self._cleanup(True) 
+        for func in afterRelease:
+            func()
 
     def fail(self):
         if not self.isActive():
@@ -228,6 +232,15 @@ class TransactionService(object):
     def getInfo(self):
         return self.state.info
 
+    def callAfterRelease(self, func):
+        '''
+        Call `func` after the transaction has committed and been cleaned up
+        (which releases any lock it holds), e.g. to wait for a commit to be
+        flushed to disk without making other transactions wait too. 
+        If `func` raises an exception `commit()` raises it.
+        '''
+        self.state.afterRelease.append(func)
+
     def _cleanup(self, committed):
         for p in self.state.participants[:]:
             try:
@@ -396,6 +409,19 @@ class ProcessorTransactionService(TransactionService,utils.ObjectWithThreadLocal
                 #lock on first participant joining that will write
                 self.state.lock = self.server.getLock()
         super(ProcessorTransactionService, self).join(participant, readOnly)
+
+    def callAfterRelease(self, func):
+        '''
+        If the transaction was started with an '__afterRelease' list in its
+        keywords `func` is appended to it instead, for a caller that holds its
+        own lock around the transaction to call after releasing that lock
+        (see `vesper.web.HTTPRequestProcessor.wsgi_app`).
+        '''
+        deferred = self.state.kw.get('__afterRelease')
+        if deferred is not None:
+            deferred.append(func)
+        else:
+            super(ProcessorTransactionService, self).callAfterRelease(func)
    
     def _cleanup(self, committed):
         if committed:
@@ -50,6 +50,10 @@ XSD+'int': int,
 XSD+'float' : float,
 }
 
+#the object types whose values toJsonValue() converts to numbers
+NUMERIC_TYPES = (XSD+'integer', XSD+'double', XSD+'decimal', XSD+'int', 
+                                                            XSD+'float')
+
 from vesper.utils import Uri
 ABSURI = Uri.getURIRegex(allowbnode=True)[0]
 URIREF = r'(?:[\w$_-]+[^\s{}\\\\]*)'
@@ -47,10 +47,12 @@ We could give the propery different names just as can "SELECT foo AS fob FROM ta
 """
 from vesper.backports import *
 from vesper.data.base import Tupleset, ColumnInfo, EMPTY_NAMESPACE, ResourceUri
+from vesper.data.base import Model
 from vesper import utils, pjson
+from vesper.utils import MRUCache
 import StringIO
 import vesper.utils._utils
-import time
+import time, copy, threading, itertools, weakref
 
 SUBJECT = 0
 PROPERTY = 1
@@ -79,7 +81,8 @@ def runQuery(query, model):
 
 def getResults(query, model, bindvars=None, explain=None, debug=False,
     forUpdate=False, captureErrors=False, contextShapes=None, useSerializer=True,
-    printast=False, queryCache=None):
+    printast=False, queryCache=None, astCache=None, executor=None,
+    sortBufferRows=None):
     '''
     Returns a dict with the following keys:
         
@@ -111,6 +114,17 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
        If value is a boolean, indicates whether pjson serialization is used or 
        not (default: True). If value is a dict it is passed as keyword arguments
        to the `pjson.Serializer` constructor.
+    astCache
+       If set, an `ASTCache` used to look up (or save) the parsed query.
+    executor
+       If set, a `vesper.utils.ThreadPool` used to evaluate the independent
+       branches of the query's joins concurrently (if the model supports 
+       concurrent reads).
+    sortBufferRows
+       If set, the maximum number of rows an ``order by`` sorts in memory,
+       more rows are sorted in runs written to temporary files and merged.
+       Also limits the number of groups a ``group by`` of aggregate functions
+       keeps in memory.
     '''
     #XXX? add option to include `resources` in the result,
     # a list describing the resources (used for track changes)
@@ -118,7 +132,10 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
     response = utils.attrdict()
     errors = []
     
-    (ast, parseErrors) = buildAST(query)
+    if astCache is not None:
+        (ast, parseErrors) = astCache.getAST(query)
+    else:
+        (ast, parseErrors) = buildAST(query)
     errors.extend(parseErrors)
     
     response['results'] = []
@@ -130,27 +147,36 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
         debug = StringIO.StringIO()
     
     if ast != None:        
-        try:
-            results = list(evalAST(ast, model, bindvars, explain, debug, 
-                    forUpdate, contextShapes, useSerializer, queryCache))
-            #XXX: if forUpdate add a pjson header including namemap
-            #this we have a enough info to reconstruct refs and datatypes without guessing
-            #if forUpdate: 
-            #   #need a context.datamap
-            #   pjson.addHeader(context.datamap, response)
-            response['results'] = results
-        except QueryException, qe:
-            if captureErrors:
-                errors.append('error: %s' % qe.message)
-            else:
-                raise
-        except Exception, ex:
-            if captureErrors:
-                import traceback
-                errors.append("unexpected exception: %s" % traceback.format_exc())
-            else:
-                raise
+        rows = evalAST(ast, model, bindvars, explain, debug, 
+                    forUpdate, contextShapes, useSerializer, queryCache, 
+                    executor=executor, sortBufferRows=sortBufferRows)
+        #XXX: if forUpdate add a pjson header including namemap
+        #this we have a enough info to reconstruct refs and datatypes without guessing
+        #if forUpdate: 
+        #   #need a context.datamap
+        #   pjson.addHeader(context.datamap, response)
+        response['results'] = _collectResults(rows, errors, captureErrors)
     
+    return _finishResponse(response, start, errors, explain, debug, 
+                                                    printast and ast)
+
+def _collectResults(rows, errors, captureErrors):
+    try:
+        return list(rows)
+    except QueryException, qe:
+        if captureErrors:
+            errors.append('error: %s' % qe.message)
+        else:
+            raise
+    except Exception, ex:
+        if captureErrors:
+            import traceback
+            errors.append("unexpected exception: %s" % traceback.format_exc())
+        else:
+            raise
+    return []
+
+def _finishResponse(response, start, errors, explain, debug, printast):
     response['elapsed'] = time.clock() - start
     response['errors'] = errors
     if explain:
@@ -161,7 +187,7 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
     
     if printast:
         import pprint
-        response['ast'] = pprint.pformat(ast)
+        response['ast'] = pprint.pformat(printast)
     
     return response
 
@@ -170,6 +196,404 @@ def buildAST(query, namemap=None):
     from vesper.query import parse, engine
     return parse.parse(query, engine.SimpleQueryEngine.queryFunctions, False, namemap)
 
+def _raiseNotCached(*args):
+    raise MRUCache.NotCacheable
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.iteritems()))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+def normalizeQuery(query):
+    '''
+    Strip leading and trailing whitespace from each line of the query.
+    (Strings can't span lines so this never changes the meaning of the query.)
+    '''
+    return '\n'.join(line.strip() for line in query.strip().splitlines())
+
+class ASTCache(object):
+    '''
+    A bounded, thread-safe MRU cache of parsed (and rewritten) queries, keyed 
+    by the normalized query text and namemap.
+
+    The cached ASTs are shared between callers (and threads) so they must be 
+    treated as read-only -- they can be evaluated with `evalAST` any number of 
+    times with different bindvars.
+    '''
+
+    def __init__(self, capacity=200):
+        self._cache = MRUCache.MRUCache(capacity)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.parseTime = 0.0 #total time spent parsing cache misses
+        self.timeSaved = 0.0 #total parse time of the cache hits 
+
+    def getKey(self, query, namemap=None):
+        return (normalizeQuery(query), _freeze(namemap))
+
+    def getAST(self, query, namemap=None):
+        "Like `buildAST`, returns (ast, [error messages])"
+        key = self.getKey(query, namemap)
+        self._lock.acquire()
+        try:
+            try:
+                ast, errors, elapsed = self._cache.getOrCalcValue(
+                                                        _raiseNotCached, key)
+            except MRUCache.NotCacheable:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.timeSaved += elapsed
+                return ast, list(errors)
+        finally:
+            self._lock.release()
+
+        #parse outside the lock so misses don't serialize (parsers are per-thread)
+        #copy the namemap since the parser updates it and the ast references it
+        start = time.time()
+        ast, errors = buildAST(query, copy.deepcopy(namemap))
+        elapsed = time.time() - start
+
+        self._lock.acquire()
+        try:
+            self.parseTime += elapsed
+            if ast is not None:
+                entry = (ast, tuple(errors), elapsed)
+                self._cache.getOrCalcValue(lambda *args: entry, key)
+        finally:
+            self._lock.release()
+        return ast, errors
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''
+        Returns a dict with `hits`, `misses`, `evictions`, `size`, `capacity`, 
+        `parseTime` and `timeSaved` keys.
+        '''
+        self._lock.acquire()
+        try:
+            return dict(hits=self.hits, misses=self.misses, 
+                evictions=self._cache.evictions, 
+                size=len(self._cache.nodeDict), capacity=self._cache.capacity,
+                parseTime=self.parseTime, timeSaved=self.timeSaved)
+        finally:
+            self._lock.release()
+
+class ReadRecordingModel(Model):
+    '''
+    Wraps a model and records the statement patterns (a (subject, predicate,
+    object, objecttype, context) tuple with None as a wildcard) of every 
+    lookup the query engine makes. Used by `QueryResultCache`.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.patterns = set()
+
+    def __getattribute__(self, name):
+        #delegate everything but the lookups (like DataStore.ModelWrapper)
+        if name in ReadRecordingModel.__dict__ or name in ('model', 'patterns'):
+            return object.__getattribute__(self, name)
+        return getattr(object.__getattribute__(self, 'model'), name)
+
+    def filter(self, conditions=None, hints=None):
+        pattern = [None] * 5
+        if conditions:
+            for key, value in conditions.iteritems():
+                if key < 5:
+                    if isinstance(value, ResourceUri):
+                        value = value.uri
+                    pattern[key] = value
+        self.patterns.add(tuple(pattern))
+        return self.model.filter(conditions, hints)
+
+    def getStatements(self, subject=None, predicate=None, object=None,
+                      objecttype=None, context=None, asQuad=True, hints=None):
+        self.patterns.add((subject, predicate, object, objecttype, context))
+        return self.model.getStatements(subject, predicate, object, 
+                                        objecttype, context, asQuad, hints)
+
+    def iterStatements(self, subject=None, predicate=None, object=None,
+                      objecttype=None, context=None, asQuad=True, hints=None):
+        self.patterns.add((subject, predicate, object, objecttype, context))
+        return self.model.iterStatements(subject, predicate, object, 
+                                        objecttype, context, asQuad, hints)
+
+class _CachedResults(object):
+    __slots__ = ('key', 'results', 'patterns', 'version', 'elapsed', 
+                                                            '__weakref__')
+
+def _copyResults(obj):
+    #copy the dicts and lists so callers can't modify the cached results
+    if isinstance(obj, dict):
+        return type(obj)((k, _copyResults(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        return type(obj)(_copyResults(v) for v in obj)
+    return obj
+
+class QueryResultCache(object):
+    '''
+    A bounded, thread-safe MRU cache of query results that is shared by 
+    all transactions. 
+
+    Each entry records the statement patterns the query read (see 
+    `ReadRecordingModel`) and `invalidate()` removes the entries with a 
+    pattern matching any of the statements a transaction added or removed. 
+
+    `version` is incremented by each invalidation: results computed from a
+    version of the store older than the current one aren't added and an 
+    entry is only returned to a reader whose version of the store isn't 
+    older than the entry's.
+    '''
+
+    def __init__(self, capacity=0, maxRows=1000):
+        self._cache = MRUCache.MRUCache(capacity)
+        self._lock = threading.Lock()
+        self.maxRows = maxRows
+        self.version = 0
+        #(position, term) (or None for patterns without terms) 
+        # => entries with a pattern whose most selective term is at position 
+        self._index = {}
+        self._prunedAt = 0 #evictions when the index was last pruned
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0 #number of entries removed by invalidate()
+        self.timeSaved = 0.0 #total time the cache hits took to compute
+
+    def getKey(self, query, bindvars=None, forUpdate=False, 
+                                    contextShapes=None, useSerializer=True):
+        '''
+        Returns the key for the results of the given query or None if the 
+        arguments can't be used as a key.
+        '''
+        key = (normalizeQuery(query), _freeze(bindvars), bool(forUpdate), 
+                            _freeze(contextShapes), _freeze(useSerializer))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key, version):
+        '''
+        Returns a copy of the results cached for the key or None if there 
+        aren't any valid for a reader of the given version of the store.
+        '''
+        self._lock.acquire()
+        try:
+            try:
+                entry = self._cache.getOrCalcValue(_raiseNotCached, key)
+            except MRUCache.NotCacheable:
+                entry = None
+            if entry is None or entry.version > version:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.timeSaved += entry.elapsed
+        finally:
+            self._lock.release()
+        return _copyResults(entry.results)
+
+    def put(self, key, results, patterns, version, elapsed=0.0):
+        '''
+        Add the results of a query that read the given patterns from the 
+        given version of the store.
+        '''
+        if len(results) > self.maxRows:
+            return
+        entry = _CachedResults()
+        entry.key = key
+        entry.results = _copyResults(results)
+        entry.patterns = tuple(patterns)
+        entry.version = version
+        entry.elapsed = elapsed
+        self._lock.acquire()
+        try:
+            if version != self.version:
+                return #the store changed since the query read it
+            self._cache.getOrCalcValue(lambda *args: entry, key)
+            for pattern in entry.patterns:
+                self._index.setdefault(self._indexKey(pattern), 
+                                            weakref.WeakSet()).add(entry)
+            if self._cache.evictions - self._prunedAt >= self._cache.capacity:
+                #evicted entries drop out of the index's WeakSets, 
+                #periodically remove the empty ones 
+                self._prunedAt = self._cache.evictions
+                for indexKey in [k for k, v in self._index.iteritems() if not v]:
+                    del self._index[indexKey]
+        finally:
+            self._lock.release()
+
+    def _indexKey(self, pattern):
+        for pos in (1, 0, 2, 4):
+            if pattern[pos] is not None:
+                return (pos, pattern[pos])
+        return None
+
+    def invalidate(self, stmts):
+        '''
+        Remove the entries that read any of the given statements and 
+        increment `version`.
+        '''
+        self._lock.acquire()
+        try:
+            self.version += 1
+            index = self._index
+            stale = set()
+            for stmt in stmts:
+                for indexKey in ((1, stmt[1]), (0, stmt[0]), (2, stmt[2]),
+                                                        (4, stmt[4]), None):
+                    entries = index.get(indexKey)
+                    if not entries:
+                        continue
+                    for entry in list(entries):
+                        if entry in stale:
+                            continue
+                        for pattern in entry.patterns:
+                            for i in (0, 1, 2, 3, 4):
+                                if (pattern[i] is not None 
+                                                and pattern[i] != stmt[i]):
+                                    break
+                            else:
+                                stale.add(entry)
+                                break
+            for entry in stale:
+                node = self._cache.nodeDict.get((entry.key,))
+                if node is not None and node.value is entry:
+                    self._cache.removeNode(node)
+                    self.invalidations += 1
+                for pattern in entry.patterns:
+                    entries = index.get(self._indexKey(pattern))
+                    if entries is not None:
+                        entries.discard(entry)
+                        if not entries:
+                            del index[self._indexKey(pattern)]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        "Remove all the entries and increment `version`."
+        self._lock.acquire()
+        try:
+            self.version += 1
+            self._cache.clear()
+            self._index.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''
+        Returns a dict with `hits`, `misses`, `hitRate`, `evictions`, 
+        `invalidations`, `size`, `capacity` and `timeSaved` keys.
+        '''
+        self._lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses, 
+                hitRate=lookups and float(self.hits) / lookups or 0.0,
+                evictions=self._cache.evictions, 
+                invalidations=self.invalidations,
+                size=len(self._cache.nodeDict), capacity=self._cache.capacity,
+                timeSaved=self.timeSaved)
+        finally:
+            self._lock.release()
+
+def getBindVarNames(ast):
+    "Returns the set of the names of the bindvars referenced by the query"
+    from vesper.query import jqlAST
+    return frozenset(op.name for op in ast.depthfirst() 
+                                        if isinstance(op, jqlAST.BindVar))
+
+class CompiledQuery(object):
+    '''
+    A query that has been parsed and rewritten once so it can be evaluated 
+    any number of times with different bindvars. 
+    
+    Besides skipping the parser and the join rewriting, it also works out 
+    up front which bindvars might need to be coerced into resource references,
+    so only those values are examined at evaluation time.
+    '''
+
+    def __init__(self, query, useSerializer=True, astCache=None):
+        self.query = query
+        self.useSerializer = useSerializer
+        if astCache is not None:
+            (self.ast, self.errors) = astCache.getAST(query)
+        else:
+            (self.ast, self.errors) = buildAST(query)
+        if self.ast is None:
+            raise QueryException('could not parse query: ' + '\n'.join(self.errors))
+
+        self.bindVarNames = getBindVarNames(self.ast)
+        self.parseContext = _getParseContext(_getSerializer(self.ast, 
+                                            useSerializer), self.ast)
+        if self.parseContext and self.parseContext.idrefpattern:
+            self.refBindVarNames = self.bindVarNames
+        else: #nothing could look like a ref
+            self.refBindVarNames = frozenset()
+
+    def parseBindVars(self, bindvars):
+        '''
+        Returns a new dictionary with the bindvars referenced by this query 
+        (the given dictionary is left unchanged).
+        '''
+        if not bindvars:
+            return {}
+        parsed = {}
+        for k in self.bindVarNames:
+            if k not in bindvars:
+                continue #evalBindVar will raise an error if it's used
+            v = bindvars[k]
+            if k in self.refBindVarNames:
+                v = _parseBindVar(self.parseContext, v)
+            parsed[k] = v
+        return parsed
+
+    def evaluate(self, model, bindvars=None, explain=None, debug=False, 
+            forUpdate=False, contextShapes=None, queryCache=None, executor=None,
+            sortBufferRows=None):
+        "Like `evalAST`, yields the query results"
+        return evalAST(self.ast, model, self.parseBindVars(bindvars), explain, 
+            debug, forUpdate, contextShapes, self.useSerializer, queryCache, 
+            parseBindVars=False, executor=executor, sortBufferRows=sortBufferRows)
+
+    def getResults(self, model, bindvars=None, limit=None, offset=None, 
+            explain=None, debug=False, forUpdate=False, captureErrors=False, 
+            contextShapes=None, queryCache=None, executor=None,
+            sortBufferRows=None):
+        '''
+        Like `getResults`. If `limit` or `offset` are specified they are 
+        applied to the rows yielded by the query (after any limit or offset 
+        in the query itself), evaluation stops once `limit` rows are retrieved.
+        '''
+        start = time.clock()
+        response = utils.attrdict()
+        errors = []
+        if explain:
+            explain = StringIO.StringIO()
+        if debug and not hasattr(debug, 'write'):
+            debug = StringIO.StringIO()
+
+        rows = self.evaluate(model, bindvars, explain, debug, forUpdate, 
+                            contextShapes, queryCache, executor, sortBufferRows)
+        if limit is not None or offset:
+            offset = offset or 0
+            if limit is not None:
+                rows = itertools.islice(rows, offset, offset+limit)
+            else:
+                rows = itertools.islice(rows, offset, None)
+        response['results'] = _collectResults(rows, errors, captureErrors)
+        return _finishResponse(response, start, errors, explain, debug, False)
+
 def _parsePjson(parseContext, v):
     #XXX handle pjson dicts
     if isinstance(v, (str, unicode)):
@@ -178,34 +602,45 @@ def _parsePjson(parseContext, v):
             return ResourceUri(ref)
     return v
 
-def evalAST(ast, model, bindvars=None, explain=None, debug=False, 
-    forUpdate=False, contextShapes=None, useSerializer=True, queryCache=None):
-    from vesper.query import engine
-    
+def _parseBindVar(parseContext, v):
+    if isinstance(v, (list, tuple)):
+        return [_parsePjson(parseContext, i) for i in v]
+    else:
+        return _parsePjson(parseContext, v)
+
+def _getSerializer(ast, useSerializer):
     astNameMap = getattr(ast,'namemap', None)
     if isinstance(useSerializer, dict):        
         if astNameMap is not None:
             useSerializer['nameMap'] = astNameMap
-        serializer = pjson.Serializer(**useSerializer)
+        return pjson.Serializer(**useSerializer)
     elif useSerializer:
-        serializer = pjson.Serializer(astNameMap)
+        return pjson.Serializer(astNameMap)
     else:
-        serializer = None
-    if bindvars:
-        if serializer:
-            parseContext = serializer.parseContext
-        else:
-            parseContext = pjson.ParseContext(astNameMap)
+        return None
+
+def _getParseContext(serializer, ast):
+    if serializer:
+        return serializer.parseContext
+    else:
+        return pjson.ParseContext(getattr(ast,'namemap', None))
+
+def evalAST(ast, model, bindvars=None, explain=None, debug=False, 
+    forUpdate=False, contextShapes=None, useSerializer=True, queryCache=None,
+    parseBindVars=True, executor=None, sortBufferRows=None):
+    from vesper.query import engine
+    
+    serializer = _getSerializer(ast, useSerializer)
+    if bindvars and parseBindVars:
+        parseContext = _getParseContext(serializer, ast)
         if parseContext:
             for k, v in bindvars.items():
-                if isinstance(v, (list, tuple)):
-                    bindvars[k] = [_parsePjson(parseContext, i) for i in v]
-                else:
-                    bindvars[k] = _parsePjson(parseContext, v)
+                bindvars[k] = _parseBindVar(parseContext, v)
 
     queryContext = QueryContext(model, ast, explain, bindvars, debug, 
             forUpdate=forUpdate, shapes=contextShapes, 
-            serializer=serializer, cache=queryCache)
+            serializer=serializer, cache=queryCache, executor=executor,
+            sortBufferRows=sortBufferRows)
     result = ast.evaluate(engine.SimpleQueryEngine(),queryContext)
     if explain:
         result.explain(explain)
@@ -223,7 +658,8 @@ class QueryContext(object):
     complexPredicateHack = False
     
     def __init__(self, initModel, ast, explain=False, bindvars=None, debug=False,
-            depth=0, forUpdate=False, shapes=None, serializer=None, cache=None):
+            depth=0, forUpdate=False, shapes=None, serializer=None, cache=None,
+            executor=None, sortBufferRows=None):
         self.initialModel = initModel
         self.currentTupleset = initModel        
         self.explain=explain
@@ -233,10 +669,13 @@ class QueryContext(object):
         self.depth=depth
         self.forUpdate = forUpdate
         self.constructStack = []
+        self.pushdownSemijoins = {}
         self.engine = None        
         self.accumulate = {}
         self.shapes = shapes or self.defaultShapes.copy()
         self.serializer = serializer
+        self.executor = executor
+        self.sortBufferRows = sortBufferRows
         if cache is None:            
             self.objCache = {}
         else:
@@ -245,11 +684,12 @@ class QueryContext(object):
     def __copy__(self):
         copy = QueryContext(self.initialModel,self.ast,self.explain,self.bindvars,
             self.debug, self.depth, self.forUpdate, self.shapes, 
-            self.serializer, self.objCache)
+            self.serializer, self.objCache, self.executor, self.sortBufferRows)
         copy.currentTupleset = self.currentTupleset
         copy.currentValue = self.currentValue
         copy.currentRow = self.currentRow
         copy.constructStack = self.constructStack
+        copy.pushdownSemijoins = self.pushdownSemijoins
         copy.engine = self.engine
         #don't copy other attributes
         return copy
@@ -8,14 +8,14 @@ Defines the evaluation engine, which, given an jql ast and a query context,
 returns a generator which yields the results of the query.
 """
 
-import operator, copy, sys, pprint, itertools
+import operator, copy, sys, pprint, itertools, heapq, tempfile, cPickle
 
 from vesper.query import jqlAST
 from vesper.data import base
 from vesper.utils import flattenSeq, flatten, debugp
 from vesper import pjson
 from vesper.query import *
-from vesper.query.operations import validateRowShape, SimpleTupleset, MutableTupleset, IterationJoin
+from vesper.query.operations import validateRowShape, SimpleTupleset, MutableTupleset, IterationJoin, HashJoin, MergeJoin
 from vesper.backports import product
 
 #############################################################
@@ -46,16 +46,15 @@ def getColumns(keypos, row, tableType=Tupleset, outerjoin=False, includekey=Fals
     >>> list( getColumns((1,1), t, list) ) #group by 'c'
     [([('c1', 'd1')], ['a1', 'b1']), ([('c2', 'd1')], ['a1', 'b2'])]
     """
-    keypos = list(keypos)
-    pos = keypos.pop(0)
-    cols = []
-    for i, cell in enumerate(row):
-        if i == pos:
-            keycell = cell
-            if includekey:
-                cols.append(cell)
-        else:
-            cols.append(cell)
+    pos = keypos[0]
+    keypos = keypos[1:]
+    keycell = row[pos]
+    #copy the cells with slices rather than cell by cell
+    if includekey:
+        cols = list(row)
+    else:
+        cols = list(row[:pos])
+        cols.extend(row[pos+1:])
     assert outerjoin or keycell
     if not keypos:
         yield keycell, cols
@@ -187,29 +186,104 @@ def chooseColumns(groupby, columns, includekey=False):
         outputcolumns.append(groupbycol) #goes last
     return MutableTupleset(columns=outputcolumns)
 
-def groupbyOrdered(tupleset, groupby, debug=False):
+def groupbyOrdered(tupleset, groupby, debug=False, outerjoin=False, includekey=False):
     '''
     More efficient version of groupbyUnordered -- use if the tupleset is
-    ordered by column in the given pos
+    ordered by column in the given pos. The groups are yielded in that order
+    (and as soon as they are complete).
     '''
     previous = None
+    vals = None
     for row in tupleset:
-        cols = []
-        keycell = None
-        for i, cell in enumerate(row):
-            if i == groupby:
-                keycell = cell
-            else:
-                cols.append(cell)
-        assert keycell is not None
-        if keycell != previous:
-            yield [previous, vals]
-            vals = MutableTupleset()
-            previous = keycell
-        vals.append(cols)
-    if previous is not None:
+        if debug: validateRowShape(tupleset.columns, row)
+        for key, outputrow in getColumns(groupby, row, outerjoin=outerjoin, includekey=includekey):
+            if vals is None or key != previous:
+                if vals is not None:
+                    yield [previous, vals]
+                vals = MutableTupleset()
+                previous = key
+            vals.append(outputrow)
+    if vals is not None:
         yield [previous, vals]
 
+class _Descending(object):
+    '''
+    Wraps a sort key so that it sorts in reverse order, letting columns
+    sorted in different directions share one key instead of a `cmp` function.
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __reduce__(self):
+        return (_Descending, (self.value,))
+
+def _writeRun(entries):
+    run = tempfile.TemporaryFile()
+    for entry in entries:
+        cPickle.dump(entry, run, cPickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+def _readRun(run):
+    while True:
+        try:
+            yield cPickle.load(run)
+        except EOFError:
+            return
+
+def _popEntries(heap):
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)
+
+def externalSort(rows, key, maxRows=None, lazy=False):
+    '''
+    Yields the rows sorted by `key` (stable), keeping at most `maxRows` rows
+    in memory: whenever that many have been read they are sorted and written
+    to a temporary file and the sorted runs are merged as the rows are
+    yielded. Rows that are spilled (and their keys) must be picklable.
+    If `maxRows` is None the rows are sorted in memory.
+    If `lazy` is True the rows left in memory are put in a heap instead of
+    being sorted so only the rows that are consumed are sorted.
+    '''
+    runs = []
+    buffer = []
+    try:
+        for i, row in enumerate(rows):
+            #include the row's index so that rows with equal keys keep their
+            #order and the rows themselves are never compared
+            buffer.append( (key(row), i, row) )
+            if maxRows is not None and len(buffer) >= maxRows:
+                buffer.sort()
+                runs.append(_writeRun(buffer))
+                buffer = []
+        if lazy:
+            entries = _popEntries(buffer)
+        else:
+            buffer.sort()
+            entries = buffer
+        if runs:
+            entries = heapq.merge(entries, *[_readRun(run) for run in runs])
+        for entry in entries:
+            yield entry[2]
+    finally:
+        for run in runs:
+            run.close()
+
 #############################################################
 ################ Query Functions ############################
 #############################################################
@@ -223,7 +297,8 @@ class QueryFuncs(object):
 
     def addFunc(self, name, func, type=None, opFactory=None, cost=None, 
                             needsContext=False, lazy=False, checkForNulls=9999,
-                            isAggregate=False, initialValue=None, finalFunc=None):
+                            isAggregate=False, initialValue=None, finalFunc=None,
+                            combineFunc=None):
         if isinstance(name, (unicode, str)):
             name = (EMPTY_NAMESPACE, name)
         if cost is None or callable(cost):
@@ -233,7 +308,8 @@ class QueryFuncs(object):
         self.SupportedFuncs[name] = jqlAST.QueryFuncMetadata(func, type, 
                     opFactory, costFunc=costfunc, needsContext=needsContext, 
                     lazy=lazy, checkForNulls=checkForNulls, isAggregate=isAggregate,
-                    initialValue=initialValue, finalFunc=finalFunc)
+                    initialValue=initialValue, finalFunc=finalFunc,
+                    combineFunc=combineFunc)
 
     def getOp(self, name, *args, **kw):
         if isinstance(name, (unicode, str)):
@@ -480,6 +556,13 @@ def _aggAvg(x, y):
     else:
         return len(x) and (x[0]+ safeFloat(y), x[1]+1.0) or (safeFloat(y),1.0)
 
+def _aggAvgCombine(x, y):
+    if not y:
+        return x
+    if not x:
+        return y
+    return (x[0]+y[0], x[1]+y[1])
+
 def _aggCount(context, x, y):
     if context.groupby:
         if y == jqlAST.Project('*') or context.groupby.args[0] == y:
@@ -508,18 +591,24 @@ class SimpleQueryEngine(object):
     queryFunctions.addFunc('isref', lambda a: isinstance(a, base.ResourceUri), BooleanType)
     #aggregate funcs follow the semantics described here:
     #http://www.sqlite.org/lang_aggfunc.html
-    for name, func, initialValue, finalFunc in [
+    #(a combineFunc of True means the func can also combine partial results)
+    for name, func, initialValue, finalFunc, combineFunc in [
         ('sum', lambda x,y: y is not None and (
-                x and x+safeFloat(y) or safeFloat(y)) or x, None, None),
+                x and x+safeFloat(y) or safeFloat(y)) or x, None, None, True),
         ('total', lambda x,y: y is not None and (
-                x and x+float(y) or safeFloat(y)) or x, 0, None),
-        ('avg', _aggAvg, (), lambda n, *a: len(n) and n[0]/n[1] or 0),
-        ('min', _aggMin, None, None),
-        ('max', _aggMax, None, None)]:
+                x and x+float(y) or safeFloat(y)) or x, 0, None, True),
+        ('avg', _aggAvg, (), lambda n, *a: len(n) and n[0]/n[1] or 0, 
+                                                            _aggAvgCombine),
+        ('min', _aggMin, None, None, True),
+        ('max', _aggMax, None, None, True)]:
+        if combineFunc is True:
+            combineFunc = func
         queryFunctions.addFunc(name, func, NumberType, lazy=False, 
-            isAggregate=True, initialValue=initialValue, finalFunc=finalFunc)
+            isAggregate=True, initialValue=initialValue, finalFunc=finalFunc,
+            combineFunc=combineFunc)
     queryFunctions.addFunc('count', _aggCount, NumberType, lazy=True,
-        needsContext=True, isAggregate=True, initialValue=0)
+        needsContext=True, isAggregate=True, initialValue=0, 
+        combineFunc=operator.add)
 
     def isPropertyList(self, context, v):
         '''
@@ -610,7 +699,14 @@ class SimpleQueryEngine(object):
             if op.where:
                 context.currentTupleset = op.where.evaluate(self, context)
             if op.groupby:
-                context.currentTupleset = op.groupby.evaluate(self, context)
+                aggregates = self._findHashAggregates(op)
+                if aggregates:
+                    context.currentTupleset = self._evalHashAggregate(op, 
+                                                        aggregates, context)
+                    #construct reads each group's values from its row
+                    context.finalizedAggs = True
+                else:
+                    context.currentTupleset = op.groupby.evaluate(self, context)
             if op.orderby:
                 context.currentTupleset = op.orderby.evaluate(self, context)
 
@@ -913,7 +1009,11 @@ class SimpleQueryEngine(object):
                                 v = self.buildObject(ccontext, ResourceUri(idvalue), True)
                             else:
                                 ccontext.finalizedAggs = context.finalizedAggs
-                                ccontext.accumulate = context.accumulate
+                                if context.finalizedAggs and op.parent.groupby:
+                                    #see _evalHashAggregate
+                                    ccontext.accumulate = row[-1]
+                                else:
+                                    ccontext.accumulate = context.accumulate
                                 ccontext.groupby = op.parent.groupby
                                 v = context.currentRow
                                 ccontext.currentTupleset = SimpleTupleset(v,
@@ -985,41 +1085,64 @@ class SimpleQueryEngine(object):
     def evalOrderBy(self, op, context):
         #XXX only order by if orderby is different then current order of tupleset
         tupleset = context.currentTupleset
-        tupleset = MutableTupleset(tupleset.columns, tupleset, hint=tupleset, op='order by')
 
-        assert all(isinstance(s.exp, jqlAST.Project) for s in op.args), 'only property name lists currently implemented'        
+        assert all(isinstance(s.exp, jqlAST.Project) for s in op.args), 'only property name lists currently implemented'
         #print 'c', tupleset.columns, [s.exp.name for s in op.args]
         def getpos(project):
             if project.isPosition():
                 return (project.name,)
             else:
-                return tupleset.findColumnPos(project.name) 
+                return tupleset.findColumnPos(project.name)
         positions = [getpos(s.exp) for s in op.args]
 
-        reverse = all(not s.asc for s in op.args) #all desc
-        if not reverse and not all(s.asc for s in op.args):
-            #mixed asc and desc
-            orders = [s.asc for s in op.args]
-            def orderbyCmp(row1, row2):
-                for pos, order in zip(positions, orders):
-                    v1 = flatten( (c[0] for c in getColumn(pos, row1)))
-                    v2 = flatten( (c[0] for c in getColumn(pos, row2)))
-                    c = cmp(v1,v2)
-                    if c == -1:
-                        return order and -1 or 1
-                    elif c == 1:
-                        return order and 1 or -1
-                return 0
-
-            tupleset.sort(cmp=orderbyCmp)
+        def extractKey(row):
+            return [flatten( (c[0] for c in getColumn(pos, row))) for pos in positions]
+
+        #each row's key is extracted once, descending columns are handled by
+        #wrapping their values so that the keys sort ascending
+        descending = [i for i, s in enumerate(op.args) if not s.asc]
+        reverse = len(descending) == len(op.args) #all desc
+        if reverse:
+            sortKey = lambda row: _Descending(extractKey(row))
+        elif descending:
+            def sortKey(row):
+                key = extractKey(row)
+                for i in descending:
+                    key[i] = _Descending(key[i])
+                return key
         else:
-            def extractKey(row):
-                return [flatten( (c[0] for c in getColumn(pos, row))) for pos in positions]
+            sortKey = extractKey
 
-            tupleset.sort(key=extractKey, reverse=reverse)
+        if op.parent.limit is not None:
+            return self._topN(tupleset, sortKey, context)
 
+        if context.sortBufferRows:
+            maxRows = context.sortBufferRows
+            return SimpleTupleset(
+                lambda: externalSort(tupleset, sortKey, maxRows),
+                columns=tupleset.columns, hint=tupleset,
+                op='external order by', debug=context.debug)
+
+        tupleset = MutableTupleset(tupleset.columns, tupleset, hint=tupleset, op='order by')
+        if reverse:
+            tupleset.sort(key=extractKey, reverse=True)
+        else:
+            tupleset.sort(key=sortKey)
         return tupleset
 
+    def _topN(self, tupleset, sortKey, context):
+        '''
+        With a limit only the first rows of the sorted result are needed (the 
+        limit plus the offset) so instead of sorting every row put them in a 
+        heap and pop rows from it as they are consumed. The construct can skip 
+        rows (e.g. property list resources) and read past the limit, this 
+        just pops more rows so the tupleset is only read once.
+        '''
+        maxRows = context.sortBufferRows or None
+        topN = lambda: externalSort(tupleset, sortKey, maxRows, lazy=True)
+        return SimpleTupleset(topN, columns=tupleset.columns, hint=tupleset,
+                                    op='top-n order by', debug=context.debug)
+
     def evalGroupBy(self, op, context):
         tupleset = context.currentTupleset
         label = op.name
@@ -1031,11 +1154,179 @@ class SimpleQueryEngine(object):
             ColumnInfo('#groupby', chooseColumns(position, tupleset.columns) )
         ] 
         debug = context.debug
+        if len(position) == 1 and position[0] == tupleset.orderedBy:
+            groupby = groupbyOrdered
+            orderedBy = 0 #ordered by the group by key
+        else:
+            groupby = groupbyUnordered
+            orderedBy = None
         return SimpleTupleset(
-            lambda: groupbyUnordered(tupleset, position, debug=debug and columns),
-            columns=columns, 
+            lambda: groupby(tupleset, position, debug=debug and columns),
+            columns=columns, orderedBy=orderedBy,
             hint=tupleset, op='groupby op on '+label,  debug=debug)
 
+    def _findHashAggregates(self, op):
+        '''
+        Returns the (construct property, aggregate function) pairs of a select
+        with a group by if the groups can be reduced as the rows are read 
+        instead of collecting each group's rows: each property must be either 
+        the group by key or an expression of aggregate functions that can be 
+        computed incrementally. Otherwise returns None.
+        '''
+        isAggregate = lambda o: isinstance(o, jqlAST.AnyFuncOp) and o.isAggregate()
+        label = op.groupby.name
+        if op.orderby and not all(isinstance(s.exp, jqlAST.Project) 
+                        and s.exp.name == label for s in op.orderby.args):
+            return None
+        aggregates = []
+        for prop in op.construct.args:
+            if isinstance(prop, jqlAST.ConstructSubject):
+                continue #not output with a group by
+            if not isinstance(prop, jqlAST.ConstructProp) or (prop.nameFunc 
+                                    and not prop.nameFunc.isIndependent()):
+                return None
+            value = prop.value
+            if isinstance(value, jqlAST.Project) and value.name == label:
+                continue
+            if not prop.hasAggFunc or not (isAggregate(value) 
+                            or value.isIndependent(exclude=isAggregate)):
+                return None
+            for agg in value.depthfirst(lambda o: not isAggregate(o)):
+                if not isAggregate(agg):
+                    continue
+                #lazy aggregates evaluate the group themselves, except count
+                if agg.metadata.lazy and agg.metadata.func is not _aggCount:
+                    return None
+                for child in agg.depthfirst():
+                    if child is not agg and (isAggregate(child) 
+                                        or isinstance(child, jqlAST.Select)):
+                        return None
+                aggregates.append( (prop, agg) )
+        return aggregates or None
+
+    def _evalHashAggregate(self, op, aggregates, context):
+        '''
+        Groups the rows like `evalGroupBy` but instead of collecting each 
+        group's rows, reduces its aggregate functions as the rows are read,
+        yielding a [key, {id(aggregate function) : value}] row for each group 
+        (construct uses the dictionary as the aggregates' finalized values).
+
+        If the rows are ordered by the group by key each group is yielded as 
+        soon as it is complete. Otherwise the groups are kept in a hash table
+        and, if there are more than `context.sortBufferRows` groups and each 
+        aggregate function can combine partial results, spilled to temporary
+        files sorted by key, which are merged once all the rows are read.
+        '''
+        tupleset = context.currentTupleset
+        label = op.groupby.name
+        position = tupleset.findColumnPos(label)
+        assert position is not None, 'cant find %s in %s %s' % (label, tupleset, tupleset.columns)
+        columns = [
+            ColumnInfo(label, object),
+            ColumnInfo('#aggregates', object)
+        ]
+        key = op.groupby.args[0]
+        star = jqlAST.Project('*')
+        aggs = [agg for prop, agg in aggregates]
+        ids = [id(agg) for agg in aggs]
+        #count(*) and count(key) just count the group's rows
+        counted = lambda agg: agg.metadata.lazy and agg.args[0] in (star, key)
+        props = []
+        for i, (prop, agg) in enumerate(aggregates):
+            if not props or props[-1][0] is not prop:
+                props.append( (prop, [], []) )
+            props[-1][1 + counted(agg)].append( (i, agg) )
+        combines = [agg.metadata.combineFunc for agg in aggs]
+        if all(combines):
+            maxGroups = context.sortBufferRows
+        else:
+            maxGroups = None
+
+        #evaluate the aggregates' arguments like evalAggregate does
+        ccontext = copy.copy(context)
+        ccontext.currentTupleset = SimpleTupleset((),
+            columns=chooseColumns(position, tupleset.columns).columns,
+            hint=tupleset, op='hash aggregate row', debug=context.debug)
+        def step(values, row):
+            ccontext.currentRow = row
+            for prop, evaluated, counts in props:
+                for i, agg in counts:
+                    values[i] += 1
+                if not evaluated:
+                    continue
+                ccontext.projectValues = None
+                projectValues = {}
+                for project in prop.projects:
+                    projectValues[project.name] = project.evaluate(self, ccontext)
+                ccontext.projectValues = projectValues
+                for i, agg in evaluated:
+                    v = flatten(agg.args[0].evaluate(self, ccontext), 
+                                                    flattenTypes=Tupleset)
+                    if agg.metadata.lazy: #count
+                        if v is not None:
+                            values[i] += 1
+                    else:
+                        values[i] = agg.metadata.func(values[i], v)
+
+        def initialValues():
+            return [agg.metadata.initialValue for agg in aggs]
+
+        def merge(groups):
+            previous = values = None
+            for k, partial in groups:
+                if values is not None and k == previous:
+                    values = [combine(a, b) for combine, a, b in 
+                                            zip(combines, values, partial)]
+                else:
+                    if values is not None:
+                        yield previous, values
+                    previous, values = k, partial
+            if values is not None:
+                yield previous, values
+
+        def aggregateOrdered():
+            previous = values = None
+            for row in tupleset:
+                for k, outputrow in getColumns(position, row):
+                    if values is None or k != previous:
+                        if values is not None:
+                            yield [previous, dict(zip(ids, values))]
+                        previous, values = k, initialValues()
+                    step(values, outputrow)
+            if values is not None:
+                yield [previous, dict(zip(ids, values))]
+
+        def aggregateUnordered():
+            groups = {}
+            runs = []
+            try:
+                for row in tupleset:
+                    for k, outputrow in getColumns(position, row):
+                        values = groups.get(k)
+                        if values is None:
+                            if maxGroups and len(groups) >= maxGroups:
+                                runs.append(_writeRun(sorted(groups.iteritems())))
+                                groups = {}
+                            values = groups[k] = initialValues()
+                        step(values, outputrow)
+                if runs:
+                    groups = merge(heapq.merge(sorted(groups.iteritems()),
+                                        *[_readRun(run) for run in runs]))
+                else:
+                    groups = groups.iteritems()
+                for k, values in groups:
+                    yield [k, dict(zip(ids, values))]
+            finally:
+                for run in runs:
+                    run.close()
+
+        if len(position) == 1 and position[0] == tupleset.orderedBy:
+            return SimpleTupleset(aggregateOrdered, columns=columns, orderedBy=0,
+                hint=tupleset, op='streaming aggregate on '+label, debug=context.debug)
+        else:
+            return SimpleTupleset(aggregateUnordered, columns=columns,
+                hint=tupleset, op='hash aggregate on '+label, debug=context.debug)
+
     def costGroupBy(self, op, context):
         return 1.0
 
@@ -1044,7 +1335,6 @@ class SimpleQueryEngine(object):
         group the given tupleset by the column specified by given join condition
         and return a tupleset whose first column is the group by key.
         '''
-        #XXX use groupbyOrdered if we know tupleset is ordered by groupby key
         position = tupleset.findColumnPos(joincond.position)
         assert position is not None, 'cant find %r in %s %s' % (
                     joincond.position, tupleset, tupleset.columns)
@@ -1059,10 +1349,17 @@ class SimpleQueryEngine(object):
                                 chooseColumns(position,tupleset.columns, includekey) )
         ]
         outerjoin = joincond.join in ('r')
+        if len(position) == 1 and position[0] == tupleset.orderedBy:
+            groupby = groupbyOrdered
+            orderedBy = 0 #ordered by the group by key
+            msg = 'ordered ' + msg
+        else:
+            groupby = groupbyUnordered
+            orderedBy = None
         return SimpleTupleset(
-            lambda: groupbyUnordered(tupleset, position,
+            lambda: groupby(tupleset, position,
                                     debug and columns, outerjoin, includekey),
-            columns=columns,
+            columns=columns, orderedBy=orderedBy,
             hint=tupleset, op=msg + repr((joincond.join, joincond.position)),  debug=debug)
 
     def reorderWithListInfo(self, context, op, listval):
@@ -1147,14 +1444,50 @@ class SimpleQueryEngine(object):
 
             current = self._groupby(result, joincond,debug=context.debug)
 
-    def _evalJoin(self, op, context):
-        args = sorted(op.args, key=lambda arg:
-            #put non-inner joins and filters with complex predicates last
-            #XXX: we should do semantic ordering earlier so it shows up in the ast
-            #and maybe mark each group so we can do this cost-based ordering per group
-            (getattr(arg.leftPosition, 'startswith', lambda s:False)('#@'),
+    def _joinOrderKey(self, arg, context):
+        #put non-inner joins and filters with complex predicates last
+        #XXX: we should do semantic ordering earlier so it shows up in the ast
+        #and maybe mark each group so we can do this cost-based ordering per group
+        dependent = not isinstance(arg.leftPosition, int)
+        if arg.join == 'i' and not dependent:
+            #the cheapest (i.e. smallest) inner join drives the join
+            cost = arg.op.cost(self, context)
+            reorder = self._isSingleValued(arg.op, context)
+        else:
+            #joins on labels need the labels to appear earlier in the join and
+            #the results of outer joins depend on their order, so only 
+            #reorder these by type
+            cost = isinstance(arg.op, jqlAST.Join) and 2.0 or 1.0
+            reorder = True
+        return (getattr(arg.leftPosition, 'startswith', lambda s:False)('#@'),
             getattr(arg.op, 'complexPredicates', False), arg.join != 'i',
-                                                arg.op.cost(self, context)) )
+            dependent, cost), reorder
+
+    def _orderJoins(self, args, context):
+        '''
+        Sort the join arguments so the cheapest inner join drives the join.
+        The results of inner joins on properties with more than one value 
+        per subject (e.g. lists) depend on the order they are joined in, so 
+        those keep their relative order, at the position of the cheapest.
+        '''
+        keys = {}
+        fixed = []
+        for arg in args:
+            key, reorder = self._joinOrderKey(arg, context)
+            keys[id(arg)] = key
+            if not reorder:
+                fixed.append(id(arg))
+        if fixed:
+            costs = {}
+            for key in [keys[argId] for argId in fixed]:
+                costs[key[:-1]] = min(costs.get(key[:-1], key[-1]), key[-1])
+            for argId in fixed:
+                key = keys[argId]
+                keys[argId] = key[:-1] + (costs[key[:-1]],)
+        return sorted(args, key=lambda arg: keys[id(arg)])
+
+    def _evalJoin(self, op, context):
+        args = self._orderJoins(op.args, context)
 
         tmpop = None
         if not args or args[0].join != 'i':
@@ -1178,6 +1511,17 @@ class SimpleQueryEngine(object):
         #lslice = slice( joincond.position, joincond.position+1)
         #rslice = slice( 0, 1) #curent tupleset
         #current = MergeJoin(result, current, lslice,rslice)
+        if self._canPushdown(context.currentTupleset, context):
+            self._findPushdownSemijoins(args, context)
+
+        #evaluate the branches that don't depend on the rows that precede 
+        #them concurrently with the first one 
+        #(debug output from multiple threads would be interleaved)
+        executor = context.executor
+        if executor is not None and (context.debug or not getattr(
+                            context.initialModel, 'concurrentReads', False)):
+            executor = None
+
         previous = None
         #print 'evaljoin', args
         while args:
@@ -1201,6 +1545,8 @@ class SimpleQueryEngine(object):
                 current = result
             else:
                 current = self._groupby(result, joincond,debug=context.debug)
+            if executor is not None and previous and fcontext is context:
+                current = self._evalConcurrently(current, executor, context)
             
             if previous:
                 def mergeColumns(left, right):
@@ -1355,14 +1701,45 @@ class SimpleQueryEngine(object):
                         'l', previous, indexToLeft, nullrows, leftpos, previous),
                                     columns,joincond.name,debug=context.debug)
                 else:
-                    previous = IterationJoin(previous, current, bindjoinFunc(
-                     joincond, current, indexToLeft, nullrows, leftpos, previous),
-                                    columns,joincond.name,debug=context.debug)
+                    joinFunc = bindjoinFunc(joincond, current, indexToLeft, 
+                                                nullrows, leftpos, previous)
+                    previous = self._chooseJoin(previous, current, joinFunc, 
+                                    leftpos, joincond, columns, context.debug)
             else:
                 previous = current
 
         return previous
 
+    def _evalConcurrently(self, tupleset, executor, context):
+        '''
+        Start reading the rows of the given tupleset on one of the executor's
+        threads and return a tupleset that yields those rows once they've 
+        all been read.
+        '''
+        task = executor.submit(list, tupleset)
+        return SimpleTupleset(lambda: iter(task.result()), 
+                    columns=tupleset.columns, orderedBy=tupleset.orderedBy,
+                    hint=tupleset, op='concurrent', debug=context.debug)
+
+    def _chooseJoin(self, left, right, joinFunc, leftpos, joincond, columns,
+                                                                    debug):
+        '''
+        Choose the join algorithm: nested loop if there's no join key (cross 
+        joins), a merge join if both sides are ordered by the join key,
+        otherwise a hash join. Note that the right side has already been 
+        grouped by its join key so its the first column.
+        '''
+        if joincond.join == 'x':
+            return IterationJoin(left, right, joinFunc, columns, joincond.name,
+                                                                debug=debug)
+        elif isinstance(leftpos, int) and left.orderedBy == leftpos and (
+                                                        right.orderedBy == 0):
+            return MergeJoin(left, right, joinFunc, leftpos, 0, columns, 
+                                                    joincond.name, debug=debug)
+        else:
+            return HashJoin(left, right, joinFunc, 0, columns, joincond.name,
+                                                                debug=debug)
+
     def _findSimplePredicates(self, op, context):
         simpleops = (jqlAST.Eq,) #only Eq supported for now
         complexargs = []
@@ -1400,6 +1777,123 @@ class SimpleQueryEngine(object):
             complexargs.pop()
         return simplefilter, complexargs
 
+    def _canPushdown(self, tupleset, context):
+        return (tupleset is context.initialModel and
+                getattr(tupleset, 'canHandlePushdownHints', False))
+
+    def _canOrderBySubject(self, tupleset, context):
+        return self._canPushdown(tupleset, context) or (
+            tupleset is context.initialModel and
+            getattr(tupleset, 'canHandleOrderbyHint', False))
+
+    def _findPushdownCondition(self, pred, context):
+        '''
+        Returns a condition for the model's 'where' hint if the predicate
+        compares the object with constant values, otherwise None.
+        '''
+        def isObject(arg):
+            return (isinstance(arg, jqlAST.Project) and arg.isPosition()
+                                                and arg.name == OBJECT)
+
+        if isinstance(pred, jqlAST.Cmp):
+            if pred.right is None:
+                return None
+            if isObject(pred.left) and pred.right.isIndependent():
+                cmpop, others = pred.op, [pred.right]
+            elif isObject(pred.right) and pred.left.isIndependent():
+                flip = { '<' : '>', '<=' : '>=', '>' : '<', '>=' : '<=' }
+                cmpop, others = flip[pred.op], [pred.left]
+            else:
+                return None
+        elif isinstance(pred, jqlAST.In):
+            if not isObject(pred.args[0]) or len(pred.args) < 2:
+                return None
+            for arg in pred.args[1:]:
+                if not arg.isIndependent():
+                    return None
+            cmpop, others = 'in', pred.args[1:]
+        else:
+            return None
+
+        values = [other.evaluate(self, context) for other in others]
+        #note: bool is a subclass of int
+        if [v for v in values if isinstance(v, bool)]:
+            return None
+        if not [v for v in values if not isinstance(v, (int, long, float))]:
+            #only numeric values can be less or greater than a number
+            objectTypes = pjson.NUMERIC_TYPES
+        elif not [v for v in values if not isinstance(v, (str, unicode))]:
+            #only plain literals are converted to strings
+            objectTypes = (base.OBJECT_TYPE_LITERAL,)
+        else:
+            return None
+        return (cmpop, tuple(values), objectTypes)
+
+    def _findPushdownConditions(self, op, complexargs, context):
+        '''
+        Returns the list of conditions for the model's 'where' hint that rows
+        need to satisfy to pass the filter.
+        '''
+        if op.complexPredicates or [a for a in op.args if a.saveValue]:
+            return []
+        conditions = []
+        for pred in complexargs:
+            for arg in jqlAST.flattenOp(pred, jqlAST.And):
+                condition = self._findPushdownCondition(arg, context)
+                if condition:
+                    conditions.append(condition)
+        return conditions
+
+    def _findPushdownSemijoins(self, args, context):
+        '''
+        Filters inner joined on the subject can only contribute rows whose
+        subject matches all the other filters, so pass each filter's conditions
+        to the others as a 'semijoins' hint.
+        '''
+        labels = ('subject', 'predicate', 'object', 'objecttype', 'context')
+        patterns = []
+        for joincond in args:
+            op = joincond.op
+            if (joincond.join != 'i' or joincond.position != '#0' 
+                    or joincond.leftPosition != SUBJECT
+                    or not isinstance(op, jqlAST.Filter) 
+                    or op.complexPredicates):
+                continue
+            simplefilter, complexargs = self._findSimplePredicates(op, context)
+            columns = {}
+            for pos, value in simplefilter.items():
+                if pos == SUBJECT and isinstance(value, base.ResourceUri):
+                    value = value.uri
+                columns[labels[pos]] = value
+            conditions = self._findPushdownConditions(op, complexargs, context)
+            patterns.append( (op, (columns, conditions)) )
+
+        for op, pattern in patterns:
+            context.pushdownSemijoins[id(op)] = [other for otherop, other
+                in patterns if otherop is not op and (other[0] or other[1])]
+
+    def _isLimitedScan(self, op):
+        '''
+        Returns True if the given filter is the only source of rows for a 
+        select with a limit, and so only the statements about the first 
+        subjects it finds are needed (if rows are constructed as they are
+        read). Selects with just an offset are included so that the rows it
+        skips are the same as with a limit.
+        '''
+        joincond = op.parent
+        if (not isinstance(joincond, jqlAST.JoinConditionOp) 
+                or joincond.join != 'i' or joincond.position != '#0'):
+            return False
+        join = joincond.parent
+        if [arg for arg in join.args if arg is not joincond]:
+            return False
+        select = join.parent
+        return (isinstance(select, jqlAST.Select) and select.where is join 
+            and (select.limit is not None or select.offset) 
+            and not select.groupby 
+            and not select.orderby and not select.construct.hasAggFunc 
+            and not select.mergeall)
+
     def evalFilter(self, op, context):
         '''
         Find slots
@@ -1419,15 +1913,52 @@ class SimpleQueryEngine(object):
                 yield row[pos]
 
         tupleset = context.currentTupleset        
+
+        #let the model skip rows that the complex predicates would reject
+        hints = None
+        if not op.isIndependent() and self._canPushdown(tupleset, context):
+            hints = {}
+            where = self._findPushdownConditions(op, complexargs, context)
+            if where:
+                hints['where'] = where
+            semijoins = context.pushdownSemijoins.get(id(op))
+            if semijoins:
+                hints['semijoins'] = semijoins
+
+        sourceOrderedBy = tupleset.orderedBy
+        if (sourceOrderedBy != SUBJECT and not (complexargs and op.isIndependent())
+                and self._canOrderBySubject(tupleset, context) 
+                and self._isLimitedScan(op)):
+            #if the statements are sorted by subject the groupby can yield 
+            #each subject as soon as its read, so the scan can stop once 
+            #the limit is reached
+            #(this also means an unordered limit selects the first subjects
+            #in id order, see "LIMIT and OFFSET" in doc/source/spec.rst)
+            hints = hints or {}
+            hints['orderby'] = ['subject']
+            sourceOrderedBy = SUBJECT
         
+        #filtering preserves the order of the rows 
+        #but the colmap changes the column positions 
+        orderedBy = None
+        for i, (label, pos) in enumerate(op.labels):
+            if pos == sourceOrderedBy:
+                orderedBy = i
+                break
+
         #first apply all the simple predicates that we assume are efficient
-        if simplefilter or not complexargs:
+        if simplefilter or hints or not complexargs:
             #XXX: optimization: if cost is better filter on initialmodel
             #and then find intersection of result and currentTupleset
+            if complexargs:
+                simpleOrderedBy = sourceOrderedBy
+            else:
+                simpleOrderedBy = orderedBy
             tupleset = SimpleTupleset(
-                lambda tupleset=tupleset: tupleset.filter(simplefilter),
+                lambda tupleset=tupleset: tupleset.filter(simplefilter, hints),
                 columns = complexargs and tupleset.columns or columns,
                 colmap = not complexargs and colmap or None,
+                orderedBy = simpleOrderedBy,
                 hint=tupleset, op='selectWithValue1', debug=context.debug)
 
         if not complexargs:            
@@ -1479,7 +2010,7 @@ class SimpleQueryEngine(object):
         opmsg = 'complexfilter:'+ str(complexargs)
         
         return SimpleTupleset(filterRows, hint=tupleset,columns=columns,
-                colmap=colmap, op=opmsg, debug=context.debug)
+                colmap=colmap, orderedBy=orderedBy, op=opmsg, debug=context.debug)
 
     def buildObject(self, context, v, handleNil):
         if handleNil and v == NilResource:
@@ -1604,57 +2135,85 @@ class SimpleQueryEngine(object):
     def costLabel(self, op, context):
         return 1.0
 
-    def costFilter(self, op, context):
-        return 1.0 #XXX
+    def _getPredicateStatistics(self, context):
+        return getattr(context.initialModel, 'getPredicateStatistics', None)
 
-        #simple cheaper than complex
-        #dependent cheaper then
-        #subject cheaper object cheaper than predicate
-        SIMPLECOST = [1, 4, 2]
-        #we have to evaluate each row
-        COMPLEXCOST = []
-        #we have to evaluate each row
-        DEPENDANTCOST = []
-
-        cost = 0 #no-op
-        for i, pred in enumerate(op.args):
-            if not pred:
+    def _getFixedPositions(self, op, context):
+        '''
+        Returns a dictionary of the positions the filter compares to a value
+        that doesn't depend on the row and the predicate it matches (or None).
+        '''
+        fixed = {}
+        for pred in op.args:
+            if not isinstance(pred, jqlAST.Eq):
                 continue
-            assert pred.getType() == BooleanType
-            assert pred.left
-            #XXX dont yet support something like: where customcompare(prop1, prop2)
-            assert pred.right is None, 'multi-prop compares not yet implemented'
-
-            if pred.left.isIndependent():
-                if isinstance(pred, jqlAST.Eq): #simple
-                    positioncost = SIMPLECOST
-                else:
-                    positioncost = COMPLEXCOST
+            if isinstance(pred.left, jqlAST.Project) and pred.right.isIndependent():
+                proj, other = pred.left, pred.right
+            elif isinstance(pred.right, jqlAST.Project) and pred.left.isIndependent():
+                proj, other = pred.right, pred.left
             else:
-                positioncost = DEPENDANTCOST
+                continue
+            if proj.isPosition() and proj.name not in fixed:
+                fixed[proj.name] = other
+
+        predicate = None
+        other = fixed.get(PROPERTY)
+        #only evaluate values that are cheap to compute
+        if isinstance(other, (jqlAST.Constant, jqlAST.BindVar)):
+            predicate = other.evaluate(self, context)
+            if not isinstance(predicate, (str, unicode)):
+                predicate = None
+        return fixed, predicate
+
+    def _isSingleValued(self, op, context):
+        '''
+        Returns True if the statistics show that the filter matches at most
+        one statement per subject.
+        '''
+        getStats = self._getPredicateStatistics(context)
+        if not getStats or not isinstance(op, jqlAST.Filter):
+            return False
+        fixed, predicate = self._getFixedPositions(op, context)
+        if predicate is None:
+            return False
+        stats = getStats(predicate)
+        return stats is not None and stats.count <= stats.subjects
 
-            cost += (pred.left.cost(self, context) * positioncost[i])
+    def estimateFilterRows(self, op, context):
+        '''
+        Use the model's statistics to estimate the number of statements that
+        match the filter's simple predicates.
+        Returns None if the model doesn't maintain statistics.
+        '''
+        getStats = self._getPredicateStatistics(context)
+        if not getStats:
+            return None
+        fixed, predicate = self._getFixedPositions(op, context)
+        stats = getStats(predicate)
+        if stats is None:
+            return None
+        if SUBJECT in fixed:
+            return float(stats.count) / max(stats.subjects, 1)
+        elif OBJECT in fixed:
+            return float(stats.count) / max(stats.objects, 1)
+        else:
+            return float(stats.count)
 
-        return cost
+    def costFilter(self, op, context):
+        rows = self.estimateFilterRows(op, context)
+        if rows is None:
+            return 1.0 #XXX no statistics available
+        return rows
 
     def costJoin(self, op, context):
-        return 2.0 #XXX
-
-        args = list(flattenSeq(op.args))
-        #like costAndOp:
-        if args:                    
-            total = reduce(operator.add, [a.cost(self, context) for a in args], 0.0)
-            cost = total / len(args)
-        else:
-            cost = 1.0
-
-        if op.finalPosition == 1: #assume matching predicates are more expensive
-            cost += 5
-        if op.finalPosition == OBJTYPE_POS:
-            cost += 10
-        #if op.joinPosition < 0: #its absolute:
-        #    cost /= 10          #independent thus cheaper?
-        return cost 
+        if not self._getPredicateStatistics(context):
+            return 2.0 #XXX
+        #an inner join can't have more rows than its smallest inner join argument
+        costs = [arg.op.cost(self, context) for arg in op.args 
+                    if isinstance(arg, jqlAST.JoinConditionOp) and arg.join == 'i']
+        if costs:
+            return min(costs)
+        return 0.0
 
     def evalConstant(self, op, context):
         return op.value
@@ -1732,7 +2291,7 @@ class SimpleQueryEngine(object):
             assert isinstance(v, list)
             reduction = reduce(op.metadata.func, v, op.metadata.initialValue)
             if op.metadata.finalFunc:
-                return finalFunc(reduction)
+                return op.metadata.finalFunc(reduction, *op.args)
             else:
                 return reduction
         else:
@@ -766,7 +766,8 @@ class QueryFuncMetadata(object):
 
     def __init__(self, func, type=None, opFactory=None, isIndependent=True,
             costFunc=None, needsContext=False, lazy=False, checkForNulls=0,
-            isAggregate=False, initialValue=None, finalFunc=None):
+            isAggregate=False, initialValue=None, finalFunc=None,
+            combineFunc=None):
         self.func = func
         self.type = type or ObjectType
         self.isIndependent = isIndependent
@@ -777,6 +778,8 @@ class QueryFuncMetadata(object):
         self.isAggregate = isAggregate
         self.initialValue = initialValue
         self.finalFunc = finalFunc
+        #combines two partial results of an aggregate function
+        self.combineFunc = combineFunc
         self.checkForNulls = checkForNulls
 
 AnyFuncOp.defaultMetadata = QueryFuncMetadata(None)
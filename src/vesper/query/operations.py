@@ -45,7 +45,7 @@ class SimpleTupleset(Tupleset):
     '''
     
     def __init__(self, generatorFuncOrSeq=(),hint=None, op='',
-                                columns=None, debug=False, colmap=None):
+                columns=None, debug=False, colmap=None, orderedBy=None):
         if not callable(generatorFuncOrSeq):
             #assume its a sequence
             self.generator = lambda: iter(generatorFuncOrSeq)
@@ -60,6 +60,7 @@ class SimpleTupleset(Tupleset):
         self.cache = None
         self.columns = columns
         self.colmap = colmap
+        self.orderedBy = orderedBy
         if debug:
             self._filter = self.filter
             self.filter = self._debugFilter
@@ -196,6 +197,40 @@ def crossJoin(rowA,tableB,lastRowA):
     for row in tableB:
         yield row
     
+class HashIndex(base.Tupleset):
+    '''
+    A hash table of the rows of a tupleset keyed by the value of the given 
+    column. The whole tupleset is read when the index is created.
+    '''
+
+    def __init__(self, tupleset, keypos=0):
+        self.tupleset = tupleset
+        self.keypos = keypos
+        self.columns = tupleset.columns
+        self.index = {}
+        self.rows = []
+        for row in tupleset:
+            self.index.setdefault(row[keypos], []).append(row)
+            self.rows.append(row)
+
+    def filter(self, conditions=None, hints=None):
+        if conditions and self.keypos in conditions:
+            rows = self.index.get(conditions[self.keypos], ())
+        else:
+            rows = self.rows
+        for row in rows:
+            if conditions:
+                for pos, test in conditions.iteritems():
+                    if row[pos] != test:
+                        break #no match
+                else:
+                    yield row
+            else:
+                yield row
+
+    def size(self):
+        return len(self.rows)
+
 class Join(base.Tupleset):
     '''
     Corresponds to an join of two tuplesets
@@ -208,6 +243,8 @@ class Join(base.Tupleset):
         self.joinFunc = joinFunc
         self.columns = columns
         self.msg = msg
+        #the rows are generated in the order of the left tupleset
+        self.orderedBy = left.orderedBy
         self.debug = debug
         if debug:
             self._filter = self.filter
@@ -223,6 +260,19 @@ class Join(base.Tupleset):
         for row in results:
             yield row
 
+    def _joinRows(self, joinedRows, conditions):
+        for left, right in joinedRows:
+            row = left + right
+            if conditions:
+                for key, value in conditions.iteritems():
+                    if flatten(row[key]) != value: #XXX
+                        #print '@@@@skipped@@@', row[key], '!=', repr(value), flatten(row[key])
+                        break
+                else:
+                    yield row                
+            else:
+                yield row
+
     def getJoinType(self):
         return self.joinFunc.__doc__
 
@@ -238,67 +288,92 @@ class Join(base.Tupleset):
             
 class IterationJoin(Join):
     '''
-    Corresponds to an join of two tuplesets
-    Can be a inner join or right outer join, depending on joinFunc
+    Nested loop join: `joinFunc` is called with each row of the left 
+    tupleset and the right tupleset.
     '''
         
     def filter(self, conditions=None, hints=None):
-        for left, right in joinTuples(self.left, self.right, self.joinFunc):
-            row = left + right
-            if conditions:
-                for key, value in conditions.iteritems():
-                    if flatten(row[key]) != value: #XXX
-                        #print '@@@@skipped@@@', row[key], '!=', repr(value), flatten(row[key])
-                        break
-                else:
-                    yield row                
-            else:
-                yield row
+        return self._joinRows(joinTuples(self.left, self.right, self.joinFunc),
+                                                                    conditions)
+
+class HashJoin(Join):
+    '''
+    Build a hash table of the right tupleset on its join key column then probe
+    it with each row of the left tupleset. `joinFunc` is called with the left 
+    row and a `HashIndex` of the right tupleset.
+    '''
+
+    def __init__(self, left, right, joinFunc, rightpos=0, columns=None,
+                                                    msg='', debug=False):
+        Join.__init__(self, left, right, joinFunc, columns, msg, debug)
+        self.rightpos = rightpos
+        self.table = None
+
+    def filter(self, conditions=None, hints=None):
+        if self.table is None:
+            #build phase, done once since the right side doesn't change
+            self.table = HashIndex(self.right, self.rightpos)
+        return self._joinRows(joinTuples(self.left, self.table, self.joinFunc),
+                                                                    conditions)
+
+    def __repr__(self):
+        return Join.__repr__(self) + ' (hash on %s)' % self.rightpos
 
 class MergeJoin(Join):
     '''
     Assuming the left and right tables are ordered by the columns 
     used by the join condition, do synchronized walk through of each table.
+    `joinFunc` is called with each left row and a tupleset containing the 
+    right rows whose key matches.
     '''
         
-    def __init__(self, left, right, lpos, rpos, msg=''):
-        self.left = left
-        self.right = right
-        self.leftJoinSlice = lpos
-        self.rightJoinSlice = rpos
-        self.msg = msg
-        
-    def _filter(self, conditions=None):
-        li = iter(self.left)
-        ri = iter(self.right)
-        lpos = self.leftJoinSlice 
-        rpos=self.rightJoinSlice
-        
-        l = li.next(); r = ri.next()
-        while 1:        
-            while l[lpos] < r[rpos]:
-                l = li.next() 
-            while r[rpos] < l[lpos]:
-                r = ri.next()        
-            if l[lpos] == r[rpos]:
-                #inner join 
-                if conditions:
-                    row = l + r
-                    for key, value in conditions.iteritems():
-                        if row[key] != value:
-                            break
-                    else:
-                        yield l, r
-                else:
-                    yield l, r
-                l = li.next();
+    def __init__(self, left, right, joinFunc, leftpos, rightpos=0, 
+                                        columns=None, msg='', debug=False):
+        Join.__init__(self, left, right, joinFunc, columns, msg, debug)
+        self.leftpos = leftpos
+        self.rightpos = rightpos
+
+    def _merge(self):
+        lpos = self.leftpos
+        rpos = self.rightpos
+        rightRows = iter(self.right)
+        pending = None #the next right row 
+        matchKey = lastKey = notfound = object()
+        matches = None
+        lastRowA = None
+        for leftRow in self.left:
+            key = leftRow[lpos]
+            if key != matchKey:
+                if lastKey is not notfound and key < lastKey:
+                    #not ordered after all, so start the walk over
+                    rightRows = iter(self.right)
+                    pending = None
+                rows = []
+                while True:
+                    if pending is None:
+                        pending = next(rightRows, None)
+                        if pending is None:
+                            break #right table exhausted
+                    rkey = pending[rpos]
+                    if rkey > key:
+                        break
+                    if rkey == key:
+                        rows.append(pending)
+                    pending = None
+                matches = MutableTupleset(self.right.columns, rows)
+                matchKey = key
+            lastKey = key
+            for resultRow in self.joinFunc(leftRow, matches, lastRowA):
+                if resultRow is not None:
+                    yield leftRow, resultRow
+                lastRowA = leftRow, resultRow
     
     def filter(self, conditions=None, hints=None):
-        for left, right in self._filter(conditions):
-            yield left+right
+        return self._joinRows(self._merge(), conditions)
 
-    def getJoinType(self):
-        return 'ordered merge'
+    def __repr__(self):
+        return Join.__repr__(self) + ' (merge on %s, %s)' % (self.leftpos, 
+                                                            self.rightpos)
 
 class Union(base.Tupleset):
     '''
@@ -92,6 +92,7 @@ class MRUCache:
         self.invalidateDict = weakref.WeakValueDictionary()
         self.maxValueSize = maxValueSize
         self.digestKey = digestKey
+        self.evictions = 0 #count of nodes replaced because the cache was full
         
     def getValue(self, *args, **kw):  # magically hidden whether lookup or calc
         """
@@ -222,6 +223,7 @@ class MRUCache:
                     self.mru = node                
             else:
                 #cache full, replace the lru node
+                self.evictions += 1
                 lru = self.mru.newer; #newer than mru circularly goes to lru node
                 # position of lru node is correct for becoming mru so
                 # just replace value and hkey #                
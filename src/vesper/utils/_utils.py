@@ -1027,3 +1027,136 @@ class Worker(object):
 
     def doStuff(self, msg):
         return True
+
+class ReadWriteLock(object):
+    '''
+    A lock that can be held by any number of readers or by a single writer.
+    Once a writer is waiting new readers block until it is done, so a steady 
+    stream of readers can't starve the writers. (Not reentrant.)
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waitingWriters = 0
+
+    def acquireRead(self):
+        self._cond.acquire()
+        try:
+            while self.writer or self.waitingWriters:
+                self._cond.wait()
+            self.readers += 1
+        finally:
+            self._cond.release()
+
+    def releaseRead(self):
+        self._cond.acquire()
+        try:
+            assert self.readers > 0, 'read lock not held'
+            self.readers -= 1
+            if not self.readers:
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def acquireWrite(self):
+        self._cond.acquire()
+        try:
+            self.waitingWriters += 1
+            try:
+                while self.writer or self.readers:
+                    self._cond.wait()
+            finally:
+                self.waitingWriters -= 1
+            self.writer = True
+        finally:
+            self._cond.release()
+
+    def releaseWrite(self):
+        self._cond.acquire()
+        try:
+            assert self.writer, 'write lock not held'
+            self.writer = False
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+class PoolTask(object):
+    '''
+    A function call submitted to a `ThreadPool`.
+    '''
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.started = False
+        self.value = None
+        self.excInfo = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def run(self):
+        self._lock.acquire()
+        try:
+            if self.started:
+                return
+            self.started = True
+        finally:
+            self._lock.release()
+        try:
+            self.value = self.func(*self.args)
+        except:
+            self.excInfo = sys.exc_info()
+        self.func = self.args = None
+        self._done.set()
+
+    def result(self):
+        '''
+        Wait for the call to finish and return its value (or raise its
+        exception). If no pool thread has started the call yet it is run in 
+        the calling thread instead.
+        '''
+        self.run()
+        self._done.wait()
+        if self.excInfo:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.value
+
+class ThreadPool(object):
+    '''
+    A fixed number of daemon threads that run the functions passed to 
+    `submit()`. Because `PoolTask.result()` runs a task that hasn't been 
+    started yet itself, a task can wait on other tasks submitted to the same
+    pool without deadlocking when all the threads are busy.
+    '''
+
+    def __init__(self, threads, name='pool-worker'):
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._runTasks, 
+                                        name='%s-%d' % (name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        "Returns a `PoolTask` that calls `func(*args)` in one of the threads"
+        task = PoolTask(func, args)
+        self.queue.put(task)
+        return task
+
+    def _runTasks(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            task.run()
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
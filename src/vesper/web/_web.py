@@ -5,7 +5,8 @@ vesper.web
 ==========
 '''
 from vesper import utils
-import time, sys, mimetypes
+import time, sys, mimetypes, threading, Queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 
 from vesper.app import RequestProcessor
 
@@ -55,6 +56,11 @@ class HTTPRequestProcessor(RequestProcessor):
         mimetypes.types_map['.htc']='text/x-component'
 
         super(HTTPRequestProcessor,self).__init__(*args, **kwargs)
+        if self.server_threads:
+            #read-only requests share this lock, all others hold it exclusively
+            self.rwlock = utils.ReadWriteLock()
+        else:
+            self.rwlock = None
 
     def handleHTTPRequest(self, kw):
         if self.requestsRecord is not None:
@@ -170,17 +176,58 @@ class HTTPRequestProcessor(RequestProcessor):
         """
 
         kw = self.requestFromEnviron(environ)
-        response = self.handleHTTPRequest(kw)
-        _responseHeaders = kw['_responseHeaders']
-        _responseCookies = kw['_responseCookies']
-        
-        status = _responseHeaders.pop('_status')
-        headerlist = _responseHeaders.items()
-        if len(_responseCookies):
-            headerlist += [('Set-Cookie', m.OutputString() )
-                            for m in _responseCookies.values()]
+        release = afterRelease = None
+        if self.rwlock:
+            if self.is_read_only_request(kw):
+                kw['__readOnly'] = True
+                #stores with snapshot reads don't need readers to wait for
+                #the writer to finish
+                stores = self.stores.values()
+                if not all(getattr(store, 'snapshotReads', False) 
+                                                    for store in stores):
+                    if all(getattr(store.model, 'concurrentReads', False)
+                                                    for store in stores):
+                        self.rwlock.acquireRead()
+                        release = self.rwlock.releaseRead
+                    else:
+                        #a model that can't be read by several threads at 
+                        #once (e.g. SqliteStore without wal) 
+                        self.rwlock.acquireWrite()
+                        release = self.rwlock.releaseWrite
+            else:
+                self.rwlock.acquireWrite()
+                release = self.rwlock.releaseWrite
+                #what the request's transactions defer until their lock is
+                #released (e.g. waiting for a group commit to be flushed)
+                #waits for this lock too
+                afterRelease = kw['__afterRelease'] = []
+        try:
+            response = self.handleHTTPRequest(kw)
+            _responseHeaders = kw['_responseHeaders']
+            _responseCookies = kw['_responseCookies']
+            
+            status = _responseHeaders.pop('_status')
+            headerlist = _responseHeaders.items()
+            if len(_responseCookies):
+                headerlist += [('Set-Cookie', m.OutputString() )
+                                for m in _responseCookies.values()]
+
+            start_response(status, headerlist)
+            if hasattr(response, 'next'): #an iterator, e.g. a streamed response
+                if release:
+                    #the iterator may still read the store, keep the lock
+                    #until the server closes it
+                    response = _ReleasingIterator(response, release)
+                    release = None
+                return response
+        finally:
+            if release:
+                release()
+            #a streamed response still holds the lock but the funcs must
+            #finish before it's sent
+            while afterRelease:
+                afterRelease.pop(0)()
 
-        start_response(status, headerlist)
         if hasattr(response, 'read'): #its a file not a string
             block_size = 8192
             if 'wsgi.file_wrapper' in environ:
@@ -245,8 +292,11 @@ Please check the URL to ensure that the path is correct.</p>
 
     def runWsgiServer(self, port=8000, server=None, middleware=None):
         if not server:
-            from wsgiref.simple_server import make_server
-            server = make_server
+            if self.server_threads:
+                server = ThreadPoolWSGIServer.factory(self.server_threads)
+            else:
+                from wsgiref.simple_server import make_server
+                server = make_server
         if middleware:
             app = middleware(self.wsgi_app)
         else:
@@ -258,6 +308,87 @@ Please check the URL to ensure that the path is correct.</p>
             self.runActions('shutdown')
             self.saveRequestHistory()
 
+class _ReleasingIterator(object):
+    '''
+    Wraps a response iterator, calling `release` when the WSGI server 
+    closes it.
+    '''
+
+    def __init__(self, response, release):
+        self.response = response
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def close(self):
+        try:
+            if hasattr(self.response, 'close'):
+                self.response.close()
+        finally:
+            if self.release:
+                self.release()
+                self.release = None
+
+class ThreadPoolWSGIServer(WSGIServer):
+    '''
+    A WSGI server that accepts connections in the thread that calls 
+    `serve_forever()` and hands them off to a fixed number of worker threads.
+    If all the workers are busy up to `queueSize` connections wait in a 
+    queue, after that the server stops accepting new connections until a 
+    worker is free.
+    '''
+
+    def __init__(self, server_address, RequestHandlerClass=WSGIRequestHandler,
+                                                threads=10, queueSize=None):
+        WSGIServer.__init__(self, server_address, RequestHandlerClass)
+        if queueSize is None:
+            queueSize = threads * 4
+        self.requests = Queue.Queue(queueSize)
+        self.workers = []
+        for i in range(threads):
+            worker = threading.Thread(target=self._processRequests,
+                                      name='wsgi-worker-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def factory(cls, threads=10, queueSize=None):
+        '''
+        Returns a function with the same signature as 
+        `wsgiref.simple_server.make_server`.
+        '''
+        def makeServer(host, port, app):
+            server = cls((host, port), WSGIRequestHandler, threads, queueSize)
+            server.set_app(app)
+            return server
+        return makeServer
+    factory = classmethod(factory)
+
+    def process_request(self, request, client_address):
+        #blocks while the queue is full
+        self.requests.put((request, client_address))
+
+    def _processRequests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
 class UploadFile(object):
 
     def __init__(self, field):
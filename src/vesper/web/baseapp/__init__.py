@@ -8,6 +8,7 @@ from vesper.app import getCurrentApp
 from vesper.backports import json
 from string import Template
 import mako.runtime
+import time, itertools
 import logging
 log = logging.getLogger('datarequest')
 
@@ -28,12 +29,128 @@ vesper.utils.defaultattrdict.UNDEFINED = mako.runtime.UNDEFINED
 import vesper.query
 vesper.query.QueryContext.defaultShapes = { dict : vesper.utils.defaultattrdict }
 
+#size of the chunks of JSON sent when streaming query results
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _isStreamableRequest(request):
+    if (not isinstance(request, dict) or request.get('method') != 'query'
+            or request.get('id') is None or request.get('jsonrpc') != '2.0'):
+        return False
+    params = request.get('params')
+    if isinstance(params, (str, unicode)):
+        return True
+    return (isinstance(params, dict) and 'query' in params and 
+            not set(params) - set(['query', 'bindvars', 'forUpdate']))
+
+def isReadOnlyRequest(kw):
+    '''
+    Returns True if the request only reads the store: either a `datarequest`
+    that only contains queries or a request for a static file.
+    (Used as the :confval:`is_read_only_request` config setting.)
+    '''
+    method = kw._environ.get('REQUEST_METHOD')
+    if method in ('GET', 'HEAD'):
+        return kw._name.startswith('static/')
+    if method != 'POST' or not kw._name.endswith('datarequest'):
+        return False
+    try:
+        requests = json.loads(kw.get('_postContent') or '')
+    except ValueError:
+        return False
+    if not isinstance(requests, list):
+        requests = [requests]
+    return bool(requests) and all(_isStreamableRequest(x) for x in requests)
+
+def _formatQueryError(exc_info):
+    from vesper.query import QueryException
+    if isinstance(exc_info[1], QueryException):
+        return 'error: %s' % exc_info[1].message
+    import traceback
+    return "unexpected exception: %s" % ''.join(
+                                        traceback.format_exception(*exc_info))
+
+def _iterQueryResponses(dataStore, requests):
+    '''
+    Yields the JSON of the responses to the given query requests piece by 
+    piece, serializing each result as it is retrieved.
+    '''
+    import sys
+    txnSvc = dataStore.requestProcessor.txnSvc
+    txnSvc.begin(kw={'__readOnly' : True})
+    try:
+        yield '['
+        for i, request in enumerate(requests):
+            if i:
+                yield ', '
+            params = request['params']
+            if isinstance(params, (str, unicode)):
+                params = dict(query=params)
+            start = time.clock()
+            #retrieve the first row before writing anything so a query
+            #that fails right away gets the same error response as datarequest
+            (ast, errors) = dataStore.astCache.getAST(params['query'])
+            if ast is not None:
+                try:
+                    rows = dataStore.iterQuery(**params)
+                    first = list(itertools.islice(rows, 1))
+                except Exception:
+                    errors.append(_formatQueryError(sys.exc_info()))
+            if errors:
+                yield json.dumps(dict(id=request['id'], jsonrpc='2.0',
+                    error=dict(code=0, message='query failed', data=errors)))
+                continue
+
+            yield '{"id": %s, "jsonrpc": "2.0", "result": {"results": [' % (
+                                                    json.dumps(request['id']))
+            if first:
+                yield json.dumps(first[0])
+                try:
+                    for row in rows:
+                        yield ', '
+                        yield json.dumps(row)
+                except Exception:
+                    #too late for an error response, report it like 
+                    #a query with captureErrors does
+                    errors.append(_formatQueryError(sys.exc_info()))
+            yield '], "errors": %s, "elapsed": %s}}' % (json.dumps(errors), 
+                                                json.dumps(time.clock() - start))
+        yield ']'
+    finally:
+        #the transaction is read-only so there's nothing to commit
+        if txnSvc.isActive() and not txnSvc.state.aborted:
+            txnSvc.abort()
+
+def streamQueryResponses(dataStore, requests, chunkSize=None):
+    '''
+    Returns an iterator that yields the JSON-RPC responses to a batch of 
+    query requests in chunks of about `chunkSize` bytes (default: 
+    `STREAM_CHUNK_SIZE`). The queries are evaluated (in one read-only 
+    transaction) as the chunks are consumed, so the full result set is never
+    held in memory.
+    '''
+    chunkSize = chunkSize or STREAM_CHUNK_SIZE
+    buf = []
+    size = 0
+    for s in _iterQueryResponses(dataStore, requests):
+        buf.append(s)
+        size += len(s)
+        if size >= chunkSize:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
+
 @Route('datarequest', conditions=dict(method=["POST"]))
 @Route('{store:.*}/datarequest', conditions=dict(method=["POST"]))
 def datarequest(kw, retval):
     '''
     Accepts a JSON-RPC 2.0 (see http://groups.google.com/group/json-rpc/web/json-rpc-2-0)
     request (including a batch request).
+
+    If the :confval:`stream_query_results` config setting is True and the 
+    request only contains queries the response is streamed 
+    (see `streamQueryResponses`).
     '''
     from vesper import pjson
 
@@ -115,6 +232,10 @@ def datarequest(kw, retval):
                requests = [requests] 
             #XXX vesper.app should set a default content-type 
             kw._responseHeaders['Content-Type'] = 'application/json'
+            if (kw.__server__.stream_query_results and requests 
+                    and all(_isStreamableRequest(x) for x in requests)):
+                log.debug('streaming request: \n  %r', requests)
+                return streamQueryResponses(dataStore, requests)
             response = [isinstance(x, dict) and handleRequest(**x) or 
                 dict(id=hasattr(x, 'get') and x.get('id') or None, jsonrpc='2.0',
                             error=dict(code=-32600, message='Invalid Request'))
@@ -168,7 +289,8 @@ except ImportError:
 app = createApp(
     static_path=['static'],
     default_page_name = 'index.html',
-    actions = actions
+    actions = actions,
+    is_read_only_request = isReadOnlyRequest
 )
 
 if __name__ == "__main__":
@@ -29,5 +29,231 @@ class BdbModelTestCase(modelTest.BasicModelTestCase):
         #print 'tear down removing', self.tmpdir
         shutil.rmtree(self.tmpdir)
 
+    def testIndexes(self):
+        from vesper.data.base import Statement, ResourceUri
+        stmts = [Statement('s%d' % i, 'p', 'o%d' % (i % 2), 'R', 'c%d' % (i % 3))
+                                                        for i in range(10)]
+        model = BdbStore(self.tmpfilename)
+        model.addStatements(stmts)
+        model.commit()
+        model.close()
+
+        #reopening with indexes builds them from the existing statements
+        model = BdbStore(self.tmpfilename, indexes=['osp', 'context'])
+        self.failUnless(model.oDb is not None and model.cDb is not None)
+        self.assertEquals(model.getStatements(object=ResourceUri('o1')),
+                                                        stmts[1::2])
+        self.assertEquals(list(model.iterStatements(object='o1', objecttype='R')),
+                                                        stmts[1::2])
+        self.assertEquals(model.getStatements(context='c0'), stmts[::3])
+        self.assertEquals(model.getStatements(object='o0', objecttype='R', 
+                                context='c0'), [stmts[0], stmts[6]])
+
+        #the indexes are updated with the other b-trees
+        model.removeStatement(stmts[1])
+        model.addStatement(Statement('s10', 'p', 'o1', 'R', 'c0'))
+        model.commit()
+        self.assertEquals(model.getStatements(object=ResourceUri('o1')),
+                [Statement('s10', 'p', 'o1', 'R', 'c0')] + stmts[3::2])
+        self.assertEquals(model.getStatements(context='c1'), [stmts[4], stmts[7]])
+        model.close()
+
+        #and removed when they're no longer used
+        model = BdbStore(self.tmpfilename, indexes=['context'])
+        self.assertEquals(model.oDb, None)
+        self.failIf(os.path.exists(os.path.join(self.tmpfilename, 'obj_db')))
+        model.close()
+
+        self.assertRaises(RuntimeError, BdbStore, self.tmpfilename,
+                                                    indexes=['bad'])
+
+    def testIndexLookups(self):
+        from vesper.data.base import Statement, ResourceUri
+        types = ('R', 'L', 'http://www.w3.org/2001/XMLSchema#integer')
+        stmts = [Statement('s%d' % (i % 5), 'p%d' % (i % 2), 'o%d' % (i % 3),
+                types[(i // 3) % 3], ('', 'c1', 'c2', 'c3')[i % 4])
+                                                    for i in range(36)]
+        objects = ['o0', 'o1', 'o2', 'o3', ResourceUri('o1')]
+        contexts = [None, '', 'c1', 'c3', 'c4']
+
+        def scan(stmts, object=None, objecttype=None, context=None):
+            if isinstance(object, ResourceUri):
+                object, objecttype = object.uri, 'R'
+            return [s for s in stmts if (object is None or s[2] == object)
+                and (objecttype is None or s[3] == objecttype)
+                and (context is None or s[4] == context)]
+
+        def checkLookups(model):
+            all = model.getStatements()
+            for context in contexts:
+                self.assertEquals(model.getStatements(context=context),
+                                                    scan(all, context=context))
+                for object in objects:
+                    for objecttype in (None,) + types:
+                        self.assertEquals(model.getStatements(object=object,
+                            objecttype=objecttype, context=context), scan(all,
+                            object, objecttype, context))
+            return all
+
+        model = BdbStore(self.tmpfilename)
+        model.addStatements(stmts)
+        model.commit()
+        model.close()
+
+        model = BdbStore(self.tmpfilename)
+        self.assertEquals((model.oDb, model.cDb), (None, None))
+        self.assertEquals(checkLookups(model), sorted(stmts))
+        model.close()
+
+        #the indexes are built from the existing statements
+        model = BdbStore(self.tmpfilename, indexes=['osp', 'context'])
+        self.failUnless(model.oDb is not None and model.cDb is not None)
+        self.assertEquals(checkLookups(model), sorted(stmts))
+        model.removeStatement(stmts[4])
+        model.addStatement(Statement('s5', 'p0', 'o1', 'L', 'c4'))
+        model.commit()
+        model.close()
+
+        model = BdbStore(self.tmpfilename, indexes=['osp', 'context'])
+        self.assertEquals(checkLookups(model), sorted(stmts[:4] + stmts[5:] +
+                                    [Statement('s5', 'p0', 'o1', 'L', 'c4')]))
+        model.close()
+
+    def testSortedReads(self):
+        from vesper.data.base import Statement
+        stmts = sorted(Statement(s, p, o, 'L', c) for s in ('s2', 's1')
+            for p in ('p2', 'p1') for o in ('o2', 'o1') for c in ('', 'c'))
+        model = BdbStore(self.tmpfilename)
+        model.addStatements(reversed(stmts))
+        model.commit()
+
+        #statements are returned in the same order whichever b-tree is read
+        self.assertEquals(model.getStatements(), stmts)
+        self.assertEquals(model.getStatements('s1'), stmts[:8])
+        self.assertEquals(model.getStatements(predicate='p1'), 
+                                    [s for s in stmts if s[1] == 'p1'])
+        self.assertEquals(model.getStatements(predicate='p1', asQuad=False), 
+                            [s for s in stmts if s[1] == 'p1' and not s[4]])
+        self.assertEquals(list(model.iterStatements('s1', 
+                            hints={'limit': 3, 'offset': 2})), stmts[2:5])
+        self.assertEquals(model.getStatements(asQuad=False, 
+                            hints={'limit': 2}), [stmts[0], stmts[2]])
+        model.close()
+
+    def testModifiedWhileIterating(self):
+        from vesper.data.base import Statement
+        stmts = [Statement('s', 'p', 'o%d' % i, 'L', '') for i in range(5)]
+        model = BdbStore(self.tmpfilename)
+        model.addStatements(stmts)
+        model.commit()
+        new = Statement('s', 'p', 'o5', 'L', '')
+        for modify in (lambda: model.addStatement(new),
+                lambda: model.removeStatement(stmts[0]), model.commit,
+                model.rollback):
+            stmtIter = model.iterStatements('s')
+            stmtIter.next()
+            self.assertEquals(len(model._liveIterators), 1)
+            #the cursor is closed before the store is changed
+            modify()
+            self.assertEquals(model._liveIterators, [])
+            self.assertRaises(RuntimeError, stmtIter.next)
+        self.assertEquals(model.getStatements(), stmts[1:] + [new])
+
+        #a cursor is also closed once its iterator is finished with
+        self.assertEquals(list(model.iterStatements('s',
+                                    hints={'limit': 2})), stmts[1:3])
+        self.assertEquals(model._liveIterators, [])
+        #statements read from the predicate index are sorted up front
+        stmtIter = model.iterStatements(predicate='p')
+        stmtIter.next()
+        model.removeStatement(new)
+        self.assertEquals(list(stmtIter), stmts[2:] + [new])
+        model.commit()
+        model.close()
+
+    def testLimitedScan(self):
+        from vesper import query as jql
+        from vesper.data.store.basic import MemStore
+        from vesper.data.base import Statement
+        class CountingStore(BdbStore):
+            read = 0
+            def iterStatements(self, *args, **kw):
+                for stmt in BdbStore.iterStatements(self, *args, **kw):
+                    self.read += 1
+                    yield stmt
+        stmts = [Statement('p%02d' % i, p, str(i % 4), 'L', '') 
+                        for i in range(40) for p in ('type', 'rank')]
+        memModel = MemStore(stmts)
+        model = CountingStore(self.tmpfilename)
+        model.addStatements(stmts)
+        model.commit()
+        #statements are sorted by subject so a query with a limit stops 
+        #reading early and selects the same rows as the other stores
+        for query in ["{ * limit 3 }", "{ id where (type = '1') limit 2 }",
+                                                "{ * offset 2 limit 1 }"]:
+            model.read = 0
+            results = jql.getResults(query, model).results
+            self.assertEquals(results, jql.getResults(query, memModel).results)
+            self.failUnless(model.read < 20, model.read)
+        model.close()
+
+    def testCommitThroughput(self):
+        "benchmark commits per second at each durability level (-b to change the count)"
+        import threading
+        from vesper.data.base import Statement
+        count = modelTest.BIG
+        for durability in BdbStore.DURABILITY:
+            model = BdbStore(os.path.join(self.tmpdir, durability), 
+                                                    durability=durability)
+            start = time.time()
+            for i in xrange(count):
+                model.addStatement(Statement('s%d' % i, 'p', 'o', 'L', ''))
+                model.commit()
+            elapsed = time.time() - start
+            print '%s: %d commits/second' % (durability, count / elapsed)
+            self.assertEquals(len(model.getStatements()), count)
+            model.close()
+
+        #with group commit, threads write their transactions one at a time
+        #(like the transaction service's lock) but wait for the flush after
+        model = BdbStore(os.path.join(self.tmpdir, 'group'), groupCommit=True)
+        self.failUnless(model.groupCommit)
+        lock = threading.Lock()
+        def commit(n):
+            for i in xrange(count / 4):
+                lock.acquire()
+                try:
+                    model.addStatement(Statement('s%d-%d' % (n, i), 'p', 'o', 'L', ''))
+                    ticket = model.commit(flush=False)
+                finally:
+                    lock.release()
+                model.waitForCommit(ticket)
+        threads = [threading.Thread(target=commit, args=(n,)) for n in range(4)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        stats = model._groupCommit
+        print 'group commit: %d commits/second, %d commits per flush' % (
+                    stats.written / elapsed, stats.written / max(stats.flushes, 1))
+        self.assertEquals(stats.flushed, stats.written)
+        self.failUnless(stats.flushes <= stats.written)
+        self.assertEquals(len(model.getStatements()), count / 4 * 4)
+        model.close()
+
+class BdbIndexedModelTestCase(BdbModelTestCase):
+
+    def getModel(self):
+        model = BdbStore(self.tmpfilename, autocommit=True, 
+                                    indexes=['osp', 'context'])
+        return self._getModel(model)
+
+    def getTransactionModel(self):
+        model = BdbStore(self.tmpfilename, autocommit=False,
+                                    indexes=['osp', 'context'])
+        return self._getModel(model)
+
 if __name__ == '__main__':
     modelTest.main(BdbModelTestCase)
@@ -35,6 +35,19 @@ class FileModelTestCase(modelTest.BasicModelTestCase):
         #print 'tear down removing', self.tmpdir
         shutil.rmtree(self.tmpdir)
 
+    def breakCommit(self, model):
+        "make the model's next commit fail while writing the file"
+        model.serializeOptions = dict(badOption=1)
+
+    def getOverwriteString(self, changed=False):
+        '''
+        Returns the contents of a file with the statement 
+        ('foo', 'hello', 'world'), a different size if `changed` is True.
+        '''
+        if changed:
+            return '{"id":"foo","hello":"world" }'
+        return '{"id":"foo","hello":"world"}'
+
     def testCommitFailure(self):
         "test commit transaction isolation across 2 models"
         modelA = self.getTransactionModel()
@@ -65,7 +78,7 @@ class FileModelTestCase(modelTest.BasicModelTestCase):
         
         try:
             #make commit explode            
-            modelA.serializeOptions = dict(badOption=1)
+            self.breakCommit(modelA)
             modelA.commit()
         except:
             self.assertTrue("got expected exception")
@@ -80,7 +93,7 @@ class FileModelTestCase(modelTest.BasicModelTestCase):
     def testExternalChange(self):
         model = self.getModel()
         model.getStatements() #begin a txn
-        overwriteString = '{"id":"foo","hello":"world"}'
+        overwriteString = self.getOverwriteString()
         def overwrite():
             f = open(model.path, 'w')
             f.write(overwriteString)
@@ -99,9 +112,9 @@ class FileModelTestCase(modelTest.BasicModelTestCase):
         #should be from the overwritten file
         self.assertEqual(stmts, [Statement('foo', 'hello', 'world')])
         model.addStatement(Statement('b', 'b', ''))
-        #add some whitespace to change the file size because some file systems 
+        #the file size needs to change too because some file systems 
         #(e.g. HFS+ and FAT) have low resolution (1 and 2 second) last modified times
-        overwriteString = '{"id":"foo","hello":"world" }'
+        overwriteString = self.getOverwriteString(changed=True)
         overwrite()
         try:
             model.commit()
@@ -182,6 +195,98 @@ class TransactionFileModelTestCase(FileModelTestCase):
         model = TransactionFileStore(self.tmpfilename)
         return model#self._getModel(model)
 
+class SnapshotFileModelTestCase(FileModelTestCase):
+    EXT = 'vsnap'
+
+    def tearDown(self):
+        from vesper.data.base import writeSnapshot
+        #(vesper.data.base's utils attribute isn't the module)
+        sys.modules['vesper.data.base.utils'].writeSnapshot = writeSnapshot
+        FileModelTestCase.tearDown(self)
+
+    def breakCommit(self, model):
+        #the snapshot format has no options so fail halfway through writing it
+        from vesper.data.base import writeSnapshot
+        import cStringIO
+        def brokenWriteSnapshot(stmts, stream):
+            out = cStringIO.StringIO()
+            writeSnapshot(stmts, out)
+            stream.write(out.getvalue()[:len(out.getvalue()) // 2])
+            raise IOError('disk full')
+        sys.modules['vesper.data.base.utils'].writeSnapshot = brokenWriteSnapshot
+
+    def getOverwriteString(self, changed=False):
+        from vesper.data.base import writeSnapshot
+        import cStringIO
+        stmts = [Statement('foo', 'hello', 'world')]
+        if changed:
+            stmts.append(Statement('foo', 'hello', 'world', 'L', 'c'))
+        out = cStringIO.StringIO()
+        writeSnapshot(stmts, out)
+        return out.getvalue()
+
+    def testSnapshot(self):
+        from vesper.data.base import writeSnapshot, readSnapshot
+        from vesper.data.base import ParseException
+        import cStringIO
+        stmts = [Statement('s', 'p', u'\u00e9t\u00e9', 'en', ''),
+                 Statement('s', 'p2', 's', 'R', 'c'),
+                 Statement('t', 'p', '', 'L', '')]
+        out = cStringIO.StringIO()
+        writeSnapshot(stmts, out)
+        data = out.getvalue()
+        self.assertEqual(readSnapshot(data), stmts)
+        self.assertEqual(readSnapshot(data, 'g')[0].scope, 'g')
+        self.assertEqual(readSnapshot(data, 'g')[1].scope, 'c')
+        self.assertRaises(ParseException, readSnapshot, data[:-1])
+        self.assertRaises(ParseException, readSnapshot, '{"id" : "1"}')
+        
+        model = self.getModel()
+        model.addStatements(stmts)
+        model.commit()
+        self.assertEqual(self.getModel().getStatements(), stmts)
+
+class JournalFileModelTestCase(FileModelTestCase):
+
+    def getModel(self):
+        return FileStore(self.tmpfilename, journal=True)
+
+    def getTransactionModel(self):
+        return FileStore(self.tmpfilename, journal=True)
+
+    def testCommitFailure(self):
+        pass #commits only serialize the file when compacting
+
+    def testJournal(self):
+        s1, s2, s3 = [Statement('s', 'p'+n, 'o'+n) for n in '123']
+        model = self.getModel()
+        model.addStatements([s1, s2])
+        model.commit() #creates the file
+        contents = open(model.path).read()
+        self.assertFalse(os.path.exists(model.journalPath))
+
+        model.addStatement(s3)
+        model.removeStatement(s1)
+        model.commit()
+        #the file isn't rewritten, the changes are appended to the journal
+        self.assertEqual(open(model.path).read(), contents)
+        self.assertEqual(len(open(model.journalPath).readlines()), 1)
+        self.assertEqual(self.getModel().getStatements(), [s2, s3])
+
+        #a partially written transaction is ignored
+        f = open(model.journalPath, 'a')
+        f.write('[["+", "s", "p4", "o4"')
+        f.close()
+        self.assertEqual(self.getModel().getStatements(), [s2, s3])
+        
+        model = self.getModel()
+        model.compactRatio = 0.1
+        model.addStatement(s1)
+        model.commit()
+        #the journal grew too large so the file was rewritten
+        self.assertFalse(os.path.exists(model.journalPath))
+        self.assertEqual(self.getModel().getStatements(), [s1, s2, s3])
+
 class IncrementalFileModelTestCase(FileModelTestCase):
 
     EXT = 'nt' #XXX EXT = 'json' fails because model uses the default writeTriples
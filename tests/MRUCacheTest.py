@@ -40,6 +40,8 @@ class MRUCacheTestCase(unittest.TestCase):
         self.failUnless(v7 is v8) #it's in the cache
         self.failUnless(self.cache.nodeSize == 14)
 
+        self.failUnless(self.cache.evictions == 1)
+
         #the second item is in the cache
         v9 = self.cache.getValue(tuple('c'*7))
         self.failUnless(v9 == v5)        
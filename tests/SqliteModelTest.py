@@ -41,5 +41,65 @@ class SqliteModelTestCase(modelTest.BasicModelTestCase):
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
 
+    def testIndexes(self):
+        from vesper.data.base import Statement
+        def getIndexes(model):
+            curs = model.conn.execute("select name from sqlite_master where \
+type = 'index' and name like 'vesper_stmts_%'")
+            return sorted(row[0] for row in curs)
+
+        model = SqliteStore(self.tmpfilename)
+        self.assertEquals(getIndexes(model), 
+                    ['vesper_stmts_osp_idx', 'vesper_stmts_pos_idx'])
+        model.addStatements([Statement('s%d' % i, 'p', 'o', 'L', '') 
+                                                        for i in range(10)])
+        model.commit()
+        model.close()
+
+        #reopening with different indexes migrates the database
+        model = SqliteStore(self.tmpfilename, indexes=['context'])
+        self.assertEquals(getIndexes(model), 
+                ['vesper_stmts_context_idx', 'vesper_stmts_po_idx'])
+        #indexes were created on existing rows so ANALYZE was run
+        curs = model.conn.execute("select count(*) from sqlite_stat1 \
+where idx = 'vesper_stmts_context_idx'")
+        self.assertEquals(curs.fetchone()[0], 1)
+        self.assertEquals(len(model.getStatements(predicate='p')), 10)
+        model.close()
+
+        self.assertRaises(RuntimeError, SqliteStore, self.tmpfilename,
+                                                    indexes=['bad'])
+
+    def testWalSnapshot(self):
+        from vesper.data.base import Statement
+        model = SqliteStore(self.tmpfilename, wal=True)
+        self.assert_(model.snapshotReads and model.snapshotIsolation)
+        s1 = Statement('s', 'p', 'o1', 'L', '')
+        s2 = Statement('s', 'p', 'o2', 'L', '')
+        model.addStatement(s1)
+        model.commit()
+
+        snapshot = model.getSnapshot()
+        model.addStatement(s2)
+        #snapshots only see committed changes
+        other = model.getSnapshot()
+        self.assertEquals(other.getStatements(), [s1])
+        other.close()
+        model.commit()
+        #and keep reading the version they started with
+        self.assertEquals(snapshot.getStatements(), [s1])
+        self.assertRaises(RuntimeError, snapshot.addStatement, s2)
+        snapshot.close()
+
+        snapshot = model.getSnapshot()
+        self.assertEquals(sorted(snapshot.getStatements()), [s1, s2])
+        snapshot.close()
+        #the snapshots' connections are reused
+        self.assertEquals(len(model._readers), 2)
+        model.close()
+
+        #in-memory databases can't be shared between connections
+        self.assertEquals(SqliteStore(None, wal=True).getSnapshot(), None)
+
 if __name__ == '__main__':
     modelTest.main(SqliteModelTestCase)
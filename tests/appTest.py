@@ -234,6 +234,217 @@ class AppTestCase(unittest.TestCase):
         self.assertEquals(pjson.tojson(store.model.getStatements())['data'], [])
         self.assertEquals(store.query('{*}'), [])        
 
+    def testPreparedQuery(self):
+        store = vesper.app.createStore([
+        {"id": "a", "type" : "post", "rank" : 1, "author" : "@u1"},
+        {"id": "b", "type" : "post", "rank" : 2, "author" : "@u2"},
+        {"id": "c", "type" : "post", "rank" : 3, "author" : "@u1"},
+        ])
+        prepared = store.prepare(
+                    "{ id where (author = :author) order by rank }")
+        self.assertEquals(prepared.bindVarNames, frozenset(['author']))
+        bindvars = dict(author='@u1', unused='@u2')
+        self.assertEquals(prepared.execute(bindvars),
+                                    [{'id': '@a'}, {'id': '@c'}])
+        #the caller's bindvars aren't modified
+        self.assertEquals(bindvars, dict(author='@u1', unused='@u2'))
+        self.assertEquals(prepared.execute(dict(author='@u2')), [{'id': '@b'}])
+        self.assertEquals(prepared.execute(dict(author='@u1'), limit=1,
+                                                offset=1), [{'id': '@c'}])
+        self.assertEquals(prepared.execute(dict(author='@u1'), offset=1),
+                                                            [{'id': '@c'}])
+        self.assertEquals(store.query(prepared.query, dict(author='@u2')),
+                                                            [{'id': '@b'}])
+        results = prepared.execute(dict(author='@u1'), limit=1, explain=True)
+        self.assertEquals(results.results, [{'id': '@a'}])
+        self.failUnless(results.explain)
+
+        from vesper.query import QueryException
+        self.assertRaises(QueryException, store.prepare, "{ foo ")
+
+    def _postDataRequest(self, root, body):
+        import StringIO, wsgiref.util
+        environ = {}
+        wsgiref.util.setup_testing_defaults(environ)
+        environ.update(REQUEST_METHOD='POST', PATH_INFO='/datarequest',
+            CONTENT_TYPE='application/json', CONTENT_LENGTH=str(len(body)))
+        environ['wsgi.input'] = StringIO.StringIO(body)
+        return root.wsgi_app(environ, lambda status, headers: None)
+
+    def testStreamedDataRequest(self):
+        #importing baseapp changes these globals, restore them afterwards
+        import vesper.query
+        undefined = utils.defaultattrdict.UNDEFINED
+        defaultShapes = vesper.query.QueryContext.defaultShapes
+        try:
+            self._testStreamedDataRequest()
+        finally:
+            utils.defaultattrdict.UNDEFINED = undefined
+            vesper.query.QueryContext.defaultShapes = defaultShapes
+
+    def _testStreamedDataRequest(self):
+        from vesper.backports import json
+        from vesper.web import baseapp
+        requests = json.dumps([
+            dict(jsonrpc='2.0', id=1, method='query',
+                    params="{ id, rank where (type='post') order by rank }"),
+            dict(jsonrpc='2.0', id=2, method='query',
+                params=dict(query="{ id where (rank > :rank) }",
+                            bindvars=dict(rank=997))),
+            dict(jsonrpc='2.0', id=3, method='query', params="{ foo ")])
+        responses = []
+        for stream in (False, True):
+            app = vesper.app.createApp(baseapp='vesper.web.baseapp',
+                model_uri='test:', stream_query_results=stream,
+                storage_template=[dict(id='a%03d' % i, type='post', rank=i)
+                                                    for i in range(1000)])
+            app.load()
+            chunkSize = baseapp.STREAM_CHUNK_SIZE
+            baseapp.STREAM_CHUNK_SIZE = 1024
+            try:
+                chunks = list(self._postDataRequest(app._server, requests))
+            finally:
+                baseapp.STREAM_CHUNK_SIZE = chunkSize
+            if stream:
+                #the results are split into chunks
+                self.failUnless(len(chunks) > 10)
+                self.failUnless(max(map(len, chunks)) < 1024 + 100)
+            response = json.loads(''.join(chunks))
+            for r in response:
+                r.get('result', {}).pop('elapsed', None)
+            responses.append(response)
+        self.assertEquals(responses[0], responses[1])
+        self.assertEquals(len(responses[1][0]['result']['results']), 1000)
+        self.assertEquals(sorted(responses[1][1]['result']['results']),
+                                            [{'id':'@a998'}, {'id':'@a999'}])
+        self.assertEquals(responses[1][2]['error']['message'], 'query failed')
+
+        #a batch with updates isn't streamed
+        requests = json.dumps([dict(jsonrpc='2.0', id=1, method='add',
+                                        params=dict(id='a1000', type='post')),
+                               dict(jsonrpc='2.0', id=2, method='query',
+                                        params="{ id where (id='a1000') }")])
+        result = self._postDataRequest(app._server, requests)
+        self.assertEquals(json.loads(''.join(result))[1]['result']['results'],
+                                                        [{'id':'@a1000'}])
+
+    def testThreadPoolServer(self):
+        self._testThreadPoolServer()
+
+    def testThreadPoolServerSqlite(self):
+        #the worker threads share the store's connection
+        import tempfile, shutil
+        from vesper.data.store.sqlite import SqliteStore
+        tmpdir = tempfile.mkdtemp(prefix="rhizometest")
+        try:
+            for wal in (False, True):
+                path = os.path.join(tmpdir, 'test%d.sqlite' % wal)
+                root = self._testThreadPoolServer(model_factory=SqliteStore,
+                    storage_path=path, model_options=dict(wal=wal))
+                root.defaultStore.model.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _testThreadPoolServer(self, **config):
+        import vesper.query
+        undefined = utils.defaultattrdict.UNDEFINED
+        defaultShapes = vesper.query.QueryContext.defaultShapes
+        try:
+            return self._runThreadPoolServer(**config)
+        finally:
+            utils.defaultattrdict.UNDEFINED = undefined
+            vesper.query.QueryContext.defaultShapes = defaultShapes
+
+    def _runThreadPoolServer(self, **config):
+        import threading, urllib2
+        from vesper.backports import json
+        from vesper.web import ThreadPoolWSGIServer
+        app = vesper.app.createApp(baseapp='vesper.web.baseapp',
+            model_uri='test:', server_threads=4, **config)
+        app.load()
+        root = app._server
+        #SqliteStore ignores storage_template
+        root.defaultStore.add([dict(id='a%d' % i, rank=i) for i in range(10)])
+        self.failUnless(root.rwlock)
+        from wsgiref.simple_server import WSGIRequestHandler
+        class QuietRequestHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+        httpd = ThreadPoolWSGIServer(('localhost', 0), QuietRequestHandler, 4)
+        httpd.set_app(root.wsgi_app)
+        server = threading.Thread(target=httpd.serve_forever,
+                                  kwargs=dict(poll_interval=.05))
+        server.start()
+        try:
+            port = httpd.server_address[1]
+            def post(request):
+                req = urllib2.Request('http://localhost:%d/datarequest' % port,
+                    json.dumps(request), {'Content-Type':'application/json'})
+                return json.loads(urllib2.urlopen(req).read())
+
+            results = {}
+            def run(i):
+                if i % 2:
+                    request = dict(jsonrpc='2.0', id=i, method='add',
+                                        params=dict(id='b%d' % i, rank=i))
+                else:
+                    request = dict(jsonrpc='2.0', id=i, method='query',
+                        params="{ id where (rank < 5) }")
+                results[i] = post([request])[0]
+            threads = [threading.Thread(target=run, args=(i,))
+                                                        for i in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(10)
+            self.assertEquals(len(results), 20)
+            for i in range(0, 20, 2):
+                self.failUnless('error' not in results[i], results[i])
+                ids = [r['id'] for r in results[i]['result']['results']]
+                self.failUnless(set(["@a0", "@a4"]) <= set(ids), ids)
+            response = post([dict(jsonrpc='2.0', id=1, method='query',
+                                  params="{ id where (rank > 10) }")])
+            self.assertEquals(sorted(r['id'] for r in
+                response[0]['result']['results']), ['@b11', '@b13', '@b15',
+                                                    '@b17', '@b19'])
+        finally:
+            httpd.shutdown()
+            server.join()
+            httpd.server_close()
+        self.assertEquals((root.rwlock.readers, root.rwlock.writer), (0, False))
+        return root
+
+    def testBulkload(self):
+        import StringIO
+        from vesper import pjson
+        objs = [{"id": "p%d" % i, "type" : "post", "rank" : i} for i in range(5)]
+        expected = [{'id': '@p%d' % i} for i in range(5)]
+        query = "{ id where (type = 'post') order by rank }"
+
+        store = vesper.app.createStore()
+        report = store.bulkload(objs, batchSize=2)
+        self.assertEquals(report['statements'], 10)
+        self.assertEquals(store.query(query), expected)
+
+        from vesper.data.store.sqlite import SqliteStore
+        store = vesper.app.createStore(model_factory=SqliteStore)
+        lines = StringIO.StringIO(''.join([pjson.json.dumps(o) + '\n' for o in objs]))
+        self.assertEquals(store.bulkload(lines, 'pjsonlines', 3)['statements'], 10)
+        self.assertEquals(store.query(query), expected)
+        ntriples = StringIO.StringIO('<p5> <type> "post" .\n<p5> <rank> "5" .\n')
+        self.assertEquals(store.bulkload(ntriples, 'ntriples')['statements'], 2)
+        self.failUnless({'id': '@p5'} in store.query("{ id where (type = 'post') }"))
+        #the indexes and statistics are rebuilt after loading
+        curs = store.model.conn.execute("select count(*) from sqlite_master \
+where type = 'index' and name like 'vesper_stmts_%'")
+        self.assertEquals(curs.fetchone()[0], 2)
+        self.assertEquals(store.model.getPredicateStatistics('type').subjects, 6)
+
+        #stores with history add the batches in one transaction
+        store = vesper.app.createStore(save_history=True)
+        store.bulkload(objs, batchSize=2)
+        self.assertEquals(store.query(query), expected)
+
     def testUpdate(self):
         store = vesper.app.createStore({
         "id": "hello", 
@@ -782,9 +993,11 @@ class AppTestCase(unittest.TestCase):
 
       def thread2():
         event.wait()
-        #readonly transactions don't block but
-        #result will still be 2 as there's no transaction isolation
-        self.assertEquals(store.query("(prop where id='a')"), [2])        
+        #readonly transactions don't block, with snapshot reads they see
+        #the last committed value otherwise the result will still be 2
+        #as there's no transaction isolation
+        self.assertEquals(store.query("(prop where id='a')"),
+                                        store.snapshotReads and [1] or [2])
         #will block until the other transaction is done
         self.failUnless(t1.isAlive())
         store.update({
@@ -816,6 +1029,188 @@ class AppTestCase(unittest.TestCase):
         self._testThreading(False)
         self._testThreading('combined')
         self._testThreading('split')
+
+    def testSnapshotReads(self):
+        store = vesper.app.createStore()
+        store.add({"id": "a", "prop": 1})
+        memStore = store.model.model
+        by_s = memStore.by_s
+        #a write with no readers doesn't copy the indexes
+        store.update({"id": "a", "prop": 2})
+        self.assertEquals(memStore._owned, None)
+        self.failUnless(memStore.by_s is by_s)
+
+        self._testSnapshotReads(vesper.app.createStore())
+
+        import tempfile, shutil
+        from vesper.data.store.sqlite import SqliteStore
+        tmpdir = tempfile.mkdtemp(prefix="rhizometest")
+        try:
+            store = vesper.app.createStore(model_factory=SqliteStore,
+                storage_url='sqlite://' + os.path.join(tmpdir, 'test.sqlite'),
+                model_options=dict(wal=True))
+            self._testSnapshotReads(store)
+            store.model.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        store = vesper.app.createStore(snapshot_reads=False)
+        self.failIf(store.snapshotReads)
+
+    def testQueryResultCache(self):
+        store = vesper.app.createStore(query_result_cache_size=10)
+        cache = store.resultCache
+        store.add([{"id": "a", "prop": 1}, {"id": "b", "other": 2}])
+        query = "{ id, prop where (id='a') }"
+        self.assertEquals(store.query(query), [{'id': '@a', 'prop': 1}])
+        self.assertEquals(store.query(query), [{'id': '@a', 'prop': 1}])
+        self.assertEquals(cache.hits, 1)
+
+        #changes to resources the query didn't read keep the entry
+        store.add({"id": "c", "other": 3})
+        store.update({"id": "b", "other": 4})
+        self.assertEquals(store.query(query), [{'id': '@a', 'prop': 1}])
+        self.assertEquals(cache.hits, 2)
+
+        #but an update to what it read invalidates it
+        store.update({"id": "a", "prop": 5})
+        self.assertEquals(store.query(query), [{'id': '@a', 'prop': 5}])
+        self.assertEquals(cache.hits, 2)
+
+        #modifying the returned results doesn't corrupt the cache
+        store.query(query)[0]['prop'] = 6
+        self.assertEquals(store.query(query), [{'id': '@a', 'prop': 5}])
+        self.assertEquals(cache.hits, 4)
+
+        #queries inside a write transaction bypass the cache
+        def update():
+            store.update({"id": "a", "prop": 7})
+            return store.query(query)
+        self.assertEquals(store.requestProcessor.executeTransaction(update),
+                                                [{'id': '@a', 'prop': 7}])
+        self.assertEquals(cache.hits, 4)
+        self.assertEquals(store.query(query), [{'id': '@a', 'prop': 7}])
+
+        self.assertEquals(vesper.app.createStore().resultCache, None)
+
+    def testQueryParallelism(self):
+        import tempfile, shutil
+        from vesper.data.store.sqlite import SqliteStore
+        data = [{"id": "p%d" % i, "type": "post", "author": "user %d" % (i % 3),
+                                        "rank": i} for i in range(30)]
+        query = "{ id, rank where (type = 'post' and author = 'user 1' and rank > 10) }"
+        expected = vesper.app.createStore(data).query(query)
+        self.assertEquals(len(expected), 6)
+
+        store = vesper.app.createStore(data, query_parallelism=3)
+        self.assertEquals(len(store.queryPool.threads), 2)
+        self.assertEquals(sorted(store.query(query)), sorted(expected))
+        store.queryPool.close()
+
+        tmpdir = tempfile.mkdtemp(prefix="rhizometest")
+        try:
+            store = vesper.app.createStore(model_factory=SqliteStore,
+                storage_url='sqlite://' + os.path.join(tmpdir, 'test.sqlite'),
+                model_options=dict(wal=True), query_parallelism=3)
+            store.add(data)
+            self.failUnless(store.model.concurrentReads)
+            self.assertEquals(sorted(store.query(query)), sorted(expected))
+            store.queryPool.close()
+            store.model.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEquals(vesper.app.createStore().queryPool, None)
+
+    def testOrderByLimit(self):
+        #the nested lists add property list resources that construct skips,
+        #so the top-n heap doesn't hold enough rows for some limits
+        data = [{'id': 'a%d' % i, 'l': [1, [i, 2]]} for i in range(4)]
+        store = vesper.app.createStore(data)
+        expected = store.query('{ * order by id }')
+        self.assertEquals([r['id'] for r in expected], ['@a0', '@a1', '@a2', '@a3'])
+        for limit in range(1, 6):
+            self.assertEquals(store.query('{ * order by id limit %d }' % limit),
+                                                            expected[:limit])
+        store = vesper.app.createStore(data, sort_buffer_rows=2)
+        self.assertEquals(store.query('{ * order by id }'), expected)
+        self.assertEquals(store.query('{ * order by id offset 1 limit 2 }'),
+                                                                expected[1:3])
+
+    def testGroupCommit(self):
+        from vesper.data.store.basic import MemStore
+        waits = []
+        class GroupCommitStore(MemStore):
+            groupCommit = True
+            def commit(self, flush=True, **kw):
+                return not flush and 'ticket' or None
+            def waitForCommit(self, ticket):
+                waits.append((ticket, txnSvc.isActive()))
+
+        store = vesper.app.createStore(model_factory=GroupCommitStore)
+        txnSvc = store.requestProcessor.txnSvc
+        store.add({'id': 'a', 'prop': 1})
+        #the flush is waited on after the transaction has finished
+        self.assertEquals(waits, [('ticket', False)])
+        self.assertEquals(store.query("{ prop where (id='a') }"), [{'prop': 1}])
+
+        #a web request waits after releasing the server_threads lock too
+        from vesper.query import QueryContext
+        from vesper.backports import json
+        undefined = utils.defaultattrdict.UNDEFINED
+        defaultShapes = QueryContext.defaultShapes
+        try:
+            app = vesper.app.createApp(baseapp='vesper.web.baseapp',
+                model_uri='test:', server_threads=4,
+                model_factory=GroupCommitStore)
+            app.load()
+            root = app._server
+            txnSvc = root.txnSvc
+            del waits[:]
+            GroupCommitStore.waitForCommit = lambda self, ticket: waits.append(
+                            (ticket, txnSvc.isActive(), root.rwlock.writer))
+            request = json.dumps([dict(jsonrpc='2.0', id=1, method='add',
+                                        params=dict(id='b', prop=2))])
+            result = self._postDataRequest(root, request)
+            self.assertEquals(json.loads(''.join(result))[0]['result'],
+                                        {'added': {'id': 'b', 'prop': 2}})
+            self.assertEquals(waits, [('ticket', False, False)])
+        finally:
+            utils.defaultattrdict.UNDEFINED = undefined
+            QueryContext.defaultShapes = defaultShapes
+
+    def _testSnapshotReads(self, store):
+        import threading
+        self.failUnless(store.snapshotReads)
+        store.add({"id": "a", "prop": 1})
+        requestProcessor = store.requestProcessor
+        query = "(prop where id='a')"
+        written = threading.Event()
+        done = threading.Event()
+        results = []
+        def writer():
+            requestProcessor.txnSvc.begin()
+            try:
+                store.update({"id": "a", "prop": 2})
+                #a transaction reads its own changes
+                results.append(store.query(query))
+                written.set()
+                done.wait()
+            finally:
+                requestProcessor.txnSvc.commit()
+
+        t = threading.Thread(target=writer)
+        t.start()
+        written.wait()
+        with requestProcessor.inTransaction():
+            #readers don't wait for the writer and see the last committed version
+            results.append(store.query(query))
+            done.set()
+            t.join()
+            #the whole transaction reads the same version
+            results.append(store.query(query))
+        self.assertEquals(results, [[2], [1], [1]])
+        self.assertEquals(store.query(query), [2])
          
     def testCreateApp(self):
         #this is minimal logconfig that python's logger seems to accept:
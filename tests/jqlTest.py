@@ -196,18 +196,19 @@ t('''{ * order by child desc, id asc }''', res)
 
 t.group = 'limit'
 
+#without an order by, the rows are in id order when there's a limit or offset
 t('''{ * limit 2}''',
-[{'foo': 'bar', 'id': '3'},
- {'foo': 'bar', 'id': '2'}]
+[{'foo': 'bar', 'id': '2'},
+ {'foo': 'bar', 'id': '3'}]
 )
 
 t('''{ * offset 2}''',
-[{'child': '2', 'id': '_:2', 'parent': '1'},
-{'child': '3', 'id': '_:1', 'parent': '1'}]
+[{'child': '3', 'id': '_:1', 'parent': '1'},
+{'child': '2', 'id': '_:2', 'parent': '1'}]
 )
 
 t('''{ * offset 2 limit 1}''',
-[{'child': '2', 'id': '_:2', 'parent': '1'}]
+[{'child': '3', 'id': '_:1', 'parent': '1'}]
 )
 
 t.group = 'parse'
@@ -2649,6 +2650,12 @@ class JQLTestCase(unittest.TestCase):
     def testAll(self):
         main(t, ['--quiet'])
 
+    def testAllConcurrent(self):
+        main(t, ['--quiet', '--parallel'])
+
+    def testAllSpilled(self):
+        main(t, ['--quiet', '--spill'])
+
     def testSerializationClassOveride(self):
         '''
         test that query results always use the user specified list and dict classes
@@ -2686,6 +2693,275 @@ class JQLTestCase(unittest.TestCase):
         finally:
             jql.QueryContext.defaultShapes = save
     
+    def testASTCache(self):
+        cache = jql.ASTCache(2)
+        model = modelFromJson([{ "id" : "1", "foo" : "a value"}, 
+                               { "id" : "2", "foo" : "a value"}])
+        query = "{ * where (foo = :foo) }"
+        ast, errs = cache.getAST(query)
+        self.assertEquals(ast, jql.buildAST(query)[0])
+        #differences in indentation map to the same entry
+        ast2, errs = cache.getAST('''
+            { * where (foo = :foo) }  ''')
+        self.failUnless(ast is ast2)
+        
+        #the cached ast can be re-evaluated with different bindvars
+        results = jql.getResults(query, model, dict(foo='a value'), astCache=cache).results
+        self.assertEquals(len(results), 2)
+        results = jql.getResults(query, model, dict(foo='another value'), astCache=cache).results
+        self.assertEquals(results, [])
+        
+        #a different namemap is a different entry
+        ast3, errs = cache.getAST(query, {'refpattern' : '#(id)'})
+        self.failUnless(ast3 is not ast)
+        
+        cache.getAST("{ foo }")
+        stats = cache.stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['evictions'], 
+                    stats['size']), (3, 3, 1, 2))
+
+        #queries that fail to parse aren't cached
+        ast, errs = cache.getAST("{ foo ")
+        self.failUnless(ast is None and errs)
+        self.assertEquals(cache.stats()['size'], 2)
+
+    def testQueryResultCache(self):
+        from vesper.data.base import Statement
+        cache = jql.QueryResultCache(10)
+        model = modelFromJson([{ "id" : "1", "foo" : "a value", "bar" : 1},
+                               { "id" : "2", "foo" : "another value"}])
+        def run(query):
+            key = cache.getKey(query)
+            results = cache.get(key, cache.version)
+            if results is None:
+                recorder = jql.ReadRecordingModel(model)
+                results = jql.getResults(query, recorder).results
+                cache.put(key, results, recorder.patterns, cache.version)
+            return results
+
+        query1 = "{ id where (foo = 'a value') }"
+        query2 = "{ * where (id = @2) }"
+        self.assertEquals(run(query1), [{'id': '@1'}])
+        self.assertEquals(run(query2), [{'id': '@2', 'foo': 'another value'}])
+        #the results are copied
+        run(query1)[0]['id'] = 'changed'
+        self.assertEquals(run(query1), [{'id': '@1'}])
+        self.assertEquals(cache.stats()['hits'], 2)
+
+        #only the entries that read a statement that changed are removed
+        cache.invalidate([Statement('1', 'bar', '2', 'http://www.w3.org/2001/XMLSchema#integer', '')])
+        self.assertEquals(cache.stats()['size'], 2)
+        cache.invalidate([Statement('3', 'foo', 'a value', 'L', '')])
+        self.assertEquals(cache.stats()['size'], 1)
+        self.assertEquals(cache.get(cache.getKey(query1), cache.version), None)
+        self.failUnless(cache.get(cache.getKey(query2), cache.version))
+        #results computed from an older version of the store aren't added
+        cache.put(cache.getKey(query1), [], [], cache.version - 1)
+        self.assertEquals(cache.get(cache.getKey(query1), cache.version), None)
+        #and entries aren't returned to readers of an older version
+        self.assertEquals(run(query1), [{'id': '@1'}])
+        self.assertEquals(cache.get(cache.getKey(query1), cache.version - 1), None)
+
+        stats = cache.stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['invalidations'],
+                stats['size']), (3, 6, 1, 2))
+        self.assertEquals(stats['hitRate'], 3 / 9.0)
+        cache.clear()
+        self.assertEquals(cache.stats()['size'], 0)
+
+    def testJoinOrderStatistics(self):
+        model = modelFromJson([{ "id" : "p%d" % i, "type" : "a post",
+                                    "author" : "user %d" % i} for i in range(20)])
+        self.assertEquals(model.getPredicateStatistics('type').objects, 1)
+        for query in ["{ id where (type = 'a post' and author = 'user 7') }",
+                      "{ id where (author = 'user 7' and type = 'a post') }"]:
+            result = jql.getResults(query, model, explain=True)
+            self.assertEquals(result.results, [{'id': '@p7'}])
+            #the more selective author filter should drive the join
+            explain = result.explain
+            self.failUnless(explain.index("C('author'") < explain.index("C('type'"),
+                                                                        explain)
+
+    def testJoinAlgorithms(self):
+        model = modelFromJson([{ "id" : "p%d" % i, "type" : "a post",
+            "author" : "user %d" % (i % 3), "rank" : i} for i in range(10)])
+        query = "{ id, rank where (type = 'a post' and author = 'user 1') }"
+        expected = [{'id': '@p%d' % i, 'rank' : i} for i in (1,4,7)]
+        result = jql.getResults(query, model, explain=True)
+        self.assertEquals(sorted(result.results), expected)
+        self.failUnless('HashJoin' in result.explain, result.explain)
+
+        #if the model says its statements are sorted by subject
+        #a merge join can be used
+        model.orderedBy = 0
+        result = jql.getResults(query, model, explain=True)
+        self.assertEquals(result.results, expected)
+        self.failUnless('MergeJoin' in result.explain, result.explain)
+
+    def testPushdownHints(self):
+        from vesper.data.store.sqlite import SqliteStore
+        src = [{ "id" : "p%d" % i, "type" : "a post", "rank" : i, 
+                "author" : "user %d" % (i % 3)} for i in range(10)]
+        src.append({ "id" : "a", "type" : "an author", "rank" : "a b"})
+        memModel = modelFromJson(src)
+        model = SqliteStore()
+        model.bnodePrefix = '_:'
+        model.addStatements(memModel.getStatements())
+        for query in ["{ id where (rank > 6) }", 
+                      "{ id where (6 >= rank and type = 'a post') }",
+                      "{ id where (rank >= 'a' and type = 'an author') }",
+                      "{ id where (author in ('user 1', 'user 2') and rank < 5) }",
+                      ]:
+            self.assertEquals(
+                sorted(jql.getResults(query, model).results),
+                sorted(jql.getResults(query, memModel).results))
+
+        #the store only returns rows that match the hints
+        rank = dict(where=[('>', (6,), pjson.NUMERIC_TYPES)])
+        self.assertEquals(len(model.getStatements(predicate='rank', hints=rank)),
+                                                                            4)
+        semijoin = dict(semijoins=[({'predicate':'rank'}, rank['where'])])
+        self.assertEquals(sorted(s.subject for s in 
+            model.getStatements(predicate='author', hints=semijoin)),
+                                                    ['p7', 'p8', 'p9'])
+
+    def testLimitPushdown(self):
+        from vesper.data.store.sqlite import SqliteStore
+        class CountingStore(SqliteStore):
+            read = 0
+            def iterStatements(self, *args, **kw):
+                for stmt in SqliteStore.iterStatements(self, *args, **kw):
+                    self.read += 1
+                    yield stmt
+
+        src = [{ "id" : "p%02d" % i, "type" : "a post", "rank" : i % 4,
+                "author" : "user %d" % (i % 3)} for i in range(40)]
+        memModel = modelFromJson(src)
+        model = CountingStore()
+        model.bnodePrefix = '_:'
+        model.addStatements(memModel.getStatements())
+
+        #the scan stops once the first 3 subjects have been read
+        results = jql.getResults("{ * limit 3 }", model).results
+        self.assertEquals([r['id'] for r in results], ['@p00', '@p01', '@p02'])
+        self.assertEquals(results, sorted([r for r in
+            jql.getResults("{ * }", memModel).results if r['id'] in
+                        ('@p00', '@p01', '@p02')], key=lambda r: r['id']))
+        self.assertTrue(model.read < 40, model.read)
+        results = jql.getResults("{ id where (type = 'a post') offset 2 limit 2 }",
+                                                            model).results
+        self.assertEquals(results, [{'id' : '@p02'}, {'id' : '@p03'}])
+
+        #MemStore's statements are sorted so its scans stop early too
+        class CountingMemStore(MemStore):
+            read = 0
+            def iterStatements(self, *args, **kw):
+                for stmt in MemStore.iterStatements(self, *args, **kw):
+                    self.read += 1
+                    yield stmt
+        countingMemModel = CountingMemStore(memModel.getStatements())
+        self.assertEquals(jql.getResults("{ * limit 3 }", countingMemModel
+                        ).results, jql.getResults("{ * limit 3 }", model).results)
+        self.assertTrue(countingMemModel.read < 40, countingMemModel.read)
+
+        #and without an order by the stores select the same rows, in id order
+        memModel = modelFromJson([{ "parent":"1", "child":"2", 'id': '_:2'},
+            { "parent":"1", "child":"3", 'id': '_:1'}, { "id" : "1"},
+            { "id" : "2", "foo" : "bar"}, { "id" : "3", "foo" : "bar"}])
+        model = SqliteStore()
+        model.bnodePrefix = '_:'
+        model.addStatements(memModel.getStatements())
+        for query in ["{ * %s offset 2 limit 1 }", "{ * %s limit 2 }",
+                                                "{ * %s offset 1 }"]:
+            expected = jql.getResults(query % 'order by id', memModel).results
+            self.assertEquals(jql.getResults(query % '', model).results, expected)
+            self.assertEquals(jql.getResults(query % '', memModel).results,
+                                                                    expected)
+
+        #order by with a limit returns the first rows of the full sort
+        for orderby in ['rank', 'rank desc', 'rank desc, author', 'author, id desc']:
+            query = "{ id, rank, author order by %s %%s }" % orderby
+            expected = jql.getResults(query % '', memModel).results
+            #and so does sorting in runs spilled to disk
+            self.assertEquals(jql.getResults(query % '', memModel,
+                                    sortBufferRows=3).results, expected)
+            for limit, start, stop in [('limit 5', 0, 5),
+                                       ('offset 3 limit 4', 3, 7)]:
+                self.assertEquals(
+                    jql.getResults(query % limit, memModel).results,
+                    expected[start:stop])
+
+    def testHashAggregate(self):
+        data = [{'id': 'r%d' % i, 'key': 'k%d' % (i % 7), 'val': i}
+                                                    for i in range(50)]
+        #not modelFromJson: its refpattern (which other test modules change)
+        #would parse the keys as references
+        model = vesper.data.store.basic.MemStore(
+                                vesper.pjson.Parser().to_rdf(data)[0])
+        expected = []
+        for k in range(7):
+            vals = range(k, 50, 7)
+            expected.append({'key': 'k%d' % k, 'count': len(vals),
+                'sum': sum(vals), 'min': min(vals), 'max': max(vals),
+                'avg': float(sum(vals)) / len(vals), 'range': max(vals) - min(vals)})
+        query = '''{ key, 'count' : count(*), 'sum' : sum(val), 'min' : min(val),
+          'max' : max(val), 'avg' : avg(val), 'range' : max(val) - min(val)
+          group by key order by key }'''
+        #with a small buffer the groups are spilled to disk and merged
+        for sortBufferRows in [None, 3]:
+            results = jql.getResults(query, model,
+                                sortBufferRows=sortBufferRows).results
+            self.assertEquals(results, expected)
+
+        #the groups' rows are collected if a property isn't an aggregate
+        results = jql.getResults('''{ key, 'avg' : avg(val), 'vals' : val
+                group by key order by key }''', model).results
+        self.assertEquals([(r['key'], r['avg']) for r in results],
+                          [(r['key'], r['avg']) for r in expected])
+
+    def testExternalSort(self):
+        from vesper.query.engine import externalSort, _Descending
+        rows = [(i % 3, 'r%02d' % i) for i in range(20)]
+        expected = sorted(rows, key=lambda r: r[0])
+        for maxRows in [None, 1, 4, 20, 100]:
+            #the sort is stable
+            self.assertEquals(list(externalSort(rows, lambda r: r[0], maxRows)),
+                                                                    expected)
+            self.assertEquals(list(externalSort(rows, lambda r: r[0], maxRows,
+                                                    lazy=True)), expected)
+        #mixed directions
+        key = lambda r: [_Descending(r[0]), r[1]]
+        expected = sorted(rows, key=lambda r: r[1])
+        expected = sorted(expected, key=lambda r: r[0], reverse=True)
+        self.assertEquals(list(externalSort(rows, key, 3)), expected)
+        self.assertEquals(list(externalSort([], key, 3)), [])
+
+    def testTopN(self):
+        from vesper.query.engine import SimpleQueryEngine
+        from vesper.query.operations import SimpleTupleset
+        import itertools
+        rows = [(i % 3, 'r%02d' % i) for i in range(20)]
+        expected = sorted(rows, key=lambda r: r[0])
+        passes = []
+        def readRows():
+            passes.append(1)
+            return iter(rows)
+        class context(object):
+            sortBufferRows = 0
+            debug = False
+        for maxRows in [0, 1, 4, 100]:
+            context.sortBufferRows = maxRows
+            for count in [0, 1, 5, 20, 30]:
+                del passes[:]
+                top = iter(SimpleQueryEngine()._topN(SimpleTupleset(readRows),
+                                    lambda r: r[0], context))
+                self.assertEquals(list(itertools.islice(top, count)), 
+                                                    expected[:count])
+                #reading past the top rows (the construct can) doesn't read
+                #the tupleset again
+                self.assertEquals(list(top), expected[count:])
+                self.assertEquals(len(passes), 1)
+
     def testPygmentsLexer(self):
         try:
             import pygments
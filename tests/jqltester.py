@@ -211,7 +211,8 @@ def main(t, cmdargs=None):
     parser = OptionParser(usage)
     for name, default in [('printmodel', 0), ('printast', 0), ('explain', 0),
         ('printdebug', 0), ('printrows', 0), ('quiet',0), ('listgroups',0),
-        ('printdocs',0), ('skip', 0), ('dontabort', 0)]:
+        ('printdocs',0), ('skip', 0), ('dontabort', 0), ('parallel', 0),
+        ('spill', 0)]:
         parser.add_option('--'+name, dest=name, default=default, 
                                                 action="store_true")
     (options, args) = parser.parse_args(cmdargs)
@@ -230,6 +231,18 @@ def main(t, cmdargs=None):
             except:
                 options.group = args[0]
     
+    if options.parallel:
+        #evaluate join branches concurrently
+        from vesper.utils import ThreadPool
+        executor = ThreadPool(3)
+    else:
+        executor = None
+    if options.spill:
+        #sort with a tiny buffer so every order by writes runs to disk
+        sortBufferRows = 2
+    else:
+        sortBufferRows = None
+
     count = 0
     skipped = 0
     failed = 0
@@ -358,7 +371,8 @@ def main(t, cmdargs=None):
         if ast:
             testresults = list(jql.evalAST(ast, test.model, test.bindvars,
                     explain=explain, debug=debug, forUpdate = test.forUpdate, 
-                                            useSerializer= test.useSerializer))
+                    useSerializer= test.useSerializer, executor=executor,
+                    sortBufferRows=sortBufferRows))
         else:
             testresults = None
         
@@ -395,6 +409,8 @@ def main(t, cmdargs=None):
                 else:
                     assert resultsMatch, errMsg
 
+    if executor is not None:
+        executor.close()
     if not options.printdocs:
         print '***** %d tests passed, %d failed, %d skipped' % (count-failed, failed, skipped)
     elif t._nextdoc:
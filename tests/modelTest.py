@@ -332,6 +332,148 @@ class SimpleModelTestCase(unittest.TestCase):
         r5.sort()
         self.assertEquals(r5, statements[1:3])
 
+    def testTwoBoundLookups(self):
+        "test lookups with both the subject and predicate or predicate and object"
+        model = self.getModel()
+        statements = [Statement(s, p, o, 'L', c) for s in ('s2', 's1') 
+                        for p in ('p', 'q') for o in ('o2', 'o1') for c in ('', 'c')]
+        model.addStatements(statements)
+        model.commit()
+        statements.sort()
+        self.assertEqual(model.getStatements('s1', 'q'),
+            [s for s in statements if s[:2] == ('s1', 'q')])
+        self.assertEqual(model.getStatements(predicate='p', object='o1'),
+            [s for s in statements if s[1:3] == ('p', 'o1')])
+        self.assertEqual(len(model.getStatements('s1', 'p', 'o2', asQuad=False)), 1)
+
+        model.removeStatement(Statement('s1', 'q', 'o1', 'L', 'c'))
+        model.commit()
+        self.assertEqual(model.getStatements('s1', 'q', 'o1'),
+                                    [Statement('s1', 'q', 'o1', 'L', '')])
+        self.assertEqual(len(model.getStatements(predicate='q', object='o1')), 3)
+
+    def testIterStatements(self):
+        "test that iterStatements yields the same statements as getStatements"
+        model = self.getModel()
+        statements = [Statement(s, p, 'o', 'L', c) for s in ('s2', 's1')
+                        for p in ('p', 'q') for c in ('', 'c')]
+        model.addStatements(statements)
+        model.commit()
+        self.assertEqual(sorted(model.iterStatements()),
+                                    sorted(model.getStatements()))
+        self.assertEqual(sorted(model.iterStatements(predicate='q')),
+                                    sorted(model.getStatements(predicate='q')))
+        self.assertEqual(len(list(model.iterStatements('s1', asQuad=False))), 2)
+        self.assertEqual(len(list(model.iterStatements(hints={'limit':3}))), 3)
+        #stopping early shouldn't leave the store in a bad state
+        it = model.iterStatements()
+        it.next()
+        del it
+        model.addStatement(Statement('s3', 'p', 'o', 'L', ''))
+        model.commit()
+        self.assertEqual(len(model.getStatements('s3')), 1)
+        if isinstance(model, MemStore):
+            #statements are sorted a subject at a time as the index is walked
+            it = model.iterStatements()
+            self.assertEqual(it.next(), Statement('s1', 'p', 'o', 'L', ''))
+            model.removeStatements(model.getStatements('s2'))
+            model.commit()
+            self.assertEqual(list(it), sorted(model.getStatements())[1:])
+            self.assertEqual(list(model.iterStatements(context='c')), 
+                                    model.getStatements(context='c'))
+
+    def testPredicateStatistics(self):
+        "test the per-predicate statistics used by the query engine"
+        model = self.getModel()
+        if model.getPredicateStatistics('p') is None:
+            return #statistics not supported
+        if getattr(model, 'revisionModel', None) is getattr(model, 
+                                                    'managedModel', False):
+            return #statistics include the revision history statements
+
+        statements = [Statement("s1", "p", "o1", "L", ""),
+                      Statement("s1", "p", "o2", "L", ""),
+                      Statement("s2", "p", "o1", "L", ""),
+                      Statement("s2", "p", "o1", "L", "c"),
+                      Statement("s2", "q", "o1", "L", "")]
+        model.addStatements(statements)
+        model.addStatement(statements[0]) #already added, ignored
+        model.commit()
+        self.assertEqual(model.getPredicateStatistics('p'),
+                                        PredicateStatistics(4, 2, 2))
+        self.assertEqual(model.getPredicateStatistics('q'),
+                                        PredicateStatistics(1, 1, 1))
+        self.assertEqual(model.getPredicateStatistics('missing'),
+                                        PredicateStatistics(0, 0, 0))
+        self.assertEqual(model.getPredicateStatistics(None).count, 5)
+
+        model.removeStatement(statements[2])
+        model.commit()
+        self.assertEqual(model.getPredicateStatistics('p'),
+                                        PredicateStatistics(3, 2, 2))
+        model.removeStatement(statements[3])
+        model.commit()
+        self.assertEqual(model.getPredicateStatistics('p'),
+                                        PredicateStatistics(2, 1, 2))
+        model.removeStatement(statements[4])
+        model.commit()
+        self.assertEqual(model.getPredicateStatistics('q'),
+                                        PredicateStatistics(0, 0, 0))
+
+    def testSnapshot(self):
+        "test that a snapshot isn't affected by later changes to the model"
+        model = self.getModel()
+        if not model.snapshotReads:
+            return #snapshots not supported
+
+        s1 = Statement('s', 'p', 'o1', 'L', '')
+        s2 = Statement('s', 'p', 'o2', 'L', 'c')
+        s3 = Statement('t', 'p', 'o1', 'L', 'c')
+        model.addStatements([s1, s2])
+        model.commit()
+        snapshot = model.getSnapshot()
+        model.removeStatement(s2)
+        model.addStatement(s3)
+        model.commit()
+        self.assertEqual(snapshot.getStatements(), [s1, s2])
+        self.assertEqual(snapshot.getStatements(context='c'), [s2])
+        self.assertEqual(snapshot.getStatements(object='o1'), [s1])
+        self.assertEqual(snapshot.getPredicateStatistics('p'),
+                                        PredicateStatistics(2, 1, 2))
+        self.assertRaises(RuntimeError, snapshot.addStatement, s3)
+        self.assertEqual(model.getStatements(), [s1, s3])
+        self.assertEqual(model.getStatements(context='c'), [s3])
+        self.assertEqual(model.getPredicateStatistics('p'),
+                                        PredicateStatistics(2, 2, 1))
+        if isinstance(model, MemStore):
+            #only the sets that changed were copied
+            self.assert_(snapshot.by_s is not model.by_s)
+            self.assert_(snapshot.by_s['s'] is not model.by_s['s'])
+            self.assert_(snapshot.by_o['o2'] is not model.by_o.get('o2'))
+            self.assert_(snapshot.by_p['p'] is not model.by_p['p'])
+        snapshot.close()
+
+        snapshot = model.getSnapshot()
+        self.assertEqual(snapshot.getStatements(), [s1, s3])
+        snapshot.close()
+        if isinstance(model, MemStore):
+            del snapshot
+            #no snapshot is left so changes don't copy anything
+            model.removeStatement(s3)
+            model.commit()
+            self.assertEqual(model._owned, None)
+            self.assertEqual(model.getStatements(), [s1])
+
+            #until a snapshot is read changes are just recorded in it
+            snapshot = model.getSnapshot()
+            model.addStatement(s2)
+            model.commit()
+            self.assertEqual(model._owned, None)
+            self.assertEqual(snapshot.getStatements(), [s1])
+            self.assertEqual(snapshot.getPredicateStatistics('p'),
+                                        PredicateStatistics(1, 1, 1))
+            self.assertEqual(model.getStatements(), [s1, s2])
+
 class BasicModelTestCase(SimpleModelTestCase):
 
     def getTransactionModel(self):
@@ -512,6 +654,127 @@ class TransactionModelTestCase(SimpleModelTestCase):
         model = TransactionMemStore()
         return self._getModel(model)
 
+    def testPendingChanges(self):
+        "test that uncommitted changes are visible and applied in a batch"
+        model = self.getModel()
+        s1 = Statement('s', 'p', 'o1', 'L', '')
+        s2 = Statement('s', 'p', 'o2', 'L', '')
+        s3 = Statement('s', 'p', 'o3', 'L', 'c')
+        model.addStatements([s1, s2, s3])
+        model.commit()
+
+        s4 = Statement('s', 'q', 'o1', 'L', 'c')
+        model.removeStatement(s1)
+        model.addStatement(s4)
+        model.addStatement(s1) #cancels the removal
+        model.removeStatement(Triple('s', 'p', 'o2', 'L'))
+        self.assertEqual(model.getStatements('s', 'p'), [s1, s3])
+        model.addStatement(s2)
+        model.removeStatement(s3)
+        model.addStatement(Statement('t', 'p', 'o1', 'L', ''))
+        model.removeStatement(Statement('t', 'p', 'o1', 'L', ''))
+        self.assertEqual(model.getStatements('s'), [s1, s2, s4])
+        self.assertEqual(model.getStatements(predicate='p'), [s1, s2])
+        self.assertEqual(model.getStatements(object='o1'), [s1, s4])
+        self.assertEqual(model.getStatements(context='c'), [s4])
+        self.assertEqual(model.getStatements('s', hints=dict(limit=1, offset=1)),
+                                                                        [s2])
+        self.assertEqual(model.getStatements('t'), [])
+
+        batches = []
+        addStatements = MemStore.addStatements
+        def recordBatch(self, stmts):
+            batches.append(list(stmts))
+            return addStatements(self, batches[-1])
+        MemStore.addStatements = recordBatch
+        try:
+            model.commit()
+        finally:
+            MemStore.addStatements = addStatements
+        self.assertEqual(batches, [[s1, s2, s4]])
+        self.assertEqual(model.getStatements(), [s1, s2, s4])
+
+        model.removeStatement(s4)
+        model.rollback()
+        self.assertEqual(model.getStatements(), [s1, s2, s4])
+
+class InternedTermsModelTestCase(SimpleModelTestCase):
+    persistentStore = False
+
+    def getModel(self):
+        model = MemStore(internTerms=True)
+        return self._getModel(model)
+
+    def testInternTerms(self):
+        "test that statements added to the store share their terms"
+        model = self.getModel()
+        #build equal but distinct strings
+        subject = ''.join(['s', '1'])
+        model.addStatement(Statement(subject, 'p', 'o', 'L', ''))
+        model.addStatement(Statement(''.join(['s', '1']), 'q', subject, 'R', ''))
+        stmts = model.getStatements()
+        self.assertEqual(len(stmts), 2)
+        self.assert_(stmts[0][0] is stmts[1][0] is stmts[1][2])
+        self.assertEqual(len(model.termTable), 7)
+
+        model.removeStatement(Statement('s1', 'q', 's1', 'R', ''))
+        self.assert_('q' not in model.termTable)
+        self.assert_('s1' in model.termTable)
+        model.removeStatement(Statement('s1', 'p', 'o', 'L', ''))
+        self.assert_('s1' not in model.termTable)
+
+        #stores can share a term table
+        other = MemStore(internTerms=model.termTable)
+        other.addStatement(Statement('s2', 'p', 'o', 'L', ''))
+        model.addStatement(Statement(''.join(['s', '2']), 'p', 'o', 'L', ''))
+        self.assert_(other.getStatements()[0][0] is model.getStatements()[0][0])
+        #and a term is kept until no store uses it
+        model.removeStatement(Statement('s2', 'p', 'o', 'L', ''))
+        self.assert_('s2' in model.termTable)
+        self.assertEqual(other.getStatements()[0][0], 's2')
+        other.removeStatement(Statement('s2', 'p', 'o', 'L', ''))
+        self.assertEqual(len(model.termTable), 0)
+
+class StatementTestCase(unittest.TestCase):
+
+    def testStatementSize(self):
+        "test that statements don't have a per-instance dictionary"
+        stmt = Statement('s', 'p', 'o', 'L', 'c')
+        self.assertRaises(AttributeError, getattr, stmt, '__dict__')
+        self.assertEqual(sys.getsizeof(stmt), sys.getsizeof(tuple(stmt)))
+        self.assertRaises(AttributeError, getattr, Triple(*stmt), '__dict__')
+        self.assertEqual(tuple.__new__(Statement, stmt), stmt)
+        self.assertEqual(StatementWithOrder('s', 'p', 'o', 'L', 'c',
+                                                    [1]).listpos, (1,))
+
+    def testStatementCreation(self):
+        "benchmark creating statements from rows (-b to change the count)"
+        rows = [('s%d' % i, 'p', 'o%d' % i, 'L', '') for i in xrange(BIG*70)]
+        start = time.time()
+        stmts = [Statement(*row) for row in rows]
+        print 'created %s statements in %s seconds' % (len(rows),
+                                                        time.time() - start)
+        start = time.time()
+        new = tuple.__new__
+        fast = [new(Statement, row) for row in rows]
+        print 'created %s statements from rows in %s seconds' % (len(rows),
+                                                        time.time() - start)
+        self.assertEqual(stmts, fast)
+        print '%s bytes per statement (%s for a tuple)' % (
+                    sys.getsizeof(stmts[0]), sys.getsizeof(rows[0]))
+
+    def testIterUniqueStatements(self):
+        stmts = sorted(Statement(s, 'p', o, 'L', c) for s in ('s1', 's2')
+                                for o in ('o1', 'o2') for c in ('', 'c'))
+        triples = [stmt for stmt in stmts if not stmt[4]]
+        self.assertEqual(list(iterUniqueStatements(iter(stmts))), stmts)
+        self.assertEqual(list(iterUniqueStatements(iter(stmts), asQuad=False)),
+                                                                    triples)
+        self.assertEqual(list(iterUniqueStatements(iter(stmts), asQuad=False, 
+                                                presorted=True)), triples)
+        self.assertEqual(list(iterUniqueStatements(iter(stmts), asQuad=False, 
+                    presorted=True, limit=2, offset=1)), triples[1:3])
+
 class GraphModelTestCase(BasicModelTestCase):
 
     def _getModel(self, model):
@@ -70,6 +70,26 @@ class TxnStateTest(unittest.TestCase):
             ('finish',ts,True), ('abort',ts), ('finish',ts,False),
         ]
 
+    def testCallAfterRelease(self):
+        ts = self.ts
+        ts.begin()
+        ts.join(self.p)
+        ts.callAfterRelease(lambda: self.log.append(('afterRelease', 
+                                                    ts.isActive())))
+        ts.commit()
+
+        #not called if the transaction aborts
+        ts.begin()
+        ts.join(self.p)
+        ts.callAfterRelease(lambda: self.log.append('unexpected'))
+        ts.abort()
+
+        assert self.log == [
+            ('readyToVote',ts), ('voteForCommit',ts), ('commit',ts),
+            ('finish',ts,True), ('afterRelease', False), 
+            ('abort',ts), ('finish',ts,False),
+        ]
+
     def testExceptionDuringCommit(self):
         ts = self.ts
         ts.begin()
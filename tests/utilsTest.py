@@ -63,6 +63,60 @@ class utilsTestCase(unittest.TestCase):
         self.failUnless(test.tl1 == 2)
         self.failUnless(test.tl2 == 'a')
         
+    def testReadWriteLock(self):
+        import time
+        lock = ReadWriteLock()
+        events = []
+        def reader(name):
+            lock.acquireRead()
+            events.append(name)
+            lock.releaseRead()
+        def writer(name):
+            lock.acquireWrite()
+            events.append(name)
+            lock.releaseWrite()
+
+        #readers don't block each other
+        lock.acquireRead()
+        t = threading.Thread(target=reader, args=('r1',))
+        t.start()
+        t.join(1)
+        self.assertEquals(events, ['r1'])
+
+        #but a writer waits for the reader and new readers wait for the writer
+        w = threading.Thread(target=writer, args=('w1',))
+        w.start()
+        time.sleep(.05)
+        t = threading.Thread(target=reader, args=('r2',))
+        t.start()
+        time.sleep(.05)
+        self.assertEquals(events, ['r1'])
+        lock.releaseRead()
+        w.join(1)
+        t.join(1)
+        self.assertEquals(events, ['r1', 'w1', 'r2'])
+
+    def testThreadPool(self):
+        pool = ThreadPool(2)
+        tasks = [pool.submit(lambda x: x * 2, i) for i in range(10)]
+        self.assertEquals([task.result() for task in tasks], range(0, 20, 2))
+
+        #exceptions are raised by result()
+        task = pool.submit(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, task.result)
+
+        #tasks can wait on each other even when every thread is busy
+        def outer(i):
+            inner = [pool.submit(lambda: i) for j in range(3)]
+            return sum(task.result() for task in inner)
+        tasks = [pool.submit(outer, i) for i in range(4)]
+        self.assertEquals([task.result() for task in tasks], [0, 3, 6, 9])
+
+        pool.close()
+        self.assertEquals(pool.threads, [])
+        #tasks left in the queue still run in the thread waiting on them
+        self.assertEquals(pool.submit(lambda: 'done').result(), 'done')
+
     def testDiffPatch(self):
         orig = "A B C D E"
         new = "A C E D"